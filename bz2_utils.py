@@ -0,0 +1,265 @@
+###############################################################################
+#
+# Multi-core reader for (large) bz2 files
+#
+# A bz2 file is a sequence of independently compressed blocks, each starting
+# with a 48-bit magic number at an arbitrary bit offset. We find the block
+# boundaries in the compressed file, turn every block into a standalone
+# single-block bz2 stream, and decompress the blocks in a pool of worker
+# processes. Lines are returned in file order, so the reader can be used
+# in place of a bz2.BZ2File opened for reading.
+#
+# Each block carries its own CRC, which is checked when it is decompressed.
+# If the magic number shows up by chance inside compressed data, the block
+# before it fails to decompress and is merged with the next one.
+#
+###############################################################################
+import bz2
+import os
+import os.path
+import numpy
+import multiprocessing
+from collections import deque
+
+import config
+
+block_magic = 0x314159265359
+eos_magic = 0x177245385090
+
+# files smaller than this are read with bz2.BZ2File
+min_parallel_file_size = 4*1024*1024
+
+# size of compressed pieces read while looking for block boundaries
+scan_piece_size = 16*1024*1024
+
+# maximum number of blocks decompressed ahead of the reader (per thread)
+blocks_per_thread = 2
+
+# shared by all open readers
+worker_pool = None
+worker_pool_size = 0
+
+def get_worker_pool(num_threads):
+    global worker_pool, worker_pool_size
+    if worker_pool is None or worker_pool_size != num_threads:
+        if worker_pool is not None:
+            worker_pool.terminate()
+        worker_pool = multiprocessing.Pool(num_threads)
+        worker_pool_size = num_threads
+    return worker_pool
+
+#############
+#
+# Returns list of 8 (shift, byte pattern, offset of pattern, 56-bit mask, 56-bit value) tuples,
+# one for each bit offset of magic within a byte
+#
+#############
+def calculate_magic_patterns(magic):
+
+    patterns = []
+    for shift in xrange(0,8):
+        value = magic << (8-shift)
+        mask = ((1<<48)-1) << (8-shift)
+        value_str = "".join([chr((value >> (8*(6-i))) & 0xff) for i in xrange(0,7)])
+        if shift==0:
+            # first six bytes are fully determined
+            patterns.append((shift, value_str[0:6], 0, mask, value))
+        else:
+            # only bytes 1-5 are
+            patterns.append((shift, value_str[1:6], 1, mask, value))
+    return patterns
+
+block_magic_patterns = calculate_magic_patterns(block_magic)
+eos_magic_patterns = calculate_magic_patterns(eos_magic)
+
+def find_magic_bit_offsets(data, magic_patterns):
+
+    bit_offsets = []
+    for shift, pattern, pattern_offset, mask, value in magic_patterns:
+        byte_idx = data.find(pattern)
+        while byte_idx >= 0:
+            start_idx = byte_idx-pattern_offset
+            if start_idx >= 0 and start_idx+7 <= len(data):
+                word = 0
+                for c in data[start_idx:start_idx+7]:
+                    word = (word << 8) | ord(c)
+                if (word & mask) == value:
+                    bit_offsets.append(8*start_idx+shift)
+            byte_idx = data.find(pattern, byte_idx+1)
+    return bit_offsets
+
+###############################################################################
+#
+# Iterates over (start_bit, end_bit, is_block) for the pieces of a bz2 file
+# between consecutive block or end-of-stream markers. is_block is False for
+# pieces that start at an end-of-stream marker (these contain no data).
+#
+###############################################################################
+def iterate_bz2_block_segments(filename):
+
+    file = open(filename,"rb")
+
+    # (start of current segment, if any)
+    segment_start = -1
+    segment_is_block = False
+
+    piece_start = 0
+    while True:
+        file.seek(piece_start)
+        # overlap pieces so that magic numbers spanning them are found
+        data = file.read(scan_piece_size+7)
+        if len(data)==0:
+            break
+
+        boundaries = [(bit_offset, True) for bit_offset in find_magic_bit_offsets(data, block_magic_patterns)]
+        boundaries.extend([(bit_offset, False) for bit_offset in find_magic_bit_offsets(data, eos_magic_patterns)])
+        boundaries.sort()
+
+        for bit_offset, is_block in boundaries:
+            bit_offset += 8*piece_start
+            if bit_offset <= segment_start:
+                # already seen in previous piece
+                continue
+
+            if segment_start >= 0:
+                yield segment_start, bit_offset, segment_is_block
+
+            segment_start = bit_offset
+            segment_is_block = is_block
+
+        if len(data) < scan_piece_size+7:
+            break
+        piece_start += scan_piece_size
+
+    file.close()
+
+    if segment_is_block:
+        # a block with no end-of-stream marker after it
+        raise IOError("truncated bz2 file %s" % filename)
+
+#############
+#
+# Decompresses block between start_bit and end_bit
+# (runs in worker processes)
+#
+# returns decompressed string, or None if the block is invalid
+#
+#############
+def decompress_bz2_block(filename, start_bit, end_bit):
+
+    file = open(filename,"rb")
+    file.seek(start_bit/8)
+    data = file.read((end_bit+7)/8-start_bit/8)
+    file.close()
+
+    bit_shift = start_bit%8
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))[bit_shift:bit_shift+(end_bit-start_bit)]
+
+    # a single-block stream ends with the end-of-stream marker and
+    # the combined CRC, which for one block is just the block CRC
+    eos_bits = numpy.unpackbits(numpy.frombuffer("".join([chr((eos_magic >> (8*(5-i))) & 0xff) for i in xrange(0,6)]), dtype=numpy.uint8))
+    crc_bits = bits[48:80]
+
+    stream_bits = numpy.concatenate([bits, eos_bits, crc_bits])
+
+    try:
+        return bz2.decompress("BZh9"+numpy.packbits(stream_bits).tostring())
+    except (IOError, ValueError, EOFError):
+        return None
+
+###############################################################################
+#
+# Iterates over decompressed blocks of a bz2 file, in order
+#
+###############################################################################
+def iterate_bz2_blocks(filename, num_threads=config.bz2_num_threads):
+
+    pool = get_worker_pool(num_threads)
+    segments = iterate_bz2_block_segments(filename)
+    pending_blocks = deque()
+
+    def fill_pending_blocks():
+        while len(pending_blocks) < blocks_per_thread*num_threads:
+            try:
+                start_bit, end_bit, is_block = segments.next()
+            except StopIteration:
+                break
+            if is_block:
+                result = pool.apply_async(decompress_bz2_block, (filename, start_bit, end_bit))
+            else:
+                result = None
+            pending_blocks.append((start_bit, end_bit, is_block, result))
+
+    fill_pending_blocks()
+    while len(pending_blocks) > 0:
+
+        start_bit, end_bit, is_block, result = pending_blocks.popleft()
+        if not is_block:
+            fill_pending_blocks()
+            continue
+
+        data = result.get()
+
+        while data is None:
+            # end_bit was a false boundary: merge with next segment
+            fill_pending_blocks()
+            if len(pending_blocks)==0:
+                raise IOError("invalid bz2 block in %s at bit %d" % (filename, start_bit))
+            next_start_bit, end_bit, next_is_block, next_result = pending_blocks.popleft()
+            data = decompress_bz2_block(filename, start_bit, end_bit)
+
+        fill_pending_blocks()
+        yield data
+
+def iterate_bz2_lines(filename, num_threads=config.bz2_num_threads):
+
+    partial_line = ""
+    for data in iterate_bz2_blocks(filename, num_threads):
+        lines = data.split("\n")
+        lines[0] = partial_line+lines[0]
+        partial_line = lines.pop()
+        for line in lines:
+            yield line+"\n"
+
+    if len(partial_line) > 0:
+        yield partial_line
+
+###############################################################################
+#
+# Read-only stand-in for bz2.BZ2File
+#
+# (supports readline(), iteration and close(), but not seek())
+#
+###############################################################################
+class ParallelBZ2File:
+
+    def __init__(self, filename, num_threads=config.bz2_num_threads):
+        self.lines = iterate_bz2_lines(filename, num_threads)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.lines.next()
+
+    def readline(self):
+        try:
+            return self.lines.next()
+        except StopIteration:
+            return ""
+
+    def close(self):
+        self.lines.close()
+
+###############################################################################
+#
+# Opens bz2 file for reading, with a parallel reader if the file is big
+# enough and more than one thread is available
+#
+###############################################################################
+def open_bz2_file(filename, num_threads=config.bz2_num_threads):
+
+    if num_threads <= 1 or os.path.getsize(filename) < min_parallel_file_size:
+        return bz2.BZ2File(filename,"r")
+    else:
+        return ParallelBZ2File(filename, num_threads)
@@ -226,7 +226,7 @@ if __name__=='__main__':
         sample_coverage_map = parse_midas_data.parse_sample_coverage_map(species_name)
 
         sys.stderr.write("Loading SFSs for %s...\t" % species_name)
-        samples, sfs_map = parse_midas_data.parse_within_sample_sfs(species_name, allowed_variant_types=set(['1D','2D','3D','4D'])) 
+        samples, sfs_arrays = parse_midas_data.parse_within_sample_sfs_arrays(species_name, allowed_variant_types=set(['1D','2D','3D','4D'])) 
         sys.stderr.write("Done!\n")
 
 
@@ -252,7 +252,7 @@ if __name__=='__main__':
         sys.stderr.write("Done! %d shared genes and %d non-shared genes\n" % (len(shared_pangenome_genes), len(non_shared_genes)))
 
         import calculate_private_snvs
-        private_snv_map = calculate_private_snvs.load_private_snv_map(species_name)
+        private_snv_map = calculate_private_snvs.load_private_snv_keys(species_name)
     
         # Load SNP information for species_name
         sys.stderr.write("Loading SNPs for %s...\n" % species_name)    
@@ -331,6 +331,7 @@ if __name__=='__main__':
                                
         # Calculate SNP error rate
         same_sample_idxs, same_subject_idxs, diff_subject_idxs = sample_utils.calculate_ordered_subject_pairs(sample_order_map, snp_samples)   
+        perrs = diversity_utils.calculate_fixation_error_rates(sfs_arrays, [snp_samples[i] for i in same_subject_idxs[0]], [snp_samples[j] for j in same_subject_idxs[1]])[:,0]
         for sample_pair_idx in xrange(0,len(same_subject_idxs[0])):
     
             i = same_subject_idxs[0][sample_pair_idx]
@@ -340,7 +341,7 @@ if __name__=='__main__':
             sample_j = snp_samples[j]
             sample_pair = (sample_i, sample_j)
         
-            perr = diversity_utils.calculate_fixation_error_rate(sfs_map, sample_i, sample_j)[0]
+            perr = perrs[sample_pair_idx]
             
             snp_perrs[sample_pair] = perr
             tracked_private_snp_perrs[sample_pair] = perr
@@ -3,6 +3,7 @@ import bz2
 import numpy
 
 import parse_midas_data
+import bz2_utils
 if len(sys.argv) > 1:
     species_name=sys.argv[1]
 else:
@@ -28,8 +29,8 @@ prevalence_min_coverage = 3
 
 allowed_variant_types = set(["1D","2D","3D","4D"]) # use all types of sites to include most information
 
-depth_file = bz2.BZ2File("%ssnps/%s/snps_depth.txt.bz2" % (parse_midas_data.data_directory, species_name),"r")
-info_file = bz2.BZ2File("%ssnps/%s/snps_info.txt.bz2" % (parse_midas_data.data_directory, species_name),"r")
+depth_file = bz2_utils.open_bz2_file("%ssnps/%s/snps_depth.txt.bz2" % (parse_midas_data.data_directory, species_name))
+info_file = bz2_utils.open_bz2_file("%ssnps/%s/snps_info.txt.bz2" % (parse_midas_data.data_directory, species_name))
     
 depth_line = depth_file.readline() # header
 info_line = info_file.readline()
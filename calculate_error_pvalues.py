@@ -1,16 +1,238 @@
 import sys
 import os
 import bz2
+import numpy
+import multiprocessing
+from collections import deque
 import parse_midas_data
 
-if len(sys.argv) > 1:
-    species_name=sys.argv[1]
-else:
-    species_name=parse_midas_data.debug_species_name
+###############################################################################
+#
+# Python version of the error_filtering_cpp_code/annotate_pvalue program
+#
+# Filtered sites from pipe_snps are annotated with a bootstrapped pvalue of
+# a likelihood ratio test between a null model where all samples share the
+# same (error) frequency and an alternative where each sample has its own.
+# The LRT is calculated for many sites (and bootstraps) at once, and sites
+# are divided between a pool of worker processes. Every site has its own
+# random seed, so pvalues don't depend on the number of processes.
+#
+###############################################################################
 
-sys.stderr.write("Calculating pvalues for %s...\n" % species_name)
+# same defaults as error_filtering_cpp_code
+max_error_rate = 0.01
+default_max_num_bootstraps = 10000
+default_min_numerator_counts = 100
+default_seed = 42
 
-output_filename = "%ssnps/%s/annotated_snps.txt.bz2" % (parse_midas_data.data_directory, species_name)
+# number of bootstrapped trajectories drawn at once for each site
+bootstrap_batch_size = 100
 
-os.system('python %spipe_midas_data.py %s | %sannotate_pvalue --disabled | bzip2 -c > %s' % (parse_midas_data.scripts_directory, species_name, parse_midas_data.scripts_directory, output_filename) )  
- 
+# number of sites handed to a worker process at once
+sites_per_task = 500
+
+# maximum number of tasks waiting to be written (per process)
+tasks_per_process = 4
+
+###############################################################################
+#
+# Calculates LRT statistic (calculate_LRT in trajectory.hpp)
+# for every trajectory in alts (... x samples)
+#
+# samples with depth==0 are masked
+#
+# returns array of LRTs (with the leading dimensions of alts)
+#
+###############################################################################
+def calculate_LRTs(alts, depths):
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+
+        total_alts = alts.sum(axis=-1)
+        total_depths = depths.sum(axis=-1)
+
+        # cap the avg frequency at max error rate
+        ps = numpy.minimum(total_alts*1.0/total_depths, max_error_rate)
+
+        # (LRT is zero otherwise)
+        good_ps = (ps>0)*(ps<1)
+        ps = numpy.where(good_ps, ps, 0.5)[...,None]
+
+        # calculate upper and lower alt thresholds
+        # (so that we don't waste statistical power on
+        #  changes that we don't value scientifically)
+        expected_alts = depths*ps
+        stddev_alts = numpy.sqrt(depths*ps*(1-ps))
+
+        lower_alt_thresholds = numpy.fmax(numpy.fmin(numpy.floor(expected_alts)-0.5, expected_alts-stddev_alts), 0.0)
+        upper_alt_thresholds = numpy.fmin(numpy.fmax(numpy.ceil(expected_alts)+0.5, expected_alts+stddev_alts), depths)
+
+        outside_thresholds = numpy.logical_or(alts<lower_alt_thresholds, alts>upper_alt_thresholds)*(depths>0)
+
+        # only samples outside the thresholds contribute
+        # (usually a small fraction, so only calculate logs for those)
+        alts, depths, ps = numpy.broadcast_arrays(alts, depths, ps)
+        trajectory_idxs, sample_idxs = numpy.nonzero(outside_thresholds.reshape((-1,outside_thresholds.shape[-1])))
+        outside_alts = alts.reshape((-1,alts.shape[-1]))[trajectory_idxs, sample_idxs]
+        outside_depths = depths.reshape((-1,depths.shape[-1]))[trajectory_idxs, sample_idxs]
+        outside_ps = ps.reshape((-1,ps.shape[-1]))[trajectory_idxs, sample_idxs]
+
+        pis = outside_alts*1.0/outside_depths
+
+        log_LRTs = numpy.where(pis>0, outside_depths*pis*numpy.log(pis/outside_ps), 0)
+        log_LRTs += numpy.where(pis<1, outside_depths*(1-pis)*numpy.log((1-pis)/(1-outside_ps)), 0)
+
+        log_LRTs = numpy.bincount(trajectory_idxs, weights=log_LRTs, minlength=good_ps.size).reshape(good_ps.shape)
+
+    return numpy.where(good_ps, log_LRTs, 0)
+
+###############################################################################
+#
+# Calculates bootstrapped pvalues (calculate_pvalue in main.cpp)
+# for a set of sites
+#
+# alts, depths = (sites x samples) matrices
+# site_idxs = index of each site in the file (used to seed random numbers)
+#
+# returns array of pvalues
+#
+###############################################################################
+def calculate_pvalues(alts, depths, site_idxs, seed=default_seed, max_num_bootstraps=default_max_num_bootstraps, min_numerator_counts=default_min_numerator_counts):
+
+    num_sites = alts.shape[0]
+
+    observed_LRTs = calculate_LRTs(alts, depths)
+
+    # null model is based on resampling of observed trajectory
+    # with the (capped) average frequency
+    total_alts = alts.sum(axis=1)
+    total_depths = depths.sum(axis=1)
+    ps = numpy.minimum(total_alts*1.0/(total_depths+(total_depths==0)), max_error_rate)
+    int_depths = depths.astype(numpy.int64)
+
+    randoms = [numpy.random.RandomState([seed, site_idx]) for site_idx in site_idxs]
+
+    num_greater_LRTs = numpy.zeros(num_sites, dtype=numpy.int64)
+    num_bootstraps = numpy.zeros(num_sites, dtype=numpy.int64)
+
+    active_idxs = numpy.arange(0,num_sites)
+    while len(active_idxs) > 0:
+
+        # draw next batch of bootstrapped trajectories for each active site
+        bootstrapped_alts = numpy.array([randoms[i].binomial(int_depths[i], ps[i], size=(bootstrap_batch_size, alts.shape[1])) for i in active_idxs])
+
+        bootstrapped_LRTs = calculate_LRTs(bootstrapped_alts, depths[active_idxs][:,None,:])
+
+        # running number of bootstraps at least as extreme
+        cumulative_greater_LRTs = num_greater_LRTs[active_idxs][:,None] + (bootstrapped_LRTs >= observed_LRTs[active_idxs][:,None]).cumsum(axis=1)
+        cumulative_bootstraps = num_bootstraps[active_idxs][:,None] + numpy.arange(1,bootstrap_batch_size+1)[None,:]
+
+        # bootstrapping stops as soon as either condition is met
+        stops = numpy.logical_or(cumulative_greater_LRTs > min_numerator_counts, cumulative_bootstraps >= max_num_bootstraps)
+        stopped = stops.any(axis=1)
+        stop_idxs = numpy.where(stopped, stops.argmax(axis=1), bootstrap_batch_size-1)
+
+        num_greater_LRTs[active_idxs] = cumulative_greater_LRTs[numpy.arange(0,len(active_idxs)), stop_idxs]
+        num_bootstraps[active_idxs] = cumulative_bootstraps[numpy.arange(0,len(active_idxs)), stop_idxs]
+
+        active_idxs = active_idxs[numpy.logical_not(stopped)]
+
+    # calculate pvalues
+    pvalues = (num_greater_LRTs+1.0)/(num_bootstraps+1.0)
+    return pvalues
+
+###############################################################################
+#
+# Writes annotated_snps.txt.bz2 for species
+# (replaces "pipe_midas_data.py | annotate_pvalue | bzip2")
+#
+# returns number of sites written
+#
+###############################################################################
+def write_annotated_snps(species_name, disabled=True, num_processes=multiprocessing.cpu_count(), debug=False):
+
+    output_filename = "%ssnps/%s/annotated_snps.txt.bz2" % (parse_midas_data.data_directory, species_name)
+
+    if disabled:
+        sys.stderr.write("Warning: skipping pvalue calculation & setting p=0!\n")
+    else:
+        pool = multiprocessing.Pool(num_processes)
+
+    # (site_id_strs, alts, depths, pvalues or async result)
+    pending_tasks = deque()
+
+    num_processed = 0
+    num_surprising = 0
+
+    def write_next_task():
+        site_id_strs, alts, depths, pvalues = pending_tasks.popleft()
+        if not disabled:
+            pvalues = pvalues.get()
+        output_file.write("\n")
+        output_file.write("\n".join(parse_midas_data.format_pipe_snps_lines(site_id_strs, alts, depths, pvalues)))
+        return len(site_id_strs), (pvalues<=5e-02).sum()
+
+    output_file = bz2.BZ2File(output_filename,"w")
+
+    for batch_idx, (samples, site_id_strs, alts, depths) in enumerate(parse_midas_data.iterate_pipe_snps_batches(species_name, debug=debug)):
+
+        if batch_idx==0:
+            # first print header
+            output_file.write("\t".join(["site_id"]+samples))
+
+        for start_idx in xrange(0, len(site_id_strs), sites_per_task):
+
+            end_idx = min([start_idx+sites_per_task, len(site_id_strs)])
+            site_idxs = numpy.arange(num_processed, num_processed+end_idx-start_idx)
+            num_processed += end_idx-start_idx
+
+            if disabled:
+                pvalues = numpy.zeros(end_idx-start_idx)
+            else:
+                pvalues = pool.apply_async(calculate_pvalues, (alts[start_idx:end_idx], depths[start_idx:end_idx], site_idxs))
+
+            pending_tasks.append((site_id_strs[start_idx:end_idx], alts[start_idx:end_idx], depths[start_idx:end_idx], pvalues))
+
+            while len(pending_tasks) > tasks_per_process*num_processes:
+                num_surprising += write_next_task()[1]
+
+        sys.stderr.write("%dk trajectories processed, %d surprising!\n" % (num_processed/1000, num_surprising))
+
+    while len(pending_tasks) > 0:
+        num_surprising += write_next_task()[1]
+
+    output_file.write("\n")
+    output_file.close()
+
+    if not disabled:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write("Finished: %d trajectories processed, %d surprising!\n" % (num_processed, num_surprising))
+
+    return num_processed
+
+if __name__=='__main__':
+
+    ################################################################################
+    #
+    # Standard header to read in argument information
+    #
+    ################################################################################
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("species_name", help="name of species to process", nargs='?', default=parse_midas_data.debug_species_name)
+    parser.add_argument("--debug", help="Loads only a subset of SNPs for speed", action="store_true")
+    parser.add_argument("--calculate-pvalues", help="Calculates bootstrapped pvalues (otherwise p=0 for every site, like annotate_pvalue --disabled)", action="store_true")
+    parser.add_argument("--num-processes", type=int, help="number of processes used to calculate pvalues", default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    species_name = args.species_name
+    debug = args.debug
+    calculate_pvalues_flag = args.calculate_pvalues
+    num_processes = args.num_processes
+    ################################################################################
+
+    sys.stderr.write("Calculating pvalues for %s...\n" % species_name)
+
+    write_annotated_snps(species_name, disabled=(not calculate_pvalues_flag), num_processes=num_processes, debug=debug)
@@ -2,6 +2,7 @@ import sys
 import bz2
 import numpy
 import parse_midas_data
+import sample_id_utils
 
 if len(sys.argv) > 1:
     species_name=sys.argv[1]
@@ -36,7 +37,7 @@ items = line.split()
 samples = items[1:]
 
 # get the indexes of the samples in the coverage file corresponding to the depth file.
-output_idxs = numpy.array([samples.index(sample) for sample in output_samples])
+output_idxs = sample_id_utils.calculate_sample_idxs(output_samples, samples)
     
 # write header lines for output file
 output_coverage_file.write("\t".join([items[0]]+output_samples))
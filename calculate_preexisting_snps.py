@@ -8,6 +8,7 @@ import numpy
 
 import diversity_utils
 import gene_diversity_utils
+import calculate_snp_prevalences
 
 import stats_utils
 from math import log10,ceil
@@ -20,9 +21,18 @@ intermediate_filename = '%spreexisting_snps.txt.gz' % (parse_midas_data.data_dir
 min_coverage = 5
 allowed_variant_types = set(['1D','2D','3D','4D'])
 
-def parse_preexisting_snps(species_name):
+###############################################################################
+#
+# Loads preexisting snps for species
+#
+# returns site freq table of prevalences (see calculate_snp_prevalences)
+#
+###############################################################################
+def load_preexisting_snp_table(species_name):
     
-    preexisting_snps = {}  
+    contigs = []
+    locations = []
+    prevalences = []
     file = gzip.GzipFile(intermediate_filename,"r")
     for line in file:
         if line.startswith(species_name):
@@ -36,14 +46,17 @@ def parse_preexisting_snps(species_name):
                 snp_items = contig_subitems[1].split()
                 for snp_item in snp_items:
                     snp_subitems = snp_item.split(",")
-                    location = long(snp_subitems[0])
-                    prevalence = float(snp_subitems[1])
-                    
-                    preexisting_snps[(contig,location)] = prevalence
+                    contigs.append(contig)
+                    locations.append(long(snp_subitems[0]))
+                    prevalences.append(float(snp_subitems[1]))
                     
     file.close()
     
-    return preexisting_snps
+    return calculate_snp_prevalences.create_site_freq_table(species_name, contigs, locations, prevalences)
+
+# (map from (contig,location) -> prevalence, see load_preexisting_snp_table)
+def parse_preexisting_snps(species_name):
+    return calculate_snp_prevalences.site_freq_table_to_map(load_preexisting_snp_table(species_name))
     
 if __name__=='__main__':
 
@@ -15,6 +15,7 @@ from numpy.random import randint
 
 import core_gene_utils
 import gzip
+import site_key_utils
 
 private_snv_directory = '%sprivate_snvs/' % (parse_midas_data.data_directory)
 intermediate_filename_template = '%s%s.txt.gz'  
@@ -48,8 +49,29 @@ def load_private_snv_map(species_name):
         
         private_snv_map[(contig, location)] = (gene_name, variant_type, host)
         
+    file.close()
     return private_snv_map
 
+def load_private_snv_keys(species_name):
+# returns sorted array of site keys of private snvs (see site_key_utils)
+# (faster than load_private_snv_map for checking whether many sites are private)
+
+    intermediate_filename = intermediate_filename_template % (private_snv_directory, species_name)
+
+    contigs = []
+    locations = []
+
+    if os.path.isfile(intermediate_filename):
+        file = gzip.open(intermediate_filename,"r")
+        file.readline() # header
+        for line in file:
+            items = line.split(",",2)
+            contigs.append(items[0].strip())
+            locations.append(long(items[1]))
+        file.close()
+
+    return site_key_utils.create_site_key_set(site_key_utils.calculate_site_keys(species_name, contigs, locations))
+
 
 if __name__=='__main__':
 
@@ -128,12 +128,10 @@ if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="Loads only a subset of SNPs for speed", action="store_true")
-    parser.add_argument("--chunk-size", type=int, help="max number of records to load", default=1000000000)
     parser.add_argument("species", help="Name of specific species to run code on")
     args = parser.parse_args()
 
     debug = args.debug
-    chunk_size = args.chunk_size
     species_name=args.species
     good_species_list = [species_name]
     
@@ -169,107 +167,30 @@ if __name__=='__main__':
         sys.stderr.write("Done! %d core genes and %d shared genes and %d non-shared genes\n" % (len(core_genes), len(shared_pangenome_genes), len(non_shared_genes)))
 
 
-        # Analyze SNPs, looping over chunk sizes. 
-        # Clunky, but necessary to limit memory usage on cluster
-
         # Load SNP information for species_name
+        # (one gene at a time, to limit memory usage on cluster)
         sys.stderr.write("Loading SNPs for %s...\n" % species_name)
-        sys.stderr.write("(core genes only...)\n")
+        snp_samples, snp_genes = parse_midas_data.parse_snp_genes(species_name, debug=debug, allowed_samples=snp_samples, allowed_genes=non_shared_genes)
         
-        snp_doubleton_count_matrix = numpy.array([])
-        snp_difference_count_matrix = numpy.array([])         
-        snp_singleton_count_matrix = numpy.array([]) 
-        snp_singleton_opportunity_matrix = numpy.array([])
+        # Calculate fixation matrix
+        sys.stderr.write("Calculating matrix of singletons...\n")
+        matrix_functions = [(diversity_utils.calculate_singleton_matrix, {'allowed_genes': core_genes, 'allowed_variant_types': set(['4D'])}), # Synonymous (4D)
+                            (diversity_utils.calculate_singleton_matrix, {'allowed_genes': core_genes, 'allowed_variant_types': set(['1D'])}), # Nonsynonymous (1D)
+                            (diversity_utils.calculate_singleton_matrix, {'allowed_genes': core_genes}), # Core (all)
+                            (diversity_utils.calculate_singleton_matrix, {})] # All
         
-        syn_doubleton_count_matrix = numpy.array([])
-        syn_difference_count_matrix = numpy.array([])                 
-        syn_singleton_count_matrix = numpy.array([])
-        syn_singleton_opportunity_matrix = numpy.array([])
+        syn_matrices, non_matrices, core_matrices, snp_matrices = diversity_utils.calculate_matrices_from_snp_genes(snp_genes, matrix_functions)
         
-        non_doubleton_count_matrix = numpy.array([])
-        non_difference_count_matrix = numpy.array([])                 
-        non_singleton_count_matrix = numpy.array([])
-        non_singleton_opportunity_matrix = numpy.array([])
+        if snp_matrices is None:
+            sys.stderr.write("No SNPs!\n")
+            continue
         
-        core_doubleton_count_matrix = numpy.array([])
-        core_difference_count_matrix = numpy.array([])             
-        core_singleton_count_matrix = numpy.array([])
-        core_singleton_opportunity_matrix = numpy.array([])
-                
-        final_line_number = 0
-        while final_line_number >= 0:
-    
-            sys.stderr.write("Loading chunk starting @ %d...\n" % final_line_number)
-            dummy_samples, allele_counts_map, passed_sites_map, final_line_number = parse_midas_data.parse_snps(species_name, debug=debug, allowed_samples=snp_samples, chunk_size=chunk_size,initial_line_number=final_line_number, allowed_genes=non_shared_genes)
-            sys.stderr.write("Done! Loaded %d genes\n" % len(allele_counts_map.keys()))
-            
-            # Calculate fixation matrix
-            sys.stderr.write("Calculating matrix of singletons...\n")
-            # Synonymous (4D)
-            
-            chunk_syn_doubleton_count_matrix, chunk_syn_singleton_count_matrix, chunk_syn_difference_count_matrix, chunk_syn_singleton_opportunity_matrix = diversity_utils.calculate_singleton_matrix(allele_counts_map, passed_sites_map, allowed_genes=core_genes, allowed_variant_types=set(['4D']))
-            
-            # Nonsynonymous (1D) 
-            chunk_non_doubleton_count_matrix, chunk_non_singleton_count_matrix, chunk_non_difference_count_matrix, chunk_non_singleton_opportunity_matrix = diversity_utils.calculate_singleton_matrix(allele_counts_map, passed_sites_map, allowed_genes=core_genes, allowed_variant_types=set(['1D']))
-            
-            # Core (all)
-            chunk_core_doubleton_count_matrix, chunk_core_singleton_count_matrix, chunk_core_difference_count_matrix, chunk_core_singleton_opportunity_matrix = diversity_utils.calculate_singleton_matrix(allele_counts_map, passed_sites_map, allowed_genes=core_genes)
-            
-            # All
-            chunk_snp_doubleton_count_matrix, chunk_snp_singleton_count_matrix, chunk_snp_difference_count_matrix, chunk_snp_singleton_opportunity_matrix = diversity_utils.calculate_singleton_matrix(allele_counts_map, passed_sites_map)
-            
-            sys.stderr.write("Done!\n")
-    
-            if len(snp_singleton_count_matrix)==0:
-                snp_doubleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                snp_difference_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                snp_singleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                snp_singleton_opportunity_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                syn_doubleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                syn_difference_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                syn_singleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                syn_singleton_opportunity_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                non_doubleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                non_difference_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                non_singleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                non_singleton_opportunity_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                core_doubleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                core_difference_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-                core_singleton_count_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                core_singleton_opportunity_matrix = numpy.zeros_like(chunk_snp_singleton_count_matrix)*1.0
-                
-            # Add syn
-            syn_singleton_count_matrix += chunk_syn_singleton_count_matrix
-            syn_singleton_opportunity_matrix += chunk_syn_singleton_opportunity_matrix
-            syn_doubleton_count_matrix += chunk_syn_doubleton_count_matrix
-            syn_difference_count_matrix += chunk_syn_difference_count_matrix
-            
-            # Add non
-            non_singleton_count_matrix += chunk_non_singleton_count_matrix
-            non_singleton_opportunity_matrix += chunk_non_singleton_opportunity_matrix
-            non_doubleton_count_matrix += chunk_non_doubleton_count_matrix
-            non_difference_count_matrix += chunk_non_difference_count_matrix
-            
-            # Add core
-            core_singleton_count_matrix += chunk_core_singleton_count_matrix
-            core_singleton_opportunity_matrix += chunk_core_singleton_opportunity_matrix
-            core_doubleton_count_matrix += chunk_core_doubleton_count_matrix
-            core_difference_count_matrix += chunk_core_difference_count_matrix
-            
-            # Add all
-            snp_singleton_count_matrix += chunk_snp_singleton_count_matrix
-            snp_singleton_opportunity_matrix += chunk_snp_singleton_opportunity_matrix
-            snp_doubleton_count_matrix += chunk_snp_doubleton_count_matrix
-            snp_difference_count_matrix += chunk_snp_difference_count_matrix
-            
-            snp_samples = dummy_samples
+        syn_doubleton_count_matrix, syn_singleton_count_matrix, syn_difference_count_matrix, syn_singleton_opportunity_matrix = syn_matrices
+        non_doubleton_count_matrix, non_singleton_count_matrix, non_difference_count_matrix, non_singleton_opportunity_matrix = non_matrices
+        core_doubleton_count_matrix, core_singleton_count_matrix, core_difference_count_matrix, core_singleton_opportunity_matrix = core_matrices
+        snp_doubleton_count_matrix, snp_singleton_count_matrix, snp_difference_count_matrix, snp_singleton_opportunity_matrix = snp_matrices
+        
+        sys.stderr.write("Done!\n")
     
         # Add records to output
         for i in xrange(0,len(snp_samples)):
@@ -4,67 +4,241 @@ import bz2
 import gzip
 import config
 import os.path
+import site_key_utils
 
 
 intermediate_filename_template = config.data_directory+"snp_prevalences/%s.txt.gz"
     
+###############################################################################
+#
+# Site frequency tables
+#
+# Per-site frequencies (population freqs, snp prevalences, ...) are stored as
+# sorted arrays instead of dicts keyed by (contig, location) tuples:
+#
+# 'species_name' = species (whose contig dictionary is used for the keys)
+# 'keys' = sorted int64 array of site keys (see site_key_utils)
+# 'freqs' = float64 array of frequencies (same order as keys)
+#
+# and are looked up for many sites at once with lookup_site_freqs
+# (or lookup_site_freqs_by_key)
+#
+###############################################################################
+
+#############
+#
+# Creates a site freq table from lists of contigs, locations and freqs
+#
+# (if a site appears more than once, the last freq is kept, like a dict)
+#
+#############
+def create_site_freq_table(species_name, contigs, locations, freqs):
+
+    keys = site_key_utils.calculate_site_keys(species_name, contigs, locations)
+    freqs = numpy.asarray(freqs, dtype=numpy.float64)
+
+    # stable sort, so that duplicates stay in file order
+    sorted_idxs = numpy.argsort(keys, kind='mergesort')
+    keys = keys[sorted_idxs]
+    freqs = freqs[sorted_idxs]
+
+    # keep last copy of each site
+    last_copies = numpy.ones(len(keys), dtype=numpy.bool_)
+    last_copies[:-1] = (keys[1:]!=keys[:-1])
+
+    return {'species_name': species_name, 'keys': keys[last_copies], 'freqs': freqs[last_copies]}
+
+#############
+#
+# Returns array of freqs for sites with site keys
+# (default for sites that are not in the table)
+#
+#############
+def lookup_site_freqs_by_key(site_freq_table, keys, default=0):
+
+    table_idxs, found = site_key_utils.find_site_keys(site_freq_table['keys'], keys)
+
+    if len(site_freq_table['keys'])==0:
+        return numpy.ones(len(found))*default
+
+    return numpy.where(found, site_freq_table['freqs'][table_idxs], default)
+
+#############
+#
+# Returns array of freqs for sites at (contigs[i], locations[i])
+# (default for sites that are not in the table)
+#
+#############
+def lookup_site_freqs(site_freq_table, contigs, locations, default=0):
+
+    keys = site_key_utils.calculate_site_keys(site_freq_table['species_name'], contigs, locations, add_missing=False)
+    return lookup_site_freqs_by_key(site_freq_table, keys, default)
+
+#############
+#
+# Returns freq for a single site (default if not in table)
+#
+#############
+def lookup_site_freq_by_key(site_freq_table, key, default=0):
+
+    if key < 0 or len(site_freq_table['keys'])==0:
+        return default
+
+    table_idx = site_freq_table['keys'].searchsorted(key)
+    if table_idx < len(site_freq_table['keys']) and site_freq_table['keys'][table_idx]==key:
+        return float(site_freq_table['freqs'][table_idx])
+    else:
+        return default
+
+def lookup_site_freq(site_freq_table, contig, location, default=0):
+
+    key = site_key_utils.calculate_site_key(site_freq_table['species_name'], contig, location, add_missing=False)
+    return lookup_site_freq_by_key(site_freq_table, key, default)
+
+#############
+#
+# Converts a site freq table to a map from (contig,location) -> freq
+#
+#############
+def site_freq_table_to_map(site_freq_table):
+
+    contigs, locations = site_key_utils.decode_site_keys(site_freq_table['species_name'], site_freq_table['keys'])
+
+    return {(contig, long(location)): freq for contig, location, freq in zip(contigs, locations.tolist(), site_freq_table['freqs'].tolist())}
+
+###############################################################################
+#
+# Loads the snp_prevalences file for species
+#
+# returns site freq table of population freqs (sites where population_freq>0,
+# repolarized to the minor allele if polarize_by_consensus), and of snp freqs
+#
+###############################################################################
+def load_site_freq_tables(desired_species_name, polarize_by_consensus=False):
+
+    intermediate_filename = intermediate_filename_template % desired_species_name
+
+    contigs = []
+    locations = []
+    population_freqs = []
+    snp_freqs = []
+
+    if os.path.isfile(intermediate_filename):
+
+        file = gzip.GzipFile(intermediate_filename,"r")
+        file.readline()
+        for line in file:
+            items = line.split(",")
+            contigs.append(items[0])
+            locations.append(long(items[1]))
+            population_freqs.append(float(items[2]))
+            snp_freqs.append(float(items[3]))
+        file.close()
+
+    population_freqs = numpy.array(population_freqs)
+    if polarize_by_consensus:
+        population_freqs = numpy.where(population_freqs > 0.5, 1-population_freqs, population_freqs)
+
+    snp_freq_table = create_site_freq_table(desired_species_name, contigs, locations, snp_freqs)
+
+    polymorphic_idxs = numpy.nonzero(population_freqs!=0)[0]
+    population_freq_table = create_site_freq_table(desired_species_name, [contigs[idx] for idx in polymorphic_idxs], numpy.array(locations, dtype=numpy.int64)[polymorphic_idxs], population_freqs[polymorphic_idxs])
+
+    return population_freq_table, snp_freq_table
+
+def load_population_freq_table(desired_species_name, polarize_by_consensus=False):
+    return load_site_freq_tables(desired_species_name, polarize_by_consensus)[0]
+
+def load_snp_prevalence_table(desired_species_name):
+    return load_site_freq_tables(desired_species_name)[1]
+
 # Loading file
+# (map from (contig,location) -> snp freq, see load_snp_prevalence_table)
 def parse_snp_prevalences(desired_species_name):
+    return site_freq_table_to_map(load_snp_prevalence_table(desired_species_name))
+
+# Loading file
+# (map from (contig,location) -> population freq, see load_population_freq_table)
+def parse_population_freqs(desired_species_name, polarize_by_consensus=False):
+    return site_freq_table_to_map(load_population_freq_table(desired_species_name, polarize_by_consensus))
+
+###############################################################################
+#
+# Calculates prevalences of a site from alt and depth counts across samples
+#
+# returns population_prevalence, population_freq, snp_prevalence, snp_freq
+#
+###############################################################################
+def calculate_site_prevalences(alts, depths):
     
-    intermediate_filename = intermediate_filename_template % desired_species_name
-        
-    snp_prevalences = {}
-    
-    if not os.path.isfile(intermediate_filename):
-        return snp_prevalences
-    
-    file = gzip.GzipFile(intermediate_filename,"r")
-    file.readline()
-    for line in file:
-        items = line.split(",")
-        contig = items[0]
-        location = long(items[1])
-        population_freq = float(items[2])
-        snp_freq = float(items[3])
+    refs = depths-alts
+    
+    # First calculate fraction of cohort where alternate (non-reference) allele is the major allele
+    population_prevalence = ((alts>=refs)*(depths>0)).sum()
+    population_freq = population_prevalence*1.0/(depths>0).sum()
+    
+    if population_freq>0.5:
+        # alternate allele is in the majority
+        # re-polarize for now
+        alts,refs = refs,alts
         
-        snp_prevalences[(contig,location)] = snp_freq
-                            
-    file.close()
+    # Next calculate fraction of cohort where population minor allele is present at >=10% within-host frequency 
+    alt_threshold = numpy.ceil(depths*0.1)+0.5 #at least one read above 10%.
     
-    return snp_prevalences
+    snp_prevalence = ((alts>=alt_threshold)*(depths>0)).sum()
+    snp_freq = snp_prevalence*1.0/(depths>0).sum()
+    
+    return population_prevalence, population_freq, snp_prevalence, snp_freq
+
+# Returns the population freq of a site exactly as 
+# parse_population_freqs would load it from the intermediate file 
+# (0 if site is not recorded). Used to polarize sites in the same
+# pass that writes the file (see snp_scan_utils)
+def calculate_population_freq(contig, location, alts, depths):
+
+    population_prevalence, population_freq, snp_prevalence, snp_freq = calculate_site_prevalences(alts, depths)
     
+    if (population_prevalence==0) and (snp_prevalence==0):
+        return 0
     
-# Loading file
-def parse_population_freqs(desired_species_name, polarize_by_consensus=False):
+    return float("%g" % population_freq)
+
+###############################################################################
+#
+# Consumer for snp_scan_utils.scan_annotated_snps 
+# that writes the snp_prevalences file
+#
+###############################################################################
+def create_snp_prevalence_consumer(species_name):
     
-    intermediate_filename = intermediate_filename_template % desired_species_name
-      
-    population_freqs = {}
-    
-    if not os.path.isfile(intermediate_filename):
-        return population_freqs
-
-    file = gzip.GzipFile(intermediate_filename,"r")
-    file.readline()
-    for line in file:
-        items = line.split(",")
-        contig = items[0]
-        location = long(items[1])
-        population_freq = float(items[2])
-        snp_freq = float(items[3])
+    record_strs = ["Chromosome, Location, AltFreq, SNPFreq"]
+    
+    def start(samples):
+        sys.stderr.write("Calculating SNP prevalences...\n")
+    
+    def process_site(line_number, byte_offset, chromosome, location, gene_name, variant_type, polarization, pvalue, alts, depths):
+    
+        population_prevalence, population_freq, snp_prevalence, snp_freq = calculate_site_prevalences(alts, depths)
         
-        if polarize_by_consensus:
-            if population_freq > 0.5:
-                population_freq = 1-population_freq
+        if (population_prevalence==0) and (snp_prevalence==0):
+            return
         
-        if population_freq==0:
-            pass
-        else:
-            population_freqs[(contig,location)] = population_freq
-                            
-    file.close()
+        # otherwise record data    
+        record_str = "%s, %d, %g, %g" % (chromosome, location, population_freq, snp_freq)
+        record_strs.append(record_str)
+    
+    def finish():
+        # Holds panel wide prevalence for each species
+        os.system('mkdir -p %ssnp_prevalences' % config.data_directory)
+        
+        # Write to disk!
+        intermediate_filename = intermediate_filename_template % species_name
+        output_file = gzip.GzipFile(intermediate_filename,"w")
+        output_file.write("\n".join(record_strs))
+        output_file.close()
+        sys.stderr.write("Done writing SNP prevalences!\n")
     
-    return population_freqs
+    return {'start': start, 'process_site': process_site, 'finish': finish}
 
 if __name__=='__main__': 
     
@@ -85,80 +259,9 @@ if __name__=='__main__':
     chunk_size = args.chunk_size
     ################################################################################
 
-    # Holds panel wide prevalence for each species
-    os.system('mkdir -p %ssnp_prevalences' % config.data_directory)
-
-    # Open post-processed MIDAS output
-    snp_file =  bz2.BZ2File("%ssnps/%s/annotated_snps.txt.bz2" % (config.data_directory, species_name),"r")
+    import snp_scan_utils
     
-    line = snp_file.readline() # header
-    items = line.split()[1:]
-    samples = numpy.array([item.strip() for item in items])
-    
-    record_strs = ["Chromosome, Location, AltFreq, SNPFreq"]    
-    
-    sys.stderr.write("Calculating SNP prevalences...\n")        
-    num_sites_processed = 0
-    for line in snp_file:
-        
-        num_sites_processed+=1
-        #print num_sites_processed
-        if num_sites_processed%50000==0:
-            sys.stderr.write("%dk sites processed...\n" % (num_sites_processed/1000))   
-            if debug:
-                break
-        
-        items = line.split()
-        # Load information about site
-        info_items = items[0].split("|")
-        chromosome = info_items[0]
-        location = long(info_items[1])
-        gene_name = info_items[2]
-        
-        #    
-        # Load alt and depth counts
-        alts = []
-        depths = []
-        for item in items[1:]:
-            subitems = item.split(",")
-            alts.append(long(subitems[0]))
-            depths.append(long(subitems[1]))
-        alts = numpy.array(alts)
-        depths = numpy.array(depths)
-        refs = depths-alts
-    
-        # First calculate fraction of cohort where alternate (non-reference) allele is the major allele
-        population_prevalence = ((alts>=refs)*(depths>0)).sum()
-        population_freq = population_prevalence*1.0/(depths>0).sum()
-    
-        if population_freq>0.5:
-            # alternate allele is in the majority
-            # re-polarize for now
-            alts,refs = refs,alts
-            
-        # Next calculate fraction of cohort where population minor allele is present at >=10% within-host frequency 
-        alt_threshold = numpy.ceil(depths*0.1)+0.5 #at least one read above 10%.
-        
-        snp_prevalence = ((alts>=alt_threshold)*(depths>0)).sum()
-        snp_freq = snp_prevalence*1.0/(depths>0).sum()
-        
-        if (population_prevalence==0) and (snp_prevalence==0):
-            continue
-        
-        # otherwise record data    
-        record_str = "%s, %d, %g, %g" % (chromosome, location, population_freq, snp_freq) 
-        
-        record_strs.append(record_str)
-        
-    
-    snp_file.close()
+    # (snp_scan_utils.py runs this together with the other 
+    #  consumers of annotated_snps in a single pass)
+    snp_scan_utils.scan_annotated_snps(species_name, [create_snp_prevalence_consumer(species_name)], debug=debug)
     sys.stderr.write("Done!\n")
-
-    # Write to disk!
-    intermediate_filename = intermediate_filename_template % species_name
-    output_file = gzip.GzipFile(intermediate_filename,"w")
-    output_file.write("\n".join(record_strs))
-    output_file.close()
-
-
-
@@ -1,4 +1,5 @@
 import sample_utils 
+import sample_id_utils
 import config
 import parse_midas_data
 import os.path
@@ -14,6 +15,7 @@ from math import log10,ceil
 from numpy.random import randint
 
 import core_gene_utils
+from snp_store_utils import calculate_source_stamp
 import gzip
 import os
 
@@ -23,15 +25,17 @@ intermediate_filename_template = '%s%s.txt.gz'
 min_coverage = config.min_median_coverage
 min_sample_size = 10
 
-def load_substitution_rate_map(species_name):
-# This definition is called whenever another script downstream uses the output of this data.
+binary_filename_template = '%s%s.npz'
+
+# order of matrices for each type in binary file
+substitution_rate_matrix_names = ['Num_muts', 'Num_revs', 'Num_mut_opportunities', 'Num_rev_opportunities']
+
+def parse_substitution_rate_file(species_name):
+# Parses text intermediate file into map from type -> sample pair -> (num_muts, num_revs, num_mut_opportunities, num_rev_opportunities)
 
     intermediate_filename = intermediate_filename_template % (substitution_rate_directory, species_name)
 
     substitution_rate_map = {}
-
-    if not os.path.isfile(intermediate_filename):
-        return substitution_rate_map
     
     file = gzip.open(intermediate_filename,"r")
     file.readline() # header
@@ -40,8 +44,6 @@ def load_substitution_rate_map(species_name):
         if items[0].strip()!=species_name:
             continue
             
-        record_strs = [", ".join(['Species', 'Sample1', 'Sample2', 'Type', 'Num_muts', 'Num_revs', 'Num_mut_opportunities', 'Num_rev_opportunities'])]    
-            
         sample_1 = items[1].strip()
         sample_2 = items[2].strip()
         type = items[3].strip()
@@ -50,15 +52,91 @@ def load_substitution_rate_map(species_name):
         num_mut_opportunities = float(items[6])
         num_rev_opportunities = float(items[7])
         
-        num_changes = num_muts+num_revs
-        num_opportunities = num_mut_opportunities+num_rev_opportunities
-        
         sample_pair = (sample_1, sample_2)
         
         if type not in substitution_rate_map:
             substitution_rate_map[type] = {}
           
         substitution_rate_map[type][sample_pair] = (num_muts, num_revs, num_mut_opportunities, num_rev_opportunities)
+    
+    file.close()
+        
+    return substitution_rate_map
+
+def write_substitution_rate_matrices(species_name):
+# Converts the text intermediate file to a compressed binary file 
+# (samples + stacked mut/rev/opportunity matrices for each type) 
+# that can be loaded directly into matrices
+#
+# returns the loaded matrices (see load_substitution_rate_map)
+
+    intermediate_filename = intermediate_filename_template % (substitution_rate_directory, species_name)
+    binary_filename = binary_filename_template % (substitution_rate_directory, species_name)
+
+    source_stamp = calculate_source_stamp(intermediate_filename)
+    text_substitution_rate_map = parse_substitution_rate_file(species_name)
+    
+    sample_set = set([])
+    for type in text_substitution_rate_map.keys():
+        for sample_1, sample_2 in text_substitution_rate_map[type].keys():
+            sample_set.add(sample_1)
+            sample_set.add(sample_2)
+    samples = list(sorted(sample_set))
+    sample_idx_map = {samples[i]:i for i in xrange(0,len(samples))}
+    
+    types = list(sorted(text_substitution_rate_map.keys()))
+    
+    # type x matrix x sample x sample
+    matrices = numpy.zeros((len(types), len(substitution_rate_matrix_names), len(samples), len(samples)))
+    # type x sample x sample (whether pair was recorded)
+    recorded_pairs = numpy.zeros((len(types), len(samples), len(samples)), dtype=numpy.bool_)
+    
+    for type_idx in xrange(0,len(types)):
+        for (sample_1, sample_2), values in text_substitution_rate_map[types[type_idx]].iteritems():
+            i = sample_idx_map[sample_1]
+            j = sample_idx_map[sample_2]
+            matrices[type_idx,:,i,j] = values
+            recorded_pairs[type_idx,i,j] = True
+    
+    try:
+        numpy.savez_compressed(binary_filename, samples=numpy.array(samples), types=numpy.array(types), matrices=matrices, recorded_pairs=recorded_pairs, source_stamp=numpy.array(source_stamp))
+    except (IOError, OSError):
+        sys.stderr.write("Warning: could not write %s\n" % binary_filename)
+    
+    return samples, types, matrices, recorded_pairs
+
+def load_substitution_rate_map(species_name):
+# This definition is called whenever another script downstream uses the output of this data.
+#
+# returns map from type -> {'samples': list of samples, 
+#                           'matrices': stacked mut/rev/opportunity matrices (see substitution_rate_matrix_names), 
+#                           'recorded_pairs': boolean sample x sample matrix of recorded pairs}
+#
+# Loaded from the binary version of the intermediate file (which is created
+# the first time if it doesn't exist or the text file has changed)
+
+    intermediate_filename = intermediate_filename_template % (substitution_rate_directory, species_name)
+    binary_filename = binary_filename_template % (substitution_rate_directory, species_name)
+
+    substitution_rate_map = {}
+
+    samples = None
+    if os.path.isfile(binary_filename):
+        binary_file = numpy.load(binary_filename)
+        if (not os.path.isfile(intermediate_filename)) or str(binary_file['source_stamp'])==calculate_source_stamp(intermediate_filename):
+            samples = list(binary_file['samples'])
+            types = list(binary_file['types'])
+            matrices = binary_file['matrices']
+            recorded_pairs = binary_file['recorded_pairs']
+        binary_file.close()
+
+    if samples is None:
+        if not os.path.isfile(intermediate_filename):
+            return substitution_rate_map
+        samples, types, matrices, recorded_pairs = write_substitution_rate_matrices(species_name)
+
+    for type_idx in xrange(0,len(types)):
+        substitution_rate_map[types[type_idx]] = {'samples': samples, 'matrices': matrices[type_idx], 'recorded_pairs': recorded_pairs[type_idx]}
         
     return substitution_rate_map
 
@@ -66,41 +144,26 @@ def calculate_mutrev_matrices_from_substitution_rate_map(substitution_rate_map,
     # Rewritten to preserve order of allowed samples
     # If allowed samples contains things that are not in DB, it returns zero opportunities
 
-    total_sample_set = set([])
-    for sample_1, sample_2 in substitution_rate_map[type].keys():
-        total_sample_set.add(sample_1)
-        total_sample_set.add(sample_2)
-
+    samples = substitution_rate_map[type]['samples']
+    recorded_pairs = substitution_rate_map[type]['recorded_pairs']
+    
     if len(allowed_samples)==0:
-        allowed_samples = list(sorted(total_sample_set))    
+        # samples that are part of a recorded pair
+        recorded_samples = numpy.logical_or(recorded_pairs.any(axis=0), recorded_pairs.any(axis=1))
+        allowed_samples = [samples[i] for i in numpy.nonzero(recorded_samples)[0]]
         
     # allows us to go from sample name to idx in allowed samples (to preserve order)
     sample_idx_map = {allowed_samples[i]:i for i in xrange(0,len(allowed_samples))}
+    db_sample_idx_map = {samples[i]:i for i in xrange(0,len(samples))}
     
-    mut_difference_matrix = numpy.zeros((len(allowed_samples), len(allowed_samples)))*1.0
-    rev_difference_matrix = numpy.zeros_like(mut_difference_matrix)
+    # (if a sample is repeated, only the last copy is filled in)
+    target_idxs = numpy.array([i for i in xrange(0,len(allowed_samples)) if (allowed_samples[i] in db_sample_idx_map) and (sample_idx_map[allowed_samples[i]]==i)], dtype=numpy.int64)
+    source_idxs = numpy.array([db_sample_idx_map[allowed_samples[i]] for i in target_idxs], dtype=numpy.int64)
     
-    mut_opportunity_matrix = numpy.zeros_like(mut_difference_matrix)
-    rev_opportunity_matrix = numpy.zeros_like(mut_difference_matrix)
+    matrices = numpy.zeros((len(substitution_rate_matrix_names), len(allowed_samples), len(allowed_samples)))*1.0
+    matrices[:, target_idxs[:,None], target_idxs[None,:]] = substitution_rate_map[type]['matrices'][:, source_idxs[:,None], source_idxs[None,:]]
     
-    for sample_pair in substitution_rate_map[type].keys():
-        
-        sample_i = sample_pair[0]
-        sample_j = sample_pair[1]
-        
-        if not ((sample_i in sample_idx_map) and (sample_j in sample_idx_map)):
-            continue
-        
-        i = sample_idx_map[sample_i]
-        j = sample_idx_map[sample_j]
-        
-        num_muts, num_revs, num_mut_opportunities, num_rev_opportunities = substitution_rate_map[type][sample_pair]
-        
-        mut_difference_matrix[i,j] = num_muts
-        rev_difference_matrix[i,j] = num_revs
-        
-        mut_opportunity_matrix[i,j] = num_mut_opportunities
-        rev_opportunity_matrix[i,j] = num_rev_opportunities
+    mut_difference_matrix, rev_difference_matrix, mut_opportunity_matrix, rev_opportunity_matrix = matrices
         
     return allowed_samples, mut_difference_matrix, rev_difference_matrix, mut_opportunity_matrix, rev_opportunity_matrix
 
@@ -124,12 +187,10 @@ if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="Loads only a subset of SNPs for speed", action="store_true")
-    parser.add_argument("--chunk-size", type=int, help="max number of records to load", default=1000000000)
     parser.add_argument("species", help="Name of specific species to run code on")
     args = parser.parse_args()
 
     debug = args.debug
-    chunk_size = args.chunk_size
     species_name=args.species
     good_species_list = [species_name]
 
@@ -164,105 +225,36 @@ if __name__=='__main__':
         sys.stderr.write("%d shared genes and %d non-shared genes\n" % (len(shared_pangenome_genes), len(non_shared_genes)))
 
         
-        # Analyze SNPs, looping over chunk sizes. 
-        # Clunky, but necessary to limit memory usage on cluster
-
+        # (name, allowed genes, allowed variant types) for each type of record
+        site_classes = [('4D', core_genes, set(['4D'])), ('1D', core_genes, set(['1D'])), ('core', core_genes, set([])), ('all', non_shared_genes, set([]))]
+        
         # Load SNP information for species_name
+        # (one gene at a time, to limit memory usage on cluster)
         sys.stderr.write("Loading SNPs for %s...\n" % species_name)
-        sys.stderr.write("(core genes only...)\n")
-        pi_matrix_syn = numpy.array([])
-        avg_pi_matrix_syn = numpy.array([])
-
-        syn_mut_difference_matrix = numpy.array([]) # 4d sites in core genes
-        syn_mut_opportunity_matrix = numpy.array([])
-        syn_rev_difference_matrix = numpy.array([]) # 4d sites in core genes
-        syn_rev_opportunity_matrix = numpy.array([])
-    
-        non_mut_difference_matrix = numpy.array([]) # 1d sites in core genes
-        non_mut_opportunity_matrix = numpy.array([])
-        non_rev_difference_matrix = numpy.array([]) # 1d sites in core genes
-        non_rev_opportunity_matrix = numpy.array([])
-    
-        core_mut_difference_matrix = numpy.array([]) # all sites in core genes
-        core_mut_opportunity_matrix = numpy.array([])
-        core_rev_difference_matrix = numpy.array([]) # all sites in core genes
-        core_rev_opportunity_matrix = numpy.array([])
-    
-        snp_mut_difference_matrix = numpy.array([]) # all sites in all genes
-        snp_mut_opportunity_matrix = numpy.array([])
-        snp_rev_difference_matrix = numpy.array([]) # all sites in all genes
-        snp_rev_opportunity_matrix = numpy.array([])
-    
-        final_line_number = 0
-        while final_line_number >= 0:
-    
-            sys.stderr.write("Loading chunk starting @ %d...\n" % final_line_number)
-            dummy_samples, allele_counts_map, passed_sites_map, final_line_number = parse_midas_data.parse_snps(species_name, debug=debug, allowed_samples=snp_samples, chunk_size=chunk_size,allowed_genes=non_shared_genes, initial_line_number=final_line_number)
-            sys.stderr.write("Done! Loaded %d genes\n" % len(allele_counts_map.keys()))
-            
-            # Calculate fixation matrix
-            sys.stderr.write("Calculating matrix of snp differences...\n")
-            # Synonymous (4D)
-            
-            chunk_syn_mut_difference_matrix, chunk_syn_rev_difference_matrix, chunk_syn_mut_opportunity_matrix, chunk_syn_rev_opportunity_matrix = diversity_utils.calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_genes=core_genes, allowed_variant_types=set(['4D']))
-            
-            # Nonsynonymous (1D) 
-            chunk_non_mut_difference_matrix, chunk_non_rev_difference_matrix, chunk_non_mut_opportunity_matrix, chunk_non_rev_opportunity_matrix = diversity_utils.calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_genes=core_genes, allowed_variant_types=set(['1D']))
-            
-            # Core (all)
-            chunk_core_mut_difference_matrix, chunk_core_rev_difference_matrix, chunk_core_mut_opportunity_matrix, chunk_core_rev_opportunity_matrix = diversity_utils.calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_genes=core_genes)
-            
-            # All
-            chunk_snp_mut_difference_matrix, chunk_snp_rev_difference_matrix, chunk_snp_mut_opportunity_matrix, chunk_snp_rev_opportunity_matrix = diversity_utils.calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_genes=non_shared_genes)
-            
-            sys.stderr.write("Done!\n")
-    
-            if snp_mut_difference_matrix.shape[0]==0:
-                snp_mut_difference_matrix = numpy.zeros_like(chunk_snp_mut_difference_matrix)*1.0
-                snp_mut_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                snp_rev_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                snp_rev_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                
-                syn_mut_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                syn_mut_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                syn_rev_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                syn_rev_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                
-                non_mut_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                non_mut_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                non_rev_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                non_rev_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                
-                core_mut_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                core_mut_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                core_rev_difference_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                core_rev_opportunity_matrix = numpy.zeros_like(snp_mut_difference_matrix)*1.0
-                
-            # Add syn
-            syn_mut_difference_matrix += chunk_syn_mut_difference_matrix
-            syn_mut_opportunity_matrix += chunk_syn_mut_opportunity_matrix
-            syn_rev_difference_matrix += chunk_syn_rev_difference_matrix
-            syn_rev_opportunity_matrix += chunk_syn_rev_opportunity_matrix
-
-            # Add non
-            non_mut_difference_matrix += chunk_non_mut_difference_matrix
-            non_mut_opportunity_matrix += chunk_non_mut_opportunity_matrix
-            non_rev_difference_matrix += chunk_non_rev_difference_matrix
-            non_rev_opportunity_matrix += chunk_non_rev_opportunity_matrix
-
-            # Add core
-            core_mut_difference_matrix += chunk_core_mut_difference_matrix
-            core_mut_opportunity_matrix += chunk_core_mut_opportunity_matrix
-            core_rev_difference_matrix += chunk_core_rev_difference_matrix
-            core_rev_opportunity_matrix += chunk_core_rev_opportunity_matrix
-
-            # Add all
-            snp_mut_difference_matrix += chunk_snp_mut_difference_matrix
-            snp_mut_opportunity_matrix += chunk_snp_mut_opportunity_matrix
-            snp_rev_difference_matrix += chunk_snp_rev_difference_matrix
-            snp_rev_opportunity_matrix += chunk_snp_rev_opportunity_matrix
-            
-            snp_samples = dummy_samples
+        snp_samples, snp_genes = parse_midas_data.parse_snp_genes(species_name, debug=debug, allowed_samples=snp_samples, allowed_genes=non_shared_genes)
+        
+        # Calculate fixation matrix
+        sys.stderr.write("Calculating matrix of snp differences...\n")
+        # (all four classes in one pass over the genes)
+        matrix_map = diversity_utils.calculate_matrices_from_snp_genes(snp_genes, [(diversity_utils.calculate_mutation_reversion_matrices, {'site_classes': site_classes})])[0]
+        
+        if matrix_map is None:
+            sys.stderr.write("No SNPs!\n")
+            continue
+        
+        # Synonymous (4D)
+        syn_mut_difference_matrix, syn_rev_difference_matrix, syn_mut_opportunity_matrix, syn_rev_opportunity_matrix = matrix_map['4D']
+        
+        # Nonsynonymous (1D) 
+        non_mut_difference_matrix, non_rev_difference_matrix, non_mut_opportunity_matrix, non_rev_opportunity_matrix = matrix_map['1D']
+        
+        # Core (all)
+        core_mut_difference_matrix, core_rev_difference_matrix, core_mut_opportunity_matrix, core_rev_opportunity_matrix = matrix_map['core']
+        
+        # All
+        snp_mut_difference_matrix, snp_rev_difference_matrix, snp_mut_opportunity_matrix, snp_rev_opportunity_matrix = matrix_map['all']
+        
+        sys.stderr.write("Done!\n")
     
     
         # Now calculate gene differences
@@ -271,8 +263,8 @@ if __name__=='__main__':
         gene_samples, gene_names, gene_presence_matrix, gene_depth_matrix, marker_coverages,     gene_reads_matrix = parse_midas_data.parse_pangenome_data(species_name,allowed_samples=snp_samples, disallowed_genes=shared_pangenome_genes)
         sys.stderr.write("Done! Loaded %d genes\n" % len(gene_names))
 
-        gene_sample_list = list(gene_samples)
-        gene_sample_set = set(gene_samples)
+        # idx of each snp sample in gene_samples (-1 if missing)
+        snp_gene_sample_idxs = sample_id_utils.calculate_sample_idxs(snp_samples, gene_samples)
         
         # Calculate matrix of number of genes that differ
         sys.stderr.write("Calculating matrix of gene differences...\n")
@@ -312,9 +304,10 @@ if __name__=='__main__':
                     record_str_items = [species_name, sample_i, sample_j, 'all', str(snp_mut_difference_matrix[i,j]), str(snp_rev_difference_matrix[i,j]),  str(snp_mut_opportunity_matrix[i,j]), str(snp_rev_opportunity_matrix[i,j])]
                     record_strs.append( ", ".join(record_str_items) )
         
-                    if (sample_i in gene_sample_set) and (sample_j in gene_sample_set):
-                        gene_i = gene_sample_list.index(sample_i)
-                        gene_j = gene_sample_list.index(sample_j)
+                    gene_i = snp_gene_sample_idxs[i]
+                    gene_j = snp_gene_sample_idxs[j]
+                    
+                    if (gene_i >= 0) and (gene_j >= 0):
             
                         record_str_items = [species_name, sample_i, sample_j, 'genes', str(gene_loss_matrix[gene_i, gene_j]), str(gene_gain_matrix[gene_i, gene_j]), str(gene_opportunity_matrix[gene_i, gene_j]), '0']
                     else:
@@ -332,6 +325,7 @@ if __name__=='__main__':
         record_str = "\n".join(record_strs)
         file.write(record_str)
         file.close()
+        write_substitution_rate_matrices(species_name)
         sys.stderr.write("Done!\n")
 
  
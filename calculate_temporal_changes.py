@@ -15,6 +15,7 @@ import gene_diversity_utils
 import core_gene_utils
 import gzip
 import os
+from snp_store_utils import calculate_source_stamp, read_cache_stamp, write_cache_directory, write_string_list, read_string_list
 
 temporal_change_directory = '%stemporal_changes/' % (parse_midas_data.data_directory)
 intermediate_filename_template = '%s%s.txt.gz'  
@@ -26,7 +27,11 @@ import stats_utils
 from math import log10,ceil
 from numpy.random import randint
 
-def load_temporal_change_map(species_name):
+def parse_temporal_change_file(species_name):
+# Parses the text intermediate file
+#
+# returns map from sample pair -> type -> (num_opportunities, perr, changes)
+
     
     intermediate_filename = intermediate_filename_template % (temporal_change_directory, species_name)
 
@@ -95,104 +100,368 @@ def load_temporal_change_map(species_name):
                     
         temporal_change_map[sample_pair][type] = num_opportunities, perr, changes
     
+    file.close()
     return temporal_change_map
 
-def calculate_private_reversions_from_temporal_change_map(temporal_change_map, sample_1, sample_2, lower_threshold=config.consensus_lower_threshold, 
-upper_threshold=config.consensus_upper_threshold):
-    
+###############################################################################
+#
+# Binary version of the intermediate file
+#
+# Changes are stored as typed columns, with one table for snp changes
+# (types 'snps' and 'private_snps') and one for gene changes. Each
+# (sample pair, type) record points to a contiguous range of rows in one
+# of the tables. The columns are uncompressed .npy files that are
+# memory-mapped when loaded, so the changes of a single pair can be read
+# without touching the others:
+#
+# 'samples' = sorted list of samples
+# 'pair_samples' = (pairs x 2) matrix of sample idxs
+# 'types' = list of types
+# 'record_idxs' = (pairs x types) matrix of record idxs (-1 if not recorded)
+# 'record_opportunities', 'record_perrs' = L and Perr of each record
+# 'record_starts', 'record_ends' = range of rows of each record's changes
+# 'names' = list of gene names, contigs, and variant types
+# 'snp_gene_idxs', 'snp_contig_idxs', 'snp_variant_type_idxs' = idxs in names
+# 'snp_positions' = positions of snp changes
+# 'snp_counts' = (snp changes x 4) matrix of A1, D1, A2, D2
+# 'gene_name_idxs' = idxs of gene change names in names
+# 'gene_coverages' = (gene changes x 4) matrix of D1, Dm1, D2, Dm2
+#
+###############################################################################
+binary_directory_template = '%s%s_store/'
+
+string_list_keys = ['samples', 'types', 'names']
+array_keys = ['pair_samples', 'record_idxs', 'record_opportunities', 'record_perrs', 'record_starts', 'record_ends', 'snp_gene_idxs', 'snp_contig_idxs', 'snp_positions', 'snp_variant_type_idxs', 'snp_counts', 'gene_name_idxs', 'gene_coverages']
+
+snp_change_types = set(['snps','private_snps'])
+
+def write_temporal_change_store(species_name):
+# Converts the text intermediate file to the binary store
+#
+# returns the (in memory) store (see load_temporal_change_map)
+
+    intermediate_filename = intermediate_filename_template % (temporal_change_directory, species_name)
+    binary_directory = binary_directory_template % (temporal_change_directory, species_name)
+
+    source_stamp = calculate_source_stamp(intermediate_filename)
+    text_temporal_change_map = parse_temporal_change_file(species_name)
+
+    sample_pairs = list(sorted(text_temporal_change_map.keys()))
+    samples = list(sorted(set([sample for sample_pair in sample_pairs for sample in sample_pair])))
+    sample_idx_map = {samples[i]:i for i in xrange(0,len(samples))}
+
+    types = list(sorted(set([type for sample_pair in sample_pairs for type in text_temporal_change_map[sample_pair].keys()])))
+
+    names = []
+    name_idx_map = {}
+    def get_name_idx(name):
+        if name not in name_idx_map:
+            name_idx_map[name] = len(names)
+            names.append(name)
+        return name_idx_map[name]
+
+    record_idxs = numpy.ones((len(sample_pairs), len(types)), dtype=numpy.int64)*-1
+    record_opportunities = []
+    record_perrs = []
+    record_starts = []
+    record_ends = []
+
+    snp_changes = []
+    gene_changes = []
+
+    for pair_idx in xrange(0,len(sample_pairs)):
+        for type_idx in xrange(0,len(types)):
+
+            if types[type_idx] not in text_temporal_change_map[sample_pairs[pair_idx]]:
+                continue
+
+            num_opportunities, perr, changes = text_temporal_change_map[sample_pairs[pair_idx]][types[type_idx]]
+
+            record_idxs[pair_idx, type_idx] = len(record_opportunities)
+            record_opportunities.append(num_opportunities)
+            record_perrs.append(perr)
+
+            if types[type_idx] in snp_change_types:
+                record_starts.append(len(snp_changes))
+                snp_changes.extend([(get_name_idx(gene_name), get_name_idx(contig), position, get_name_idx(variant_type), A1, D1, A2, D2) for gene_name, contig, position, variant_type, A1, D1, A2, D2 in changes])
+                record_ends.append(len(snp_changes))
+            elif types[type_idx]=='genes':
+                record_starts.append(len(gene_changes))
+                gene_changes.extend([(get_name_idx(gene_name), D1, Dm1, D2, Dm2) for gene_name, D1, Dm1, D2, Dm2 in changes])
+                record_ends.append(len(gene_changes))
+            else:
+                # (unknown types have no changes)
+                record_starts.append(0)
+                record_ends.append(0)
+
+    snp_changes = numpy.array(snp_changes, dtype=numpy.float64).reshape((len(snp_changes),8))
+    gene_changes = numpy.array(gene_changes, dtype=numpy.float64).reshape((len(gene_changes),5))
+
+    temporal_change_store = {}
+    temporal_change_store['samples'] = samples
+    temporal_change_store['pair_samples'] = numpy.array([[sample_idx_map[sample_1], sample_idx_map[sample_2]] for sample_1, sample_2 in sample_pairs], dtype=numpy.int64).reshape((len(sample_pairs),2))
+    temporal_change_store['types'] = types
+    temporal_change_store['record_idxs'] = record_idxs
+    temporal_change_store['record_opportunities'] = numpy.array(record_opportunities, dtype=numpy.float64)
+    temporal_change_store['record_perrs'] = numpy.array(record_perrs, dtype=numpy.float64)
+    temporal_change_store['record_starts'] = numpy.array(record_starts, dtype=numpy.int64)
+    temporal_change_store['record_ends'] = numpy.array(record_ends, dtype=numpy.int64)
+    temporal_change_store['names'] = names
+    temporal_change_store['snp_gene_idxs'] = snp_changes[:,0].astype(numpy.int64)
+    temporal_change_store['snp_contig_idxs'] = snp_changes[:,1].astype(numpy.int64)
+    temporal_change_store['snp_positions'] = snp_changes[:,2].astype(numpy.int64)
+    temporal_change_store['snp_variant_type_idxs'] = snp_changes[:,3].astype(numpy.int64)
+    temporal_change_store['snp_counts'] = numpy.ascontiguousarray(snp_changes[:,4:8])
+    temporal_change_store['gene_name_idxs'] = gene_changes[:,0].astype(numpy.int64)
+    temporal_change_store['gene_coverages'] = numpy.ascontiguousarray(gene_changes[:,1:5])
+
+    def write_binary_store(directory):
+        for key in string_list_keys:
+            write_string_list(directory+key+".txt", temporal_change_store[key])
+        for key in array_keys:
+            numpy.save(directory+key+".npy", temporal_change_store[key])
+
+    write_cache_directory(binary_directory, source_stamp, write_binary_store)
+
+    return temporal_change_store
+
+def load_temporal_change_map(species_name):
+# This definition is called whenever another script downstream uses the output of this data.
+#
+# returns the temporal change store (see above), from the binary version of
+# the intermediate file (which is created the first time if it doesn't exist
+# or the text file has changed). Use get_temporal_changes to get the changes
+# of a sample pair.
+
+    intermediate_filename = intermediate_filename_template % (temporal_change_directory, species_name)
+    binary_directory = binary_directory_template % (temporal_change_directory, species_name)
+
+    store_stamp = read_cache_stamp(binary_directory)
+
+    if store_stamp is not None and ((not os.path.isfile(intermediate_filename)) or store_stamp==calculate_source_stamp(intermediate_filename)):
+        temporal_change_store = {}
+        for key in string_list_keys:
+            temporal_change_store[key] = read_string_list(binary_directory+key+".txt")
+        for key in array_keys:
+            temporal_change_store[key] = numpy.load(binary_directory+key+".npy", mmap_mode='r')
+    elif os.path.isfile(intermediate_filename):
+        temporal_change_store = write_temporal_change_store(species_name)
+    else:
+        return {}
+
+    samples = temporal_change_store['samples']
+    pair_samples = numpy.asarray(temporal_change_store['pair_samples'])
+    temporal_change_store['pair_idx_map'] = {(samples[pair_samples[pair_idx,0]], samples[pair_samples[pair_idx,1]]): pair_idx for pair_idx in xrange(0,len(pair_samples))}
+    temporal_change_store['type_idx_map'] = {type: type_idx for type_idx, type in enumerate(temporal_change_store['types'])}
+
+    return temporal_change_store
+
+def get_temporal_change_record_idx(temporal_change_map, sample_1, sample_2, type):
+# returns idx of record for sample pair and type (-1 if not recorded)
+
+    if len(temporal_change_map)==0:
+        return -1
+
     sample_pair = sample_1, sample_2
-    if sample_pair not in temporal_change_map:
-        return -1, None, None
-        
-    if 'private_snps' not in temporal_change_map[sample_pair]:
+    if sample_pair not in temporal_change_map['pair_idx_map']:
+        return -1
+
+    if type not in temporal_change_map['type_idx_map']:
+        return -1
+
+    return temporal_change_map['record_idxs'][temporal_change_map['pair_idx_map'][sample_pair], temporal_change_map['type_idx_map'][type]]
+
+def get_record_rows(temporal_change_map, record_idx):
+# returns slice of rows of the record's changes
+# (slicing only reads these rows of the memory-mapped columns)
+
+    return slice(temporal_change_map['record_starts'][record_idx], temporal_change_map['record_ends'][record_idx])
+
+def get_snp_change_tuples(temporal_change_map, row_idxs):
+# returns list of (gene_name, contig, position, variant_type, A1, D1, A2, D2)
+
+    names = temporal_change_map['names']
+    return [(names[gene_idx], names[contig_idx], long(position), names[variant_type_idx], A1, D1, A2, D2) for gene_idx, contig_idx, position, variant_type_idx, (A1, D1, A2, D2) in zip(temporal_change_map['snp_gene_idxs'][row_idxs], temporal_change_map['snp_contig_idxs'][row_idxs], temporal_change_map['snp_positions'][row_idxs], temporal_change_map['snp_variant_type_idxs'][row_idxs], temporal_change_map['snp_counts'][row_idxs].tolist())]
+
+def get_gene_change_tuples(temporal_change_map, row_idxs):
+# returns list of (gene_name, D1, Dm1, D2, Dm2)
+
+    names = temporal_change_map['names']
+    return [(names[gene_idx], D1, Dm1, D2, Dm2) for gene_idx, (D1, Dm1, D2, Dm2) in zip(temporal_change_map['gene_name_idxs'][row_idxs], temporal_change_map['gene_coverages'][row_idxs].tolist())]
+
+def get_temporal_changes(temporal_change_map, sample_1, sample_2, type):
+# returns num_opportunities, perr, list of changes for sample pair and type
+# (same as the text file), or None if not recorded
+
+    record_idx = get_temporal_change_record_idx(temporal_change_map, sample_1, sample_2, type)
+    if record_idx < 0:
+        return None
+
+    rows = get_record_rows(temporal_change_map, record_idx)
+
+    if type in snp_change_types:
+        changes = get_snp_change_tuples(temporal_change_map, rows)
+    elif type=='genes':
+        changes = get_gene_change_tuples(temporal_change_map, rows)
+    else:
+        changes = []
+
+    return float(temporal_change_map['record_opportunities'][record_idx]), float(temporal_change_map['record_perrs'][record_idx]), changes
+
+def calculate_private_reversions_from_temporal_change_map(temporal_change_map, sample_1, sample_2, lower_threshold=config.consensus_lower_threshold,
+upper_threshold=config.consensus_upper_threshold):
+
+    record_idx = get_temporal_change_record_idx(temporal_change_map, sample_1, sample_2, 'private_snps')
+    if record_idx < 0:
         return -1, None, None
-        
-    # otherwise, some hope! 
-    
-    private_snp_opportunities, private_snp_perr, private_snps = temporal_change_map[sample_pair]['private_snps']
-    
-    mutations = []
-    private_snp_reversions = []
-    for snp_change in private_snps:
-    
-        a,b,c,d,A1,D1,A2,D2 = snp_change
-        
-        if D1==0 or D2==0:
-            private_snp_opportunities-=1
-            continue
-        
-        f1 = A1*1.0/D1
-        f2 = A2*1.0/D2
-        
-        if f1>=upper_threshold and f2<=lower_threshold:
-            private_snp_reversions.append(snp_change)
-        if f1<=upper_threshold and f2>=upper_threshold:
-            mutations.append(snp_change)        
-    
+
+    # otherwise, some hope!
+
+    private_snp_opportunities = float(temporal_change_map['record_opportunities'][record_idx])
+    private_snp_perr = float(temporal_change_map['record_perrs'][record_idx])
+
+    rows = get_record_rows(temporal_change_map, record_idx)
+    A1s, D1s, A2s, D2s = temporal_change_map['snp_counts'][rows].T
+
+    zero_depths = (D1s==0)+(D2s==0)
+    private_snp_opportunities -= zero_depths.sum()
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        f1s = A1s*1.0/D1s
+        f2s = A2s*1.0/D2s
+
+        is_reversion = numpy.logical_not(zero_depths)*(f1s>=upper_threshold)*(f2s<=lower_threshold)
+
+    private_snp_reversions = get_snp_change_tuples(temporal_change_map, rows.start+numpy.nonzero(is_reversion)[0])
+
     return private_snp_opportunities, private_snp_perr, private_snp_reversions
 
 
-def calculate_mutations_reversions_from_temporal_change_map(temporal_change_map, sample_1, sample_2, lower_threshold=config.consensus_lower_threshold, 
+def calculate_mutations_reversions_from_temporal_change_map(temporal_change_map, sample_1, sample_2, lower_threshold=config.consensus_lower_threshold,
 upper_threshold=config.consensus_upper_threshold):
 
-    sample_pair = sample_1, sample_2
-    if sample_pair not in temporal_change_map:
+    record_idx = get_temporal_change_record_idx(temporal_change_map, sample_1, sample_2, 'snps')
+    if record_idx < 0:
         return -1, -1, [], []
-        
-    if 'snps' not in temporal_change_map[sample_pair]:
-        return -1, -1, [], []
-        
-    # otherwise, some hope! 
-    snp_opportunities, snp_perr, snp_changes = temporal_change_map[sample_pair]['snps']
-    
-    mutations = []
-    reversions = []
-    for snp_change in snp_changes:
-    
-        a,b,c,d,A1,D1,A2,D2 = snp_change
-        
-        f1 = A1*1.0/D1
-        f2 = A2*1.0/D2
-        
-        if (f1<=lower_threshold) and (f2>=upper_threshold):
-            mutations.append(snp_change)
-        elif (f1>=upper_threshold) and (f2<=lower_threshold):
-            reversions.append(snp_change)
-            
-    
+
+    # otherwise, some hope!
+    snp_opportunities = float(temporal_change_map['record_opportunities'][record_idx])
+    snp_perr = float(temporal_change_map['record_perrs'][record_idx])
+
+    rows = get_record_rows(temporal_change_map, record_idx)
+
+    is_mutation, is_reversion = calculate_snp_change_directions(temporal_change_map, rows, lower_threshold, upper_threshold)
+
+    mutations = get_snp_change_tuples(temporal_change_map, rows.start+numpy.nonzero(is_mutation)[0])
+    reversions = get_snp_change_tuples(temporal_change_map, rows.start+numpy.nonzero(is_reversion)[0])
+
     return snp_opportunities, snp_perr, mutations, reversions
 
 
 def calculate_gains_losses_from_temporal_change_map(temporal_change_map, sample_1, sample_2, max_absent_copynum=config.gainloss_max_absent_copynum, min_normal_copynum=config.gainloss_min_normal_copynum, max_normal_copynum=config.gainloss_max_normal_copynum):
 
-
-    sample_pair = sample_1, sample_2
-    if sample_pair not in temporal_change_map:
-        return -1, -1, [], []
-        
-    if 'genes' not in temporal_change_map[sample_pair]:
+    record_idx = get_temporal_change_record_idx(temporal_change_map, sample_1, sample_2, 'genes')
+    if record_idx < 0:
         return -1, -1, [], []
-        
-    # otherwise, some hope! 
-    gene_opportunities, gene_perr, gene_changes = temporal_change_map[sample_pair]['genes']
-    
-    gains = []
-    losses = []
-    for gene_change in gene_changes:
-    
-        gene_name, D1, Dm1, D2, Dm2 = gene_change
-        
-        copynum_1 = D1/Dm1
-        copynum_2 = D2/Dm2
-        
-        if (copynum_1<=max_absent_copynum) and (copynum_2>=min_normal_copynum) and (copynum_2<=max_normal_copynum):
-            gains.append(gene_change)
-        elif (copynum_2<=max_absent_copynum) and (copynum_1>=min_normal_copynum) and (copynum_1<=max_normal_copynum):
-            losses.append(gene_change)
-            
-    
+
+    # otherwise, some hope!
+    gene_opportunities = float(temporal_change_map['record_opportunities'][record_idx])
+    gene_perr = float(temporal_change_map['record_perrs'][record_idx])
+
+    rows = get_record_rows(temporal_change_map, record_idx)
+
+    is_gain, is_loss = calculate_gene_change_directions(temporal_change_map, rows, max_absent_copynum, min_normal_copynum, max_normal_copynum)
+
+    gains = get_gene_change_tuples(temporal_change_map, rows.start+numpy.nonzero(is_gain)[0])
+    losses = get_gene_change_tuples(temporal_change_map, rows.start+numpy.nonzero(is_loss)[0])
+
     return gene_opportunities, gene_perr, gains, losses
 
+###############################################################################
+#
+# Vectorized versions of the above for all sample pairs at once
+#
+###############################################################################
+
+def calculate_snp_change_directions(temporal_change_map, row_idxs, lower_threshold=config.consensus_lower_threshold, upper_threshold=config.consensus_upper_threshold):
+# returns boolean arrays of whether each snp change is a mutation or a reversion
+
+    A1s, D1s, A2s, D2s = temporal_change_map['snp_counts'][row_idxs].T
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        f1s = A1s*1.0/D1s
+        f2s = A2s*1.0/D2s
+
+        is_mutation = (f1s<=lower_threshold)*(f2s>=upper_threshold)
+        is_reversion = (f1s>=upper_threshold)*(f2s<=lower_threshold)*numpy.logical_not(is_mutation)
+
+    return is_mutation, is_reversion
+
+def calculate_gene_change_directions(temporal_change_map, row_idxs, max_absent_copynum=config.gainloss_max_absent_copynum, min_normal_copynum=config.gainloss_min_normal_copynum, max_normal_copynum=config.gainloss_max_normal_copynum):
+# returns boolean arrays of whether each gene change is a gain or a loss
+
+    D1s, Dm1s, D2s, Dm2s = temporal_change_map['gene_coverages'][row_idxs].T
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        copynum_1s = D1s/Dm1s
+        copynum_2s = D2s/Dm2s
+
+        is_gain = (copynum_1s<=max_absent_copynum)*(copynum_2s>=min_normal_copynum)*(copynum_2s<=max_normal_copynum)
+        is_loss = (copynum_2s<=max_absent_copynum)*(copynum_1s>=min_normal_copynum)*(copynum_1s<=max_normal_copynum)*numpy.logical_not(is_gain)
+
+    return is_gain, is_loss
+
+def count_record_changes(temporal_change_map, record_idxs, is_change):
+# returns number of changes in each record (is_change = boolean array over all rows of the record type's table)
+
+    cumulative_changes = numpy.hstack([[0], numpy.cumsum(is_change)])
+    return cumulative_changes[temporal_change_map['record_ends'][record_idxs]]-cumulative_changes[temporal_change_map['record_starts'][record_idxs]]
+
+def get_recorded_sample_pairs(temporal_change_map, type):
+# returns list of sample pairs and array of their record idxs for type
+
+    if len(temporal_change_map)==0 or (type not in temporal_change_map['type_idx_map']):
+        return [], numpy.array([], dtype=numpy.int64)
+
+    record_idxs = temporal_change_map['record_idxs'][:,temporal_change_map['type_idx_map'][type]]
+    pair_idxs = numpy.nonzero(record_idxs>=0)[0]
+
+    samples = temporal_change_map['samples']
+    pair_samples = temporal_change_map['pair_samples']
+    sample_pairs = [(samples[pair_samples[pair_idx,0]], samples[pair_samples[pair_idx,1]]) for pair_idx in pair_idxs]
+
+    return sample_pairs, record_idxs[pair_idxs]
+
+def calculate_mutation_reversion_counts(temporal_change_map, lower_threshold=config.consensus_lower_threshold, upper_threshold=config.consensus_upper_threshold):
+# returns list of sample pairs with snp changes, and arrays of
+# snp_opportunities, snp_perrs, num_mutations, num_reversions for each pair
+
+    sample_pairs, record_idxs = get_recorded_sample_pairs(temporal_change_map, 'snps')
+    if len(sample_pairs)==0:
+        return [], numpy.array([]), numpy.array([]), numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+
+    is_mutation, is_reversion = calculate_snp_change_directions(temporal_change_map, slice(None), lower_threshold, upper_threshold)
+
+    num_mutations = count_record_changes(temporal_change_map, record_idxs, is_mutation)
+    num_reversions = count_record_changes(temporal_change_map, record_idxs, is_reversion)
+
+    return sample_pairs, temporal_change_map['record_opportunities'][record_idxs], temporal_change_map['record_perrs'][record_idxs], num_mutations, num_reversions
+
+def calculate_gain_loss_counts(temporal_change_map, max_absent_copynum=config.gainloss_max_absent_copynum, min_normal_copynum=config.gainloss_min_normal_copynum, max_normal_copynum=config.gainloss_max_normal_copynum):
+# returns list of sample pairs with gene changes, and arrays of
+# gene_opportunities, gene_perrs, num_gains, num_losses for each pair
+
+    sample_pairs, record_idxs = get_recorded_sample_pairs(temporal_change_map, 'genes')
+    if len(sample_pairs)==0:
+        return [], numpy.array([]), numpy.array([]), numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+
+    is_gain, is_loss = calculate_gene_change_directions(temporal_change_map, slice(None), max_absent_copynum, min_normal_copynum, max_normal_copynum)
+
+    num_gains = count_record_changes(temporal_change_map, record_idxs, is_gain)
+    num_losses = count_record_changes(temporal_change_map, record_idxs, is_loss)
+
+    return sample_pairs, temporal_change_map['record_opportunities'][record_idxs], temporal_change_map['record_perrs'][record_idxs], num_gains, num_losses
+
 
 if __name__=='__main__':
 
@@ -229,7 +498,7 @@ if __name__=='__main__':
         sample_coverage_map = parse_midas_data.parse_sample_coverage_map(species_name)
 
         sys.stderr.write("Loading SFSs for %s...\t" % species_name)
-        samples, sfs_map = parse_midas_data.parse_within_sample_sfs(species_name, allowed_variant_types=set(['1D','2D','3D','4D'])) 
+        samples, sfs_arrays = parse_midas_data.parse_within_sample_sfs_arrays(species_name, allowed_variant_types=set(['1D','2D','3D','4D'])) 
         sys.stderr.write("Done!\n")
 
 
@@ -272,7 +541,7 @@ if __name__=='__main__':
         
         # Use if HMP    
         import calculate_private_snvs
-        private_snv_map = calculate_private_snvs.load_private_snv_map(species_name)
+        private_snv_map = calculate_private_snvs.load_private_snv_keys(species_name)
     
         # If other dataset, use this (and uncomment private snv line below)
         #import calculate_snp_prevalences
@@ -358,6 +627,7 @@ if __name__=='__main__':
                 tracked_private_snp_opportunities[sample_pair] += len(chunk_tracked_private_snps)
                                
         # Calculate SNP error rate
+        perrs = diversity_utils.calculate_fixation_error_rates(sfs_arrays, [snp_samples[i] for i in same_subject_idxs[0]], [snp_samples[j] for j in same_subject_idxs[1]])[:,0]
         for sample_pair_idx in xrange(0,len(same_subject_idxs[0])):
     
             i = same_subject_idxs[0][sample_pair_idx]
@@ -367,7 +637,7 @@ if __name__=='__main__':
             sample_j = snp_samples[j]
             sample_pair = (sample_i, sample_j)
         
-            perr = diversity_utils.calculate_fixation_error_rate(sfs_map, sample_i, sample_j)[0]
+            perr = perrs[sample_pair_idx]
             
             snp_perrs[sample_pair] = perr
             tracked_private_snp_perrs[sample_pair] = perr
@@ -449,6 +719,11 @@ if __name__=='__main__':
     output_file.close()
     sys.stderr.write("Done!\n")
     
+    # binary version of intermediate file
+    sys.stderr.write("Writing binary version of intermediate file...\n")
+    write_temporal_change_store(species_name)
+    sys.stderr.write("Done!\n")
+
     # testing loading of intermediate file
     temporal_change_map = load_temporal_change_map(good_species_list[0])
  
@@ -0,0 +1,181 @@
+###############################################################################
+#
+# Indexed cache of MIDAS's centroid gene sequences
+#
+# parse_midas_data.load_centroid_fasta used to decompress all of
+# pan_genomes/<species>/centroids.ffn.gz (and build every sequence line by
+# line) even when only a few genes were needed. The first call now writes
+# all sequences back to back, without newlines, into an uncompressed file
+# (centroid_fasta_cache/<species>/sequences.dat in the data directory),
+# together with the gene names and the offset of each sequence. Later calls
+# memory-map the sequences file, so a gene's sequence is read from disk
+# only when it is requested.
+#
+# The cache is rebuilt whenever centroids.ffn.gz changes.
+#
+###############################################################################
+import numpy
+import sys
+import os
+import os.path
+import gzip
+
+import config
+from snp_store_utils import calculate_source_stamp, read_cache_stamp, write_cache_directory, write_string_list, read_string_list
+
+centroid_fasta_cache_directory_template = "%scentroid_fasta_cache/%s/"
+
+def get_centroid_fasta_filename(species_name):
+    return "%span_genomes/%s/centroids.ffn.gz" % (config.midas_directory, species_name)
+
+def get_centroid_fasta_cache_directory(species_name):
+    return centroid_fasta_cache_directory_template % (config.data_directory, species_name)
+
+###############################################################################
+#
+# Parses centroids.ffn.gz
+#
+# returns list of gene names, array of sequence offsets (genes+1), and string
+# of all sequences concatenated together
+#
+###############################################################################
+def parse_centroid_fasta_file(species_name):
+
+    gene_names = []
+    offsets = []
+    sequence_lines = []
+    total_length = 0
+
+    centroid_file = gzip.open(get_centroid_fasta_filename(species_name), 'r')
+    for line in centroid_file:
+        line=line.strip()
+        if len(line)==0:
+            continue
+        if line[0]=='>':
+            offsets.append(total_length)
+            gene_names.append(line[1:len(line)])
+        else:
+            sequence_lines.append(line)
+            total_length += len(line)
+    centroid_file.close()
+
+    offsets.append(total_length)
+
+    return gene_names, numpy.array(offsets, dtype=numpy.int64), "".join(sequence_lines)
+
+###############################################################################
+#
+# Builds the cache from centroids.ffn.gz
+#
+# returns the (in memory) index, see load_centroid_fasta_index
+#
+###############################################################################
+def create_centroid_fasta_cache(species_name):
+
+    source_stamp = calculate_source_stamp(get_centroid_fasta_filename(species_name))
+
+    sys.stderr.write("Creating centroid fasta cache for %s...\n" % species_name)
+    gene_names, offsets, sequences = parse_centroid_fasta_file(species_name)
+
+    def write_centroid_fasta_cache(cache_directory):
+
+        write_string_list(cache_directory+"gene_names.txt", gene_names)
+        numpy.save(cache_directory+"offsets.npy", offsets)
+
+        file = open(cache_directory+"sequences.dat","wb")
+        file.write(sequences)
+        file.close()
+
+    if write_cache_directory(get_centroid_fasta_cache_directory(species_name), source_stamp, write_centroid_fasta_cache):
+        sys.stderr.write("Done! Cached %d genes\n" % len(gene_names))
+
+    return create_centroid_fasta_index(gene_names, offsets, numpy.frombuffer(sequences, dtype=numpy.uint8))
+
+def create_centroid_fasta_index(gene_names, offsets, sequences):
+# returns map with 'gene_names', 'gene_idx_map', 'offsets', and 'sequences'
+# (uint8 array of all sequences)
+
+    centroid_fasta_index = {}
+    centroid_fasta_index['gene_names'] = gene_names
+    # (same as the old dictionary: the last sequence wins if a gene appears twice)
+    centroid_fasta_index['gene_idx_map'] = {gene_names[i]:i for i in xrange(0,len(gene_names))}
+    centroid_fasta_index['offsets'] = offsets
+    centroid_fasta_index['sequences'] = sequences
+    return centroid_fasta_index
+
+###############################################################################
+#
+# Loads the (memory-mapped) index, creating the cache if needed
+#
+# returns map with 'gene_names', 'gene_idx_map', 'offsets', and 'sequences'
+#
+###############################################################################
+def load_centroid_fasta_index(species_name):
+
+    cache_directory = get_centroid_fasta_cache_directory(species_name)
+
+    if read_cache_stamp(cache_directory) != calculate_source_stamp(get_centroid_fasta_filename(species_name)):
+        return create_centroid_fasta_cache(species_name)
+
+    gene_names = read_string_list(cache_directory+"gene_names.txt")
+    offsets = numpy.load(cache_directory+"offsets.npy")
+
+    if offsets[-1] > 0:
+        sequences = numpy.memmap(cache_directory+"sequences.dat", dtype=numpy.uint8, mode='r')
+    else:
+        # (numpy can't map an empty file)
+        sequences = numpy.zeros(0, dtype=numpy.uint8)
+
+    return create_centroid_fasta_index(gene_names, offsets, sequences)
+
+###############################################################################
+#
+# Random access to the sequences of individual genes
+#
+###############################################################################
+
+def get_centroid_sequence_view(centroid_fasta_index, gene_name):
+# returns uint8 array view of the gene's sequence (no copy is made)
+# raises KeyError if gene is not in the index
+
+    gene_idx = centroid_fasta_index['gene_idx_map'][gene_name]
+    return centroid_fasta_index['sequences'][centroid_fasta_index['offsets'][gene_idx]:centroid_fasta_index['offsets'][gene_idx+1]]
+
+def get_centroid_sequence(centroid_fasta_index, gene_name):
+# returns the gene's sequence as a string
+# raises KeyError if gene is not in the index
+
+    return get_centroid_sequence_view(centroid_fasta_index, gene_name).tostring()
+
+def get_centroid_sequences(centroid_fasta_index, gene_names):
+# returns map from gene name -> sequence
+# (genes that aren't in the index are skipped)
+
+    centroid_fastas = {}
+    # (read in file order)
+    for gene_name in sorted(set(gene_names), key=lambda gene_name: centroid_fasta_index['gene_idx_map'].get(gene_name,-1)):
+        if gene_name in centroid_fasta_index['gene_idx_map']:
+            centroid_fastas[gene_name] = get_centroid_sequence(centroid_fasta_index, gene_name)
+    return centroid_fastas
+
+if __name__=='__main__':
+
+    ################################################################################
+    #
+    # Standard header to read in argument information
+    #
+    ################################################################################
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("species_name", help="name of species to process")
+    parser.add_argument("genes", help="genes to print", nargs='*')
+    args = parser.parse_args()
+
+    species_name = args.species_name
+    gene_names = args.genes
+    ################################################################################
+
+    centroid_fasta_index = load_centroid_fasta_index(species_name)
+    for gene_name in gene_names:
+        print ">%s" % gene_name
+        print get_centroid_sequence(centroid_fasta_index, gene_name)
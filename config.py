@@ -4,6 +4,7 @@
 #
 ###############################################################################
 import os.path 
+import multiprocessing
 from math import log10
 
 data_directory = os.path.expanduser("~/ben_nandita_hmp_data_091118/")
@@ -53,9 +54,14 @@ pipe_snps_min_samples=4
 pipe_snps_min_nonzero_median_coverage=5
 pipe_snps_lower_depth_factor=0.3
 pipe_snps_upper_depth_factor=3
+pipe_snps_batch_size=10000 # number of sites parsed at once
 
 parse_snps_min_freq = 0.05
 
+# Number of processes used to decompress (large) bz2 input files
+# (1 = read with single-threaded bz2.BZ2File)
+bz2_num_threads = multiprocessing.cpu_count()
+
 between_host_min_sample_size = 33
 between_host_ld_min_sample_size = 10
 within_host_min_sample_size = 3
@@ -14,6 +14,8 @@ import sample_utils
 import stats_utils
 import os.path
 import sfs_utils
+import snp_container_utils
+import site_key_utils
 
 # Calls consensus genotypes from matrix of allele counts
 #
@@ -110,28 +112,27 @@ def calculate_rsquared_condition_freq(allele_counts_1, allele_counts_2, low_freq
     
     passed_sites_1=(depths_1>0)*(pooled_freqs_1 >= low_freq)[:,None]*(pooled_freqs_1 <=high_freq)[:,None]
     passed_sites_2=(depths_2>0)*(pooled_freqs_2 >= low_freq)[:,None]*(pooled_freqs_2 <= high_freq)[:,None]
-    joint_passed_sites=passed_sites_1[None,:,:]*passed_sites_2[:,None,:]
-    # sites x sites x samples matrix
     
-    joint_freqs = freqs_1[None,:,:]*freqs_2[:,None,:]
-    # sites x sites x samples_matrix
+    # sites x sites matrices of haplotype counts
+    # (freqs are consensus genotypes, see calculate_haplotype_counts)
+    ns, n11s, n10s, n01s, n00s = calculate_haplotype_counts(freqs_1, passed_sites_1, freqs_2, passed_sites_2)
     
     # this tells us what the denominator is for the computation below for joint_pooled_freqs
-    total_joint_passed_sites = joint_passed_sites.sum(axis=2)
+    total_joint_passed_sites = ns
     # add 1 to denominator if some pair is 0. 
     total_joint_passed_sites = total_joint_passed_sites+(total_joint_passed_sites==0)
     
     # compute p_ab
-    joint_pooled_freqs = (joint_freqs*joint_passed_sites).sum(axis=2)/total_joint_passed_sites   
+    joint_pooled_freqs = n11s/total_joint_passed_sites   
     # floting point issue
     joint_pooled_freqs *= (joint_pooled_freqs>1e-10)
     
     # compute p_a
-    marginal_pooled_freqs_1 = (freqs_1[None,:,:]*joint_passed_sites).sum(axis=2)/total_joint_passed_sites
+    marginal_pooled_freqs_1 = (n11s+n10s)/total_joint_passed_sites
     marginal_pooled_freqs_1 *= (marginal_pooled_freqs_1>1e-10)
 
     # compute p_b
-    marginal_pooled_freqs_2 = (freqs_2[:,None,:]*joint_passed_sites).sum(axis=2)/total_joint_passed_sites 
+    marginal_pooled_freqs_2 = (n11s+n01s)/total_joint_passed_sites 
     marginal_pooled_freqs_2 *= (marginal_pooled_freqs_2>1e-10)
        
     # (p_ab-p_a*p_b)^2
@@ -202,6 +203,43 @@ def calculate_sigmasquared(allele_counts_1, allele_counts_2):
 #####################################################################
 
 
+#####################################################################
+#
+# Haplotype counts for all pairs of sites
+#
+# genotypes, passed_sites = (sites x samples) arrays from calculate_consensus_genotypes
+#
+# returns (sites_2 x sites_1) matrices of the number of samples that passed 
+# at both sites (ns), and the number of those with genotypes 11, 10, 01, and 00
+# (for site 1, site 2)
+#
+# Each count is a single matrix product of per-site indicators, e.g. 
+#
+# n11s = dot(genotypes_2*passed_sites_2, (genotypes_1*passed_sites_1).T)
+#
+# so we never need the sites x sites x samples matrix of joint passed sites. 
+# (all entries are integers, so the float products are exact)
+#
+#####################################################################
+def calculate_haplotype_counts(genotypes_1, passed_sites_1, genotypes_2, passed_sites_2):
+
+    passed_sites_1 = passed_sites_1*1.0
+    passed_sites_2 = passed_sites_2*1.0
+    derived_sites_1 = genotypes_1*passed_sites_1
+    derived_sites_2 = genotypes_2*passed_sites_2
+    
+    ns = numpy.dot(passed_sites_2, passed_sites_1.T)
+    n11s = numpy.dot(derived_sites_2, derived_sites_1.T)
+    n10s = numpy.dot(passed_sites_2, derived_sites_1.T) - n11s
+    n01s = numpy.dot(derived_sites_2, passed_sites_1.T) - n11s
+    n00s = ns - n11s - n10s - n01s
+    
+    # (same integer type as a sum over booleans)
+    return ns.astype(numpy.int_), n11s, n10s, n01s, n00s
+
+# max number of site pairs in each block of calculate_unbiased_sigmasquared
+sigmasquared_block_size = 1000000
+
 #####################################################################
 def calculate_unbiased_sigmasquared(allele_counts_1, allele_counts_2):
     # An alternate version of a standard measure of linkage disequilibrium:
@@ -213,29 +251,33 @@ def calculate_unbiased_sigmasquared(allele_counts_1, allele_counts_2):
     # where we have corrected for finite sample effects
 
     genotypes_1, passed_sites_1 = calculate_consensus_genotypes(allele_counts_1)
-    genotypes_2, passed_sites_2 = calculate_consensus_genotypes(allele_counts_2)
+    if allele_counts_2 is allele_counts_1:
+        genotypes_2, passed_sites_2 = genotypes_1, passed_sites_1
+    else:
+        genotypes_2, passed_sites_2 = calculate_consensus_genotypes(allele_counts_2)
     
+    # sites_2 x sites_1 matrices
+    rsquared_numerators = numpy.zeros((len(genotypes_2), len(genotypes_1)))
+    rsquared_denominators = numpy.zeros_like(rsquared_numerators)
     
-    # this asks which pairs of sites have depths >0 at BOTH sites
-    # None here takes the product of the elements in the two vectors and returns a matrix. 
-    joint_passed_sites = (passed_sites_1)[None,:,:]*(passed_sites_2)[:,None,:]
-    # sites x sites x samples matrix
-    
-    # allele counts
-    ns = joint_passed_sites.sum(axis=2)
+    # (blocks of sites_2, so that the temporary matrices below 
+    #  have at most sigmasquared_block_size entries)
+    block_size = max([1, sigmasquared_block_size/max([1,len(genotypes_1)])])
     
-    n11s = ((genotypes_1[None,:,:])*(genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
-    n10s = (genotypes_1[None,:,:]*(1-genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
-    n01s = ((1-genotypes_1[None,:,:])*(genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
-    n00s = ((1-genotypes_1[None,:,:])*(1-genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
+    for site_idx in xrange(0,len(genotypes_2),block_size):
+        
+        block_idxs = slice(site_idx, site_idx+block_size)
+        
+        # allele counts
+        ns, n11s, n10s, n01s, n00s = calculate_haplotype_counts(genotypes_1, passed_sites_1, genotypes_2[block_idxs], passed_sites_2[block_idxs])
+        
+        rsquared_numerators[block_idxs], rsquared_denominators[block_idxs] = calculate_unbiased_sigmasquared_from_counts(ns, n11s, n10s, n01s, n00s)
     
-    #print "Gene:" 
-    #print n11s
-    #print n10s
-    #print n01s
-    #print n00s
-    #print "--"
+    return rsquared_numerators, rsquared_denominators
 
+def calculate_unbiased_sigmasquared_from_counts(ns, n11s, n10s, n01s, n00s):
+    # rsquared numerators and denominators from the matrices 
+    # of haplotype counts in calculate_haplotype_counts
     
     # First calculate numerator
     rsquared_numerators = n11s*(n11s-1)*n00s*(n00s-1)
@@ -365,7 +407,7 @@ def calculate_sample_freqs(allele_counts_map, passed_sites_map, variant_type='4D
      
     sample_freqs = [[] for i in xrange(0,allele_counts_map[allele_counts_map.keys()[0]][variant_type]['alleles'].shape[1])]
     
-    passed_sites = numpy.zeros(passed_sites_map[passed_sites_map.keys()[0]][variant_type]['sites'].shape[0])*1.0
+    passed_sites = numpy.zeros(passed_sites_map[passed_sites_map.keys()[0]][variant_type]['depth_patterns'].shape[1])*1.0
     
     for gene_name in allowed_genes:
     
@@ -375,14 +417,14 @@ def calculate_sample_freqs(allele_counts_map, passed_sites_map, variant_type='4D
             continue
             
         depths = allele_counts.sum(axis=2)
-        freqs = allele_counts[:,:,0]/(depths+(depths==0))
+        freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
         if fold == True:
             freqs = numpy.fmin(freqs,1-freqs) #fold
         for sample_idx in xrange(0,freqs.shape[1]):
             gene_freqs = freqs[:,sample_idx]
             sample_freqs[sample_idx].extend( gene_freqs[gene_freqs>0])
             
-        passed_sites += numpy.diagonal(passed_sites_map[gene_name][variant_type]['sites'])
+        passed_sites += numpy.diagonal(parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type]))
         
     
     return sample_freqs, passed_sites
@@ -425,7 +467,8 @@ def calculate_temporal_sample_freqs(allele_counts_map, passed_sites_map, initial
             
             chunk_positions = numpy.array([position for chromosome, position in allele_counts_map[gene_name][variant_type]['locations']])
             
-            allele_counts = allele_counts[:,desired_samples,:]            
+            # (depths are returned, so upcast from compact ints)
+            allele_counts = allele_counts[:,desired_samples,:]*1.0
             depths = allele_counts.sum(axis=2)
             freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
             
@@ -567,7 +610,7 @@ def calculate_sample_freqs_2D(allele_counts_map, passed_sites_map, desired_sampl
             sample_freqs[sample_idx].extend(gene_freqs)
             joint_passed_sites[sample_idx].extend(joint_passed_sites_tmp[:,0,sample_idx])
             idx=numpy.where(desired_samples==True)
-        passed_sites += passed_sites_map[gene_name][variant_type]['sites'][:,idx[0]][idx[0],:]
+        passed_sites += parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type], idx[0])
     
     return sample_freqs, passed_sites, joint_passed_sites
 
@@ -664,6 +707,48 @@ def calculate_pooled_counts(allele_counts_map, passed_sites_map, allowed_sample_
     pooled_counts = numpy.array(pooled_counts)
     return pooled_counts, pi_weighted_number
 
+###############################################################################
+#
+# Same as calculate_pooled_freqs and calculate_pooled_counts, 
+# but for all sites in a SNP container at once (see snp_container_utils)
+#
+# (pooled freqs are in the order of the container's sites)
+#
+###############################################################################
+def calculate_polymorphic_site_prevalences(snp_container, allowed_sample_idxs=[], allowed_variant_types = set(['1D','2D','3D','4D']), allowed_genes=set([]), lower_threshold=0.2,upper_threshold=0.8):
+# returns vectors of prevalences and number of passed samples at polymorphic sites
+
+    allele_counts = snp_container['alleles'][snp_container_utils.select_sites(snp_container, allowed_variant_types, allowed_genes)]
+    
+    if len(allowed_sample_idxs)>0:
+        allele_counts = allele_counts[:,allowed_sample_idxs,:]
+    
+    genotype_matrix, passed_sites_matrix = calculate_consensus_genotypes(allele_counts,lower_threshold,upper_threshold)
+    prevalences = (genotype_matrix*passed_sites_matrix).sum(axis=1)
+    min_prevalences = 0.5
+    max_prevalences = (passed_sites_matrix).sum(axis=1)-0.5
+    
+    polymorphic_sites = (prevalences>min_prevalences)*(prevalences<max_prevalences)
+    
+    return prevalences[polymorphic_sites], passed_sites_matrix.sum(axis=1)[polymorphic_sites]
+
+def calculate_pooled_freqs_from_snp_container(snp_container, allowed_sample_idxs=[], allowed_variant_types = set(['1D','2D','3D','4D']), allowed_genes=set([]), lower_threshold=0.2,upper_threshold=0.8):
+
+    prevalences, ns = calculate_polymorphic_site_prevalences(snp_container, allowed_sample_idxs, allowed_variant_types, allowed_genes, lower_threshold, upper_threshold)
+    
+    pooled_freqs = prevalences*1.0/ns
+    pooled_freqs = numpy.fmin(pooled_freqs,1-pooled_freqs)
+    return pooled_freqs
+    
+def calculate_pooled_counts_from_snp_container(snp_container, allowed_sample_idxs=[], allowed_variant_types = set(['1D','2D','3D','4D']), allowed_genes=set([]),pi_min_k=1,lower_threshold=0.2,upper_threshold=0.8):
+
+    ks, ns = calculate_polymorphic_site_prevalences(snp_container, allowed_sample_idxs, allowed_variant_types, allowed_genes, lower_threshold, upper_threshold)
+    
+    minor_ks = numpy.fmin(ks,ns-ks)
+    pi_weighted_number = (ks*(ns-ks)*2.0/(ns*(ns-1))*(minor_ks>=pi_min_k)).sum()
+    
+    return minor_ks, pi_weighted_number
+
 def calculate_private_snvs(samples, allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
 upper_threshold=config.consensus_upper_threshold):
 
@@ -689,8 +774,6 @@ upper_threshold=config.consensus_upper_threshold):
             if variant_type not in allowed_variant_types:
                 continue
             
-            passed_sites = passed_sites_map[gene_name][variant_type]['sites']
-   
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']                        
             if len(allele_counts)==0:
                 continue
@@ -740,6 +823,93 @@ upper_threshold=config.consensus_upper_threshold):
     return private_snvs
      
 
+# memory budget (in bytes) for the per-site arrays 
+# in each block of sites in calculate_singleton_matrix
+singleton_block_memory = 256*1024*1024
+
+#############
+#
+# Per-site indicators used by calculate_singleton_matrix
+#
+# The old sites*sample*sample tensors only enter through per-site sums over 
+# one of the samples (sample sizes and numbers of differences), 
+# which are just sites*samples arrays. 
+#
+# returns list of (sites x samples) float arrays: 
+# passed_depths, high_freq_sites, ancestral_sites, derived_sites, 
+# ambiguous_sites (both ancestral and derived), sufficient_sites 
+# (sample size >= 4), potential_singletons, potential_doubletons
+#
+#############
+def calculate_singleton_indicators(allele_counts, lower_threshold=config.consensus_lower_threshold, upper_threshold=config.consensus_upper_threshold):
+
+    depths = allele_counts.sum(axis=2)
+    freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
+    
+    passed_depths = (depths>0)
+    derived_sites = (freqs>=upper_threshold)*passed_depths
+    ancestral_sites = (freqs<=lower_threshold)*passed_depths
+    
+    # Sites where the major allele is at sufficiently high frequency
+    high_freq_sites = numpy.logical_or(ancestral_sites, derived_sites)
+    # (only possible if lower_threshold >= upper_threshold)
+    ambiguous_sites = numpy.logical_and(ancestral_sites, derived_sites)
+    
+    # number of samples that each sample can be compared to at each site
+    site_sample_sizes = high_freq_sites*high_freq_sites.sum(axis=1)[:,None]
+    # and the number of those that differ from it
+    site_total_differences = derived_sites*ancestral_sites.sum(axis=1)[:,None] + ancestral_sites*derived_sites.sum(axis=1)[:,None] - ambiguous_sites*ambiguous_sites.sum(axis=1)[:,None]
+    
+    # Want at least a sample size of 4
+    sufficient_sites = (site_sample_sizes>3.5)
+    
+    potential_singletons = ((site_sample_sizes-site_total_differences)==1)*sufficient_sites
+    potential_doubletons = ((site_sample_sizes-site_total_differences)==2)*sufficient_sites
+    
+    # (floats so that the products below go through BLAS)
+    return [passed_depths*1.0, high_freq_sites*1.0, ancestral_sites*1.0, derived_sites*1.0, ambiguous_sites*1.0, sufficient_sites*1.0, potential_singletons*1.0, potential_doubletons*1.0]
+
+def calculate_weighted_difference_matrix(weights, ancestral_sites, derived_sites, ambiguous_sites):
+# returns sum over sites of weights[s,i]*(site s differs between samples i and j)
+
+    difference_matrix = numpy.dot((weights*derived_sites).T, ancestral_sites) + numpy.dot((weights*ancestral_sites).T, derived_sites)
+    
+    if ambiguous_sites.any():
+        difference_matrix -= numpy.dot((weights*ambiguous_sites).T, ambiguous_sites)
+        
+    return difference_matrix
+
+#############
+#
+# Adds the singletons, doubletons, differences, and opportunities in a block
+# of sites (list of indicators from calculate_singleton_indicators) to the 
+# matrices in singleton_matrices 
+#
+# (all entries are integers, so the float products are exact)
+#
+#############
+def add_singleton_block(singleton_matrices, block_indicators):
+
+    if len(block_indicators)==0:
+        return
+        
+    doubleton_matrix, singleton_matrix, difference_matrix, opportunity_matrix = singleton_matrices
+    
+    passed_depths, high_freq_sites, ancestral_sites, derived_sites, ambiguous_sites, sufficient_sites, potential_singletons, potential_doubletons = [numpy.vstack([indicators[k] for indicators in block_indicators]) for k in xrange(0,8)]
+    
+    # total number of differences between i and j 
+    # (regardless of singleton/doubleton status)
+    difference_matrix += calculate_weighted_difference_matrix(sufficient_sites, ancestral_sites, derived_sites, ambiguous_sites)
+    
+    singleton_matrix += calculate_weighted_difference_matrix(potential_singletons, ancestral_sites, derived_sites, ambiguous_sites)
+    
+    # (confident in both, but not different)
+    doubleton_matrix += numpy.dot((potential_doubletons*high_freq_sites).T, high_freq_sites) - calculate_weighted_difference_matrix(potential_doubletons, ancestral_sites, derived_sites, ambiguous_sites)
+    
+    # Sites that we can't count (but we would have counted in passed_sites)
+    # (passed_sites already added)
+    opportunity_matrix -= numpy.dot(passed_depths.T, passed_depths) - numpy.dot((sufficient_sites*high_freq_sites).T, high_freq_sites)
+
 def calculate_singleton_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
 upper_threshold=config.consensus_upper_threshold):
 
@@ -753,13 +923,20 @@ upper_threshold=config.consensus_upper_threshold):
     if len(allowed_variant_types)==0:
         allowed_variant_types = set(['1D','2D','3D','4D'])    
          
-    doubleton_matrix = numpy.zeros_like( passed_sites_map.values()[0].values()[0]['sites'] )*1.0   
+    doubleton_matrix = numpy.zeros_like( parse_midas_data.calculate_passed_sites_matrix(passed_sites_map.values()[0].values()[0]) )*1.0   
     singleton_matrix = numpy.zeros_like(doubleton_matrix)
     
     difference_matrix = numpy.zeros_like(doubleton_matrix)
     
     opportunity_matrix = numpy.zeros_like(doubleton_matrix)
     
+    singleton_matrices = (doubleton_matrix, singleton_matrix, difference_matrix, opportunity_matrix)
+    
+    # Sites from many genes are added together, in blocks whose 
+    # per-site arrays (8 of them, plus temporaries) fit in singleton_block_memory
+    block_size = max([1, singleton_block_memory/(12*8*max([1,doubleton_matrix.shape[0]]))])
+    block_indicators = []
+    num_block_sites = 0
      
     for gene_name in allowed_genes:
         
@@ -767,142 +944,188 @@ upper_threshold=config.consensus_upper_threshold):
              
             if variant_type not in allowed_variant_types:
                 continue
-            
-            passed_sites = passed_sites_map[gene_name][variant_type]['sites']
    
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']                        
             if len(allele_counts)==0:
                 continue
             
-            depths = allele_counts.sum(axis=2)
-            freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
-            
-            derived_sites = (freqs>=upper_threshold)
-            ancestral_sites = (freqs<=lower_threshold)
-            
-            # Sites where the major allele is at sufficiently high frequency
-            high_freq_sites = numpy.logical_or(ancestral_sites, derived_sites)
-            # Those where it is not
-            intermediate_freq_sites = numpy.logical_not(high_freq_sites)
-            
-            # site*sample*sample matrix of sites with sufficient coverage in both samples
-            passed_depths = (depths>0)[:,:,None]*(depths>0)[:,None,:]
-
-            # site*sample*sample matrix of sites where we can look for differences            
-            confident_sites = numpy.logical_and(high_freq_sites[:,:,None], high_freq_sites[:,None,:])*passed_depths
-            
-            site_difference_matrix = numpy.logical_or(derived_sites[:,:,None]*ancestral_sites[:,None,:],  ancestral_sites[:,:,None]*derived_sites[:,None,:] )
-            
-            # this is really the only place you have to switch 
-            # to within-between hosts
-            
-            site_sample_size_matrix = confident_sites.sum(axis=2)
-            # Want at least a sample size of 4
-            site_sufficient_sample_size_matrix = (site_sample_size_matrix>3.5)
-            # 
-            site_total_difference_matrix = (site_difference_matrix*confident_sites).sum(axis=2)
-            
-            potential_singletons = ((site_sample_size_matrix-site_total_difference_matrix)==1)
+            opportunity_matrix += parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type])
             
-            potential_doubletons = ((site_sample_size_matrix-site_total_difference_matrix)==2)
+            # (long genes are split across blocks)
+            for site_idx in xrange(0,len(allele_counts),block_size):
             
+                block_allele_counts = allele_counts[site_idx:site_idx+block_size]
             
-            # Confident sites is now asymmetric
-            confident_sites *= site_sufficient_sample_size_matrix[:,:,None]
-            
-            # Sites that we can't count (but we would have counted in passed_sites)
-            non_confident_sites = numpy.logical_not(confident_sites)*passed_depths
-            
-            
-            # total number of differences between i and j 
-            # (regardless of singleton/doubleton status)
-            differences = (site_difference_matrix*confident_sites).sum(axis=0)
-            
-            singletons = (confident_sites*site_difference_matrix*potential_singletons[:,:,None]).sum(axis=0)
-            
-            doubletons = (confident_sites * numpy.logical_not(site_difference_matrix) * potential_doubletons[:,:,None]).sum(axis=0)
-            
-            opportunities = passed_sites - (numpy.logical_not(confident_sites)*passed_depths).sum(axis=0) 
-            
-            singleton_matrix += singletons
-            doubleton_matrix += doubletons
-            difference_matrix += differences
-            opportunity_matrix += opportunities
+                block_indicators.append( calculate_singleton_indicators(block_allele_counts, lower_threshold, upper_threshold) )
+                num_block_sites += len(block_allele_counts)
             
+                if num_block_sites >= block_size:
+                    add_singleton_block(singleton_matrices, block_indicators)
+                    block_indicators = []
+                    num_block_sites = 0
+    
+    add_singleton_block(singleton_matrices, block_indicators)
     
     return doubleton_matrix, singleton_matrix, difference_matrix, opportunity_matrix
     
+# max number of sites (summed over genes) in each matrix product
+# of calculate_mutation_reversion_matrix 
+mutation_reversion_block_size = 10000
+
+#############
+#
+# Per-site indicators used by calculate_mutation_reversion_matrix
+#
+# returns (sites x samples) float arrays of sites with coverage, and of sites 
+# with coverage where the major allele is ancestral, derived, or either
+#
+#############
+def calculate_mutation_reversion_indicators(allele_counts, lower_threshold=config.consensus_lower_threshold, upper_threshold=config.consensus_upper_threshold):
+
+    depths = allele_counts.sum(axis=2)
+    freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
+    
+    passed_depths = (depths>0)
+    derived_sites = (freqs>=upper_threshold)*passed_depths
+    ancestral_sites = (freqs<=lower_threshold)*passed_depths
+    
+    # Sites where the major allele is at sufficiently high frequency
+    high_freq_sites = numpy.logical_or(ancestral_sites, derived_sites)
+    
+    # (floats so that the products below go through BLAS)
+    return passed_depths*1.0, ancestral_sites*1.0, derived_sites*1.0, high_freq_sites*1.0
+
+#############
+#
+# Adds the mutations, reversions, and opportunities in a block of sites 
+# (list of indicators from calculate_mutation_reversion_indicators)
+# to the matrices in mutation_reversion_matrices 
+#
+# All the site*sample*sample sums are sums of outer products of per-site indicators,
+# so each one is a single matrix product, e.g. 
+#
+# mutations[i,j] = sum_s ancestral[s,i]*derived[s,j] = (ancestral.T . derived)[i,j]
+#
+# (all entries are integers, so the float products are exact)
+#
+#############
+def add_mutation_reversion_block(mutation_reversion_matrices, block_indicators):
+
+    if len(block_indicators)==0:
+        return
+        
+    mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix = mutation_reversion_matrices
+    
+    passed_depths, ancestral_sites, derived_sites, high_freq_sites = [numpy.vstack([indicators[k] for indicators in block_indicators]) for k in xrange(0,4)]
+    
+    mut_fixation_matrix += numpy.dot(ancestral_sites.T, derived_sites)
+    rev_fixation_matrix += numpy.dot(derived_sites.T, ancestral_sites)
+    
+    # sites were you could have had a reversion
+    # (derived in i, and confident in both)
+    reversion_opportunities = numpy.dot(derived_sites.T, high_freq_sites)
+    
+    # sites that are missing data based on allele freqs, but which had sufficient coverage
+    # (passed depths in both, but not confident in both)
+    missing_data_sites = numpy.dot(passed_depths.T, passed_depths) - numpy.dot(high_freq_sites.T, high_freq_sites)
+    
+    rev_opportunity_matrix += reversion_opportunities
+    # (passed_sites already added)
+    mut_opportunity_matrix -= (missing_data_sites + reversion_opportunities)
+
 def calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
 upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min_change):
 
-    total_genes = set(passed_sites_map.keys())
+    site_classes = [('sites', allowed_genes, allowed_variant_types)]
+    
+    return calculate_mutation_reversion_matrices(allele_counts_map, passed_sites_map, site_classes, lower_threshold, upper_threshold)['sites']
 
-    if len(allowed_genes)==0:
-        allowed_genes = set(passed_sites_map.keys())
+###############################################################################
+#
+# Same as calculate_mutation_reversion_matrix, but for several classes of sites 
+# at once, in a single pass over the genes. 
+#
+# site_classes = list of (name, allowed_genes, allowed_variant_types) 
+# (empty sets mean all genes / all variant types, as above)
+#
+# The classes can overlap (e.g. 4D sites in core genes are also core sites), 
+# so the sites are split into disjoint partitions by the set of classes they 
+# belong to (e.g. core 4D, core 1D, core 2D/3D, and accessory sites). 
+# The matrix products are only done once per partition, and the matrices 
+# of each class are the sum of the matrices of its partitions. 
+#
+# returns map from name -> (mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix)
+#
+###############################################################################
+def calculate_mutation_reversion_matrices(allele_counts_map, passed_sites_map, site_classes, lower_threshold=config.consensus_lower_threshold, upper_threshold=config.consensus_upper_threshold):
+
+    total_genes = set(passed_sites_map.keys())
     
-    allowed_genes = (allowed_genes & total_genes)     
+    class_genes = []
+    class_variant_types = []
+    for name, allowed_genes, allowed_variant_types in site_classes:
+        
+        if len(allowed_genes)==0:
+            allowed_genes = total_genes
+        class_genes.append( set(allowed_genes) & total_genes )
+        
+        if len(allowed_variant_types)==0:
+            allowed_variant_types = set(['1D','2D','3D','4D'])
+        class_variant_types.append( set(allowed_variant_types) )
     
-    if len(allowed_variant_types)==0:
-        allowed_variant_types = set(['1D','2D','3D','4D'])    
-         
-    mut_fixation_matrix = numpy.zeros_like( passed_sites_map.values()[0].values()[0]['sites'] )*1.0   
-    rev_fixation_matrix = numpy.zeros_like(mut_fixation_matrix)
+    empty_matrix = numpy.zeros_like( parse_midas_data.calculate_passed_sites_matrix(passed_sites_map.values()[0].values()[0]) )*1.0
     
-    mut_opportunity_matrix = numpy.zeros_like(mut_fixation_matrix)
-    rev_opportunity_matrix = numpy.zeros_like(rev_fixation_matrix)
-              
-    for gene_name in allowed_genes:
+    # map from partition (tuple of class idxs) -> 
+    # mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix
+    partition_matrices = {}
+    
+    # Sites from many genes are added together, 
+    # in blocks of up to mutation_reversion_block_size sites
+    partition_block_indicators = {}
+    partition_block_sizes = {}
+    
+    for gene_name in set().union(*class_genes):
         
         for variant_type in passed_sites_map[gene_name].keys():
-             
-            if variant_type not in allowed_variant_types:
+            
+            partition = tuple(class_idx for class_idx in xrange(0,len(site_classes)) if (gene_name in class_genes[class_idx]) and (variant_type in class_variant_types[class_idx]))
+            
+            if len(partition)==0:
                 continue
         
-        
-            passed_sites = passed_sites_map[gene_name][variant_type]['sites']
-   
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']                        
             if len(allele_counts)==0:
                 continue
             
-            depths = allele_counts.sum(axis=2)
-            freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
-            
-            derived_sites = (freqs>=upper_threshold)
-            ancestral_sites = (freqs<=lower_threshold)
-            
-            # Sites where the major allele is at sufficiently high frequency
-            high_freq_sites = numpy.logical_or(ancestral_sites, derived_sites)
-            # Those where it is not
-            intermediate_freq_sites = numpy.logical_not(high_freq_sites)
-            
-            # site*sample*sample matrix of sites with sufficient coverage in both samples
-            passed_depths = (depths>0)[:,:,None]*(depths>0)[:,None,:]
-
-            # site*sample*sample matrix of sites where we can look for differences            
-            confident_sites = numpy.logical_and(high_freq_sites[:,:,None], high_freq_sites[:,None,:])*passed_depths
-            
-
-            # site*sample*sample matrix of sites that are missing data 
-            # based on allele freqs, but which had sufficient coverage
-            # (we need to remove these from opportunities below)
-            missing_data_sites = numpy.logical_or(intermediate_freq_sites[:,:,None],intermediate_freq_sites[:,None,:])*passed_depths
-              
-            # Calculate mutations and reversions
-            mutations = (ancestral_sites[:,:,None])*(derived_sites[:,None,:])*confident_sites
+            if partition not in partition_matrices:
+                partition_matrices[partition] = tuple(numpy.zeros_like(empty_matrix) for k in xrange(0,4))
+                partition_block_indicators[partition] = []
+                partition_block_sizes[partition] = 0
             
-            reversions = (derived_sites[:,:,None])*(ancestral_sites[:,None,:])*confident_sites
+            mut_opportunity_matrix = partition_matrices[partition][2]
+            mut_opportunity_matrix += parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type])
             
-            # sites were you could have had a reversion
-            reversion_opportunities = derived_sites[:,:,None]*confident_sites
+            partition_block_indicators[partition].append( calculate_mutation_reversion_indicators(allele_counts, lower_threshold, upper_threshold) )
+            partition_block_sizes[partition] += len(allele_counts)
             
-            mut_fixation_matrix += (mutations).sum(axis=0)
-            rev_fixation_matrix += (reversions).sum(axis=0)
-            
-            rev_opportunity_matrix += (reversion_opportunities).sum(axis=0)
-            mut_opportunity_matrix += (passed_sites - missing_data_sites.sum(axis=0) - reversion_opportunities.sum(axis=0) ) 
+            if partition_block_sizes[partition] >= mutation_reversion_block_size:
+                add_mutation_reversion_block(partition_matrices[partition], partition_block_indicators[partition])
+                partition_block_indicators[partition] = []
+                partition_block_sizes[partition] = 0
+    
+    class_matrices = [tuple(numpy.zeros_like(empty_matrix) for k in xrange(0,4)) for site_class in site_classes]
+    
+    for partition in partition_matrices:
+        add_mutation_reversion_block(partition_matrices[partition], partition_block_indicators[partition])
+        for class_idx in partition:
+            for class_matrix, partition_matrix in zip(class_matrices[class_idx], partition_matrices[partition]):
+                class_matrix += partition_matrix
+    
+    mutation_reversion_matrix_map = {}
+    for class_idx in xrange(0,len(site_classes)):
+        mutation_reversion_matrix_map[site_classes[class_idx][0]] = class_matrices[class_idx]
             
-    return mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix    
+    return mutation_reversion_matrix_map    
     
 
 def calculate_fixation_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
@@ -933,7 +1156,7 @@ upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min
     if len(allowed_variant_types)==0:
         allowed_variant_types = set(['1D','2D','3D','4D'])    
                     
-    fixation_matrix_mutation = numpy.zeros_like(passed_sites_map.values()[0].values()[0]['sites'])*1.0 
+    fixation_matrix_mutation = numpy.zeros_like(parse_midas_data.calculate_passed_sites_matrix(passed_sites_map.values()[0].values()[0]))*1.0 
     fixation_matrix_reversion = numpy.zeros_like(fixation_matrix_mutation)*1.0
      
     passed_sites = numpy.zeros_like(fixation_matrix_mutation)*1.0
@@ -945,7 +1168,7 @@ upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min
             if variant_type not in allowed_variant_types:
                 continue
         
-            passed_sites += passed_sites_map[gene_name][variant_type]['sites']
+            passed_sites += parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type])
    
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']                        
             if len(allele_counts)==0:
@@ -1038,7 +1261,7 @@ def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_varian
     if len(allowed_variant_types)==0:
         allowed_variant_types = set(['1D','2D','3D','4D'])    
                     
-    new_snp_matrix = numpy.zeros_like(passed_sites_map.values()[0].values()[0]['sites'])*1.0  
+    new_snp_matrix = numpy.zeros_like(parse_midas_data.calculate_passed_sites_matrix(passed_sites_map.values()[0].values()[0]))*1.0  
     passed_sites = numpy.zeros_like(new_snp_matrix)*1.0
     
     for gene_name in allowed_genes:
@@ -1048,7 +1271,7 @@ def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_varian
             if variant_type not in allowed_variant_types:
                 continue
         
-            passed_sites += passed_sites_map[gene_name][variant_type]['sites']
+            passed_sites += parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type])
    
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']                        
             if len(allele_counts)==0:
@@ -1056,7 +1279,7 @@ def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_varian
             
 
             depths = allele_counts.sum(axis=2)
-            freqs = allele_counts[:,:,0]/(depths+(depths==0))
+            freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
             # turn into minor allele frequencies
             mafs = numpy.fmin(freqs,1-freqs)
             
@@ -1076,47 +1299,105 @@ def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_varian
 
 
    
-def calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=None):
+# max number of sites (summed over genes) in each matrix product
+# of calculate_pi_matrix 
+pi_block_size = 10000
+
+#############
+#
+# Per-site arrays used by calculate_pi_matrix
+#
+# returns (sites x samples) arrays of sites with coverage (passed_depths) 
+# and of pi within each sample (self_pis), and a (sites*alleles x samples)
+# array of allele frequencies, so that
+#
+# einsum('ijk,ilk',freqs,freqs) = dot(freqs.T, freqs)
+#
+# (calculated in double precision, and then cast to dtype)
+#
+#############
+def calculate_pi_site_arrays(allele_counts, dtype=numpy.float64):
+
+    # upcast from compact ints
+    allele_counts = allele_counts*1.0
+
+    depths = allele_counts.sum(axis=2)
+    freqs = allele_counts/(depths+(depths<0.1))[:,:,None]
+    self_freqs = (allele_counts-1)/(depths-1+2*(depths<1.1))[:,:,None]
+    self_pis = ((depths>0)-(freqs*self_freqs).sum(axis=2))
+    
+    num_sites, num_samples, num_alleles = allele_counts.shape
+    freqs = numpy.swapaxes(freqs,1,2).reshape(num_sites*num_alleles, num_samples)
+    
+    return ((depths>0)*1.0).astype(dtype), freqs.astype(dtype), self_pis.astype(dtype)
+
+#############
+#
+# returns pi_matrix, avg_pi_matrix summed over a block of sites 
+# (list of arrays from calculate_pi_site_arrays)
+#
+# (the diagonal of pi_matrix is not filled in)
+#
+#############
+def calculate_pi_block(block_site_arrays):
+
+    passed_depths, freqs, self_pis = [numpy.vstack([site_arrays[k] for site_arrays in block_site_arrays]) for k in xrange(0,3)]
+    
+    # pi between sample j and sample l
+    pi_matrix = numpy.dot(passed_depths.T, passed_depths) - numpy.dot(freqs.T, freqs)
+    
+    # average of pi within sample j and within sample l
+    self_pi_matrix = numpy.dot(self_pis.T, passed_depths)
+    avg_pi_matrix = (self_pi_matrix+self_pi_matrix.T)/2
+    
+    return pi_matrix, avg_pi_matrix
+   
+def calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=None, dtype=numpy.float64):
+# dtype = precision of the per-site arrays and of the matrix products 
+# (e.g. numpy.float32 for speed). Each block of pi_block_size sites is 
+# summed in dtype, and only the totals over blocks are kept in double precision
 
     if allowed_genes == None:
         allowed_genes = set(passed_sites_map.keys())
         
-    pi_matrix = numpy.zeros_like(passed_sites_map[passed_sites_map.keys()[0]][variant_type]['sites'])*1.0
+    pi_matrix = numpy.zeros_like(parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[passed_sites_map.keys()[0]][variant_type]))*1.0
     avg_pi_matrix = numpy.zeros_like(pi_matrix)
     passed_sites = numpy.zeros_like(pi_matrix)
     
+    # Sites from many genes are added together, 
+    # in blocks of up to pi_block_size sites
+    block_site_arrays = []
+    num_block_sites = 0
+    
     for gene_name in allowed_genes:
         
-        if gene_name in passed_sites_map.keys():
-            #print passed_sites_map[gene_name][variant_type].shape, passed_sites.shape
-            #print gene_name, variant_type
+        if gene_name in passed_sites_map:
         
-            passed_sites += passed_sites_map[gene_name][variant_type]['sites']
+            passed_sites += parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type])
            
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']
 
             if len(allele_counts)==0:
                 continue
          
-
-            depths = allele_counts.sum(axis=2)
-            freqs = allele_counts/(depths+(depths<0.1))[:,:,None]
-            self_freqs = (allele_counts-1)/(depths-1+2*(depths<1.1))[:,:,None]
-            self_pis = ((depths>0)-(freqs*self_freqs).sum(axis=2))
-             
-            I,J = depths.shape
-    
-            # pi between sample j and sample l
-            gene_pi_matrix = numpy.einsum('ij,il',(depths>0)*1.0,(depths>0)*1.0)-numpy.einsum('ijk,ilk',freqs,freqs)
-    
-            # average of pi within sample j and within sample i
-            gene_avg_pi_matrix = (numpy.einsum('ij,il',self_pis,(depths>0)*1.0)+numpy.einsum('ij,il',(depths>0)*1.0,self_pis))/2
-    
-            diagonal_idxs = numpy.diag_indices(J)
-            gene_pi_matrix[diagonal_idxs] = gene_avg_pi_matrix[diagonal_idxs]
-    
-            pi_matrix += gene_pi_matrix
-            avg_pi_matrix += gene_avg_pi_matrix
+            block_site_arrays.append( calculate_pi_site_arrays(allele_counts, dtype) )
+            num_block_sites += len(allele_counts)
+            
+            if num_block_sites >= pi_block_size:
+                block_pi_matrix, block_avg_pi_matrix = calculate_pi_block(block_site_arrays)
+                pi_matrix += block_pi_matrix
+                avg_pi_matrix += block_avg_pi_matrix
+                block_site_arrays = []
+                num_block_sites = 0
+    
+    if num_block_sites > 0:
+        block_pi_matrix, block_avg_pi_matrix = calculate_pi_block(block_site_arrays)
+        pi_matrix += block_pi_matrix
+        avg_pi_matrix += block_avg_pi_matrix
+    
+    # (within each sample)
+    diagonal_idxs = numpy.diag_indices(pi_matrix.shape[0])
+    pi_matrix[diagonal_idxs] = avg_pi_matrix[diagonal_idxs]
      
     # We used to normalize here    
     #pi_matrix = pi_matrix /(passed_sites+(passed_sites==0))
@@ -1125,6 +1406,129 @@ def calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D',
     
     return pi_matrix, avg_pi_matrix, passed_sites
 
+###############################################################################
+#
+# Per-gene version of calculate_pi_matrix 
+#
+# Yields (gene_name, pi_matrix, avg_pi_matrix, passed_sites) for each gene 
+# in allowed_genes, same as calculate_pi_matrix(..., allowed_genes=[gene_name]) 
+# (but without setting up a new calculation for each gene). 
+#
+# Unlike calculate_pi_matrix, the matrix products are not batched over genes, 
+# since each gene needs its own matrices. 
+#
+###############################################################################
+def iterate_gene_pi_matrices(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=None, dtype=numpy.float64):
+
+    if allowed_genes == None:
+        allowed_genes = set(passed_sites_map.keys())
+    
+    empty_matrix = numpy.zeros_like(parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[passed_sites_map.keys()[0]][variant_type]))*1.0
+    diagonal_idxs = numpy.diag_indices(empty_matrix.shape[0])
+    
+    for gene_name in allowed_genes:
+    
+        if gene_name not in passed_sites_map:
+            yield gene_name, numpy.zeros_like(empty_matrix), numpy.zeros_like(empty_matrix), numpy.zeros_like(empty_matrix)
+            continue
+        
+        gene_passed_sites = parse_midas_data.calculate_passed_sites_matrix(passed_sites_map[gene_name][variant_type])*1.0
+        
+        allele_counts = allele_counts_map[gene_name][variant_type]['alleles']
+        if len(allele_counts)==0:
+            yield gene_name, numpy.zeros_like(empty_matrix), numpy.zeros_like(empty_matrix), gene_passed_sites
+            continue
+        
+        gene_pi_matrix, gene_avg_pi_matrix = calculate_pi_block([calculate_pi_site_arrays(allele_counts, dtype)])
+        gene_pi_matrix = empty_matrix + gene_pi_matrix
+        gene_avg_pi_matrix = empty_matrix + gene_avg_pi_matrix
+        
+        # (within each sample)
+        gene_pi_matrix[diagonal_idxs] = gene_avg_pi_matrix[diagonal_idxs]
+        
+        yield gene_name, gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites
+
+
+# max number of sites (summed over genes) passed to the matrix functions
+# at once by calculate_matrices_from_snp_genes
+snp_genes_batch_size = 100000
+
+###############################################################################
+#
+# Versions of the matrix functions above that consume the genes from
+# parse_midas_data.parse_snp_genes as they are parsed
+# (so that only a batch of up to snp_genes_batch_size sites is in memory at once, 
+#  and the matrix products still run over many genes at a time)
+#
+# matrix_functions = list of (function, keyword arguments) pairs, where 
+#                    function takes allele_counts_map and passed_sites_map
+#                    and returns a tuple of matrices 
+#                    (e.g. calculate_mutation_reversion_matrix)
+#                    or a map from name -> tuple of matrices
+#                    (e.g. calculate_mutation_reversion_matrices)
+#
+# returns list with the matrices of each function, summed over genes 
+# (None for every function if there were no genes)
+#
+###############################################################################
+def calculate_matrices_from_snp_genes(snp_genes, matrix_functions):
+
+    total_matrices = [None for matrix_function in matrix_functions]
+    
+    def add_batch(allele_counts_map, passed_sites_map):
+        
+        for function_idx in xrange(0,len(matrix_functions)):
+        
+            matrix_function, kwargs = matrix_functions[function_idx]
+            matrices = matrix_function(allele_counts_map, passed_sites_map, **kwargs)
+            
+            if total_matrices[function_idx] is None:
+                total_matrices[function_idx] = matrices
+            elif isinstance(matrices, dict):
+                for name in matrices:
+                    for total_matrix, matrix in zip(total_matrices[function_idx][name], matrices[name]):
+                        total_matrix += matrix
+            else:
+                for total_matrix, matrix in zip(total_matrices[function_idx], matrices):
+                    total_matrix += matrix
+    
+    allele_counts_map = {}
+    passed_sites_map = {}
+    num_batch_sites = 0
+    
+    for gene_name, gene_allele_counts, gene_passed_sites in snp_genes:
+        
+        if gene_name in passed_sites_map:
+            # another run of a gene that is already in the batch
+            # (the matrices are sums over sites, so runs can go in different batches)
+            add_batch(allele_counts_map, passed_sites_map)
+            allele_counts_map = {}
+            passed_sites_map = {}
+            num_batch_sites = 0
+        
+        allele_counts_map[gene_name] = gene_allele_counts
+        passed_sites_map[gene_name] = gene_passed_sites
+        num_batch_sites += sum([len(gene_allele_counts[variant_type]['alleles']) for variant_type in gene_allele_counts.keys()])
+        
+        if num_batch_sites >= snp_genes_batch_size:
+            add_batch(allele_counts_map, passed_sites_map)
+            allele_counts_map = {}
+            passed_sites_map = {}
+            num_batch_sites = 0
+    
+    if len(passed_sites_map) > 0:
+        add_batch(allele_counts_map, passed_sites_map)
+    
+    return total_matrices
+
+def calculate_mutation_reversion_matrix_from_snp_genes(snp_genes, **kwargs):
+    return calculate_matrices_from_snp_genes(snp_genes, [(calculate_mutation_reversion_matrix, kwargs)])[0]
+
+def calculate_singleton_matrix_from_snp_genes(snp_genes, **kwargs):
+    return calculate_matrices_from_snp_genes(snp_genes, [(calculate_singleton_matrix, kwargs)])[0]
+
+def calculate_pi_matrix_from_snp_genes(snp_genes, **kwargs):
+    return calculate_matrices_from_snp_genes(snp_genes, [(calculate_pi_matrix, kwargs)])[0]
 
 
     
@@ -1154,7 +1558,7 @@ def estimate_sfs_naive_binning(allele_counts, target_depth=10):
     allele_counts = allele_counts[depths>0]
     depths = depths[depths>0]
     
-    freqs = allele_counts[:,0]/depths
+    freqs = allele_counts[:,0]*1.0/depths
     
     bins = (numpy.arange(0,target_depth+2)-0.5)/target_depth
     
@@ -1216,7 +1620,8 @@ upper_threshold=config.consensus_upper_threshold, log10_depth_ratio_threshold=co
             if len(allele_counts)==0:
                 continue
 
-            allele_counts = allele_counts[:,[i,j],:]
+            # (upcast from compact ints, counts are returned too)
+            allele_counts = allele_counts[:,[i,j],:]*1.0
             depths = allele_counts.sum(axis=2)
             alt_freqs = allele_counts[:,:,0]/(depths+(depths==0))
     
@@ -1244,6 +1649,9 @@ upper_threshold=config.consensus_upper_threshold, log10_depth_ratio_threshold=co
 #
 # (gene_name, (contig, location), (alt_i, depth_i), (alt_j, depth_j))
 #
+# private_snv_map = map from (contig, location) from calculate_private_snvs.load_private_snv_map
+#                   or sorted array of site keys from calculate_private_snvs.load_private_snv_keys
+#
 def calculate_tracked_private_snvs(i,j,allele_counts_map, passed_sites_map, avg_depth_i, avg_depth_j, private_snv_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
 upper_threshold=config.consensus_upper_threshold, log10_depth_ratio_threshold=config.fixation_log10_depth_ratio_threshold):
 
@@ -1269,7 +1677,8 @@ upper_threshold=config.consensus_upper_threshold, log10_depth_ratio_threshold=co
             if len(allele_counts)==0:
                 continue
 
-            allele_counts = allele_counts[:,[i,j],:]
+            # (upcast from compact ints, counts are returned too)
+            allele_counts = allele_counts[:,[i,j],:]*1.0
             depths = allele_counts.sum(axis=2)
             alt_freqs = allele_counts[:,:,0]/(depths+(depths==0))
     
@@ -1287,13 +1696,17 @@ upper_threshold=config.consensus_upper_threshold, log10_depth_ratio_threshold=co
             
             if len(potential_private_snps)>0:
                 # some candidates for private SNVs
-                for idx in potential_private_snps:
-                    # check to see if it is indeed a private SNV
+                # check to see if they are indeed private SNVs
+                if isinstance(private_snv_map, dict):
+                    private_snps = [idx for idx in potential_private_snps if allele_counts_map[gene_name][variant_type]['locations'][idx] in private_snv_map]
+                else:
+                    # (sorted array of site keys, checked all at once)
+                    private_snps = potential_private_snps[site_key_utils.isin_site_key_set(private_snv_map, allele_counts_map[gene_name][variant_type]['site_keys'][potential_private_snps])]
+                
+                for idx in private_snps:
+                    # it is indeed private! 
                     location_tuple = allele_counts_map[gene_name][variant_type]['locations'][idx]
-                    
-                    if location_tuple in private_snv_map:
-                        # it is indeed private! 
-                        tracked_private_snps.append((gene_name, location_tuple, variant_type, (allele_counts[idx,0,0], depths[idx,0]), (allele_counts[idx,1,0],depths[idx,1]) ))
+                    tracked_private_snps.append((gene_name, location_tuple, variant_type, (allele_counts[idx,0,0], depths[idx,0]), (allele_counts[idx,1,0],depths[idx,1]) ))
             
     return tracked_private_snps
     
@@ -1690,13 +2103,17 @@ def calculate_haploid_samples(species_name, min_coverage=config.min_median_cover
     # New way with pre-computed SFS
     # Load SFS information for species_name
     import sfs_utils
-    samples, sfs_map = parse_midas_data.parse_within_sample_sfs(species_name,     allowed_variant_types=set(['4D'])) 
+    samples, sfs_arrays = parse_midas_data.parse_within_sample_sfs_arrays(species_name,     allowed_variant_types=set(['4D'])) 
+    
+    within_sites, between_sites, total_sites = sfs_utils.calculate_polymorphism_rates_from_sfs_arrays(sfs_arrays)
+    
+    sample_idx_map = {sample: idx for idx, sample in enumerate(samples)}
     
     haploid_samples = []
     for sample in desired_samples:
-        within_sites, between_sites, total_sites = sfs_utils.calculate_polymorphism_rates_from_sfs_map(sfs_map[sample])
+        sample_idx = sample_idx_map[sample]
     
-        if within_sites <= threshold_within_between_fraction*between_sites:
+        if within_sites[sample_idx] <= threshold_within_between_fraction*between_sites[sample_idx]:
             haploid_samples.append(sample)    
             
     return numpy.array(haploid_samples)
@@ -1756,39 +2173,54 @@ def calculate_triple_temporal_samples(species_name, min_coverage=config.min_medi
 
 def calculate_fixation_error_rate(sfs_map, sample_i, sample_j,dfs=[0.6], frequency_bins = numpy.linspace(0,1,21)):
     
+    sfs_arrays = sfs_utils.calculate_sfs_arrays_from_sfs_maps([sample_i, sample_j], sfs_map)
     
-    dfs = numpy.array(dfs)
+    return calculate_fixation_error_rates(sfs_arrays, [sample_i], [sample_j], dfs, frequency_bins)[0]
 
-    dummy_fs, pfs_i = sfs_utils.calculate_binned_sfs_from_sfs_map(sfs_map[sample_i],bins=frequency_bins)
-    dummy_fs, pfs_j = sfs_utils.calculate_binned_sfs_from_sfs_map(sfs_map[sample_j],bins=frequency_bins)
+#######################
+#
+# Same as calculate_fixation_error_rate for many pairs of samples at once
+#
+# returns (pairs x dfs) matrix of perrs
+#
+#######################
+def calculate_fixation_error_rates(sfs_arrays, samples_i, samples_j, dfs=[0.6], frequency_bins = numpy.linspace(0,1,21)):
+    
+    dfs = numpy.array(dfs)
+    
+    # only need distributions for samples in pairs
+    samples = sorted(set(samples_i) | set(samples_j))
+    sfs_arrays = sfs_utils.select_sfs_samples(sfs_arrays, samples)
+    
+    sample_idx_map = {sample: idx for idx, sample in enumerate(samples)}
+    idxs_i = numpy.array([sample_idx_map[sample] for sample in samples_i], dtype=numpy.int64)
+    idxs_j = numpy.array([sample_idx_map[sample] for sample in samples_j], dtype=numpy.int64)
+    
+    dummy_fs, sample_pfs = sfs_utils.calculate_binned_sfs_from_sfs_arrays(sfs_arrays,bins=frequency_bins)
     
     fs = frequency_bins[1:]-(frequency_bins[1]-frequency_bins[0])/2.0
-
-    pfs = (pfs_i+pfs_j)/2.0
+    
+    pfs = (sample_pfs[idxs_i]+sample_pfs[idxs_j])/2.0
     # fold
-    pfs = (pfs+pfs[::-1])/2
+    pfs = (pfs+pfs[:,::-1])/2
     
     # Calculate depth distributions
-    dummy, D1s, pD1s = sfs_utils.calculate_binned_depth_distribution_from_sfs_map(sfs_map[sample_i])
-    dummy, D2s, pD2s = sfs_utils.calculate_binned_depth_distribution_from_sfs_map(sfs_map[sample_j])
-    
-    fs = fs[pfs>0]
-    pfs = pfs[pfs>0]
-    
-    D1s = D1s[pD1s>0]
-    pD1s = pD1s[pD1s>0]
-    D2s = D2s[pD2s>0]
-    pD2s = pD2s[pD2s>0]
+    dummy, Ds, pDs = sfs_utils.calculate_binned_depth_distribution_from_sfs_arrays(sfs_arrays)
     
+    # perr = sum over D1,D2,f of 2*P(D1 fixes at 1-f)*P(D2 fixes at f)*pD1*pD2*pf
+    # The D1 and D2 sums factorize, so we only need one sum over depths
+    # for each sample (weights of empty bins and freqs are zero)
+    def calculate_fixation_probabilities(sample_idxs, fs):
+        
+        # (samples x depths x fs x dfs)
+        sample_Ds = Ds[sample_idxs][:,:,None,None]
+        fixation_probabilities = binom.cdf(sample_Ds*(1-dfs[None,None,None,:])/2, sample_Ds, fs[None,None,:,None])
+        fixation_probabilities = numpy.where(pDs[sample_idxs][:,:,None,None]>0, fixation_probabilities, 0)
+        
+        return (fixation_probabilities*pDs[sample_idxs][:,:,None,None]).sum(axis=1)
     
-    perrs = {df:0 for df in dfs}
-    for D1,pD1 in zip(D1s,pD1s):
-        for D2,pD2 in zip(D2s,pD2s):
-            for f,pf in zip(fs,pfs):
-                for df in dfs:
-                    perrs[df] += 2*binom.cdf(D1*(1-df)/2, D1, f)*binom.cdf(D2*(1-df)/2, D2, 1-f)*pD1*pD2*pf
+    perrs = 2*(calculate_fixation_probabilities(idxs_i, fs)*calculate_fixation_probabilities(idxs_j, 1-fs)*pfs[:,:,None]).sum(axis=1)
     
-    perrs = numpy.array([perrs[df] for df in dfs])
     return perrs
 
 
@@ -0,0 +1,71 @@
+###############################################################################
+#
+# Memoized loading of metadata tables
+#
+# Species lists, marker gene coverages and sample metadata are parsed from
+# the same text (or bz2) files by almost every script, often many times
+# per run (e.g. parse_good_species_list inside species loops).
+# load_cached_metadata keeps each parsed table in memory for the rest of
+# the process, and as a pickled snapshot on disk (metadata_cache/ in the
+# data directory) for later processes. Both are keyed by the sizes and
+# mtimes of the source files, so a table is re-parsed whenever one of its
+# source files changes.
+#
+###############################################################################
+import cPickle
+import sys
+import os
+import os.path
+
+import config
+from snp_store_utils import calculate_source_stamp
+
+metadata_cache_directory = "%smetadata_cache/" % config.data_directory
+
+# map from name -> (source stamp, pickled metadata)
+memoized_metadata = {}
+
+#############
+#
+# Returns parse_function() for the metadata table called name,
+# which is parsed from source_filenames
+#
+# (every call returns a new copy, so callers can modify it)
+#
+#############
+def load_cached_metadata(name, source_filenames, parse_function):
+
+    source_stamp = ",".join([calculate_source_stamp(filename) for filename in source_filenames])
+
+    if name in memoized_metadata and memoized_metadata[name][0]==source_stamp:
+        return cPickle.loads(memoized_metadata[name][1])
+
+    snapshot_filename = "%s%s.pkl" % (metadata_cache_directory, name)
+
+    pickled_metadata = None
+    if os.path.isfile(snapshot_filename):
+        file = open(snapshot_filename,"rb")
+        if file.readline().strip()==source_stamp:
+            pickled_metadata = file.read()
+        file.close()
+
+    if pickled_metadata is None:
+
+        pickled_metadata = cPickle.dumps(parse_function(), cPickle.HIGHEST_PROTOCOL)
+
+        try:
+            os.system('mkdir -p %s' % metadata_cache_directory)
+            # (written to a temporary file first so that
+            #  other processes never see a partial snapshot)
+            tmp_filename = "%s.%d.tmp" % (snapshot_filename, os.getpid())
+            file = open(tmp_filename,"wb")
+            file.write(source_stamp+"\n")
+            file.write(pickled_metadata)
+            file.close()
+            os.rename(tmp_filename, snapshot_filename)
+        except (IOError, OSError):
+            sys.stderr.write("Warning: could not write metadata snapshot %s\n" % snapshot_filename)
+
+    memoized_metadata[name] = (source_stamp, pickled_metadata)
+
+    return cPickle.loads(pickled_metadata)
@@ -0,0 +1,437 @@
+###############################################################################
+#
+# Indexed (SQLite) store for MIDAS database metadata
+#
+# The centroid/gene maps, reference genes, representative genomes and
+# taxonomy used to be re-read from midas_db (gene_info.txt.gz,
+# genome.features.gz, species_info.txt, genome_info.txt and
+# genome_taxonomy.txt) on every call. These files are now ingested once
+# into a single SQLite database (midas_db_store.sqlite in the data
+# directory), which can be queried by species, gene, centroid or genome.
+#
+# Each table is ingested on first use (or all at once by running this
+# script), and re-ingested whenever its source files change.
+#
+###############################################################################
+import sqlite3
+import gzip
+import sys
+import os
+import os.path
+
+import config
+from snp_store_utils import calculate_source_stamp
+
+midas_db_store_filename = "%smidas_db_store.sqlite" % config.data_directory
+
+# seconds to wait for another process that is ingesting into the store
+store_timeout = 600
+
+store_schema = """
+CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, stamp TEXT);
+
+CREATE TABLE IF NOT EXISTS gene_info (species_id TEXT, row INTEGER, gene_id TEXT, genome_id TEXT, centroid_99 TEXT, centroid_95 TEXT, PRIMARY KEY (species_id, row));
+CREATE INDEX IF NOT EXISTS gene_info_gene_idx ON gene_info (species_id, gene_id);
+CREATE INDEX IF NOT EXISTS gene_info_centroid_idx ON gene_info (species_id, centroid_95);
+
+CREATE TABLE IF NOT EXISTS centroid_genes (species_id TEXT, centroid_id TEXT, gene_id TEXT, PRIMARY KEY (species_id, centroid_id));
+
+CREATE TABLE IF NOT EXISTS reference_genes (species_id TEXT, gene_id TEXT, PRIMARY KEY (species_id, gene_id));
+
+CREATE TABLE IF NOT EXISTS species_info (row INTEGER PRIMARY KEY, species_id TEXT, rep_genome_id TEXT);
+CREATE INDEX IF NOT EXISTS species_info_species_idx ON species_info (species_id);
+
+CREATE TABLE IF NOT EXISTS genome_info (row INTEGER PRIMARY KEY, genome_id TEXT, species_id TEXT, rep_genome TEXT);
+CREATE INDEX IF NOT EXISTS genome_info_species_idx ON genome_info (species_id);
+
+CREATE TABLE IF NOT EXISTS genome_taxonomy (row INTEGER PRIMARY KEY, genome_id TEXT, kingdom TEXT, phylum TEXT, class_name TEXT, order_name TEXT, family TEXT, genus TEXT);
+CREATE INDEX IF NOT EXISTS genome_taxonomy_genome_idx ON genome_taxonomy (genome_id);
+"""
+
+def get_gene_info_filename(species_name):
+    return "%span_genomes/%s/gene_info.txt.gz" % (config.midas_directory, species_name)
+
+def get_features_filename(species_name):
+    return "%srep_genomes/%s/genome.features.gz" % (config.midas_directory, species_name)
+
+# (process id, connection), so that forked processes open their own
+store_connection = (None, None)
+
+def connect_midas_db_store():
+
+    global store_connection
+
+    if store_connection[0]==os.getpid():
+        return store_connection[1]
+
+    try:
+        connection = sqlite3.connect(midas_db_store_filename, timeout=store_timeout, isolation_level=None)
+        connection.executescript(store_schema)
+    except sqlite3.Error:
+        # (e.g. read-only data directory) still works, but is re-ingested every run
+        sys.stderr.write("Warning: could not open %s, using in-memory store\n" % midas_db_store_filename)
+        connection = sqlite3.connect(":memory:", isolation_level=None)
+        connection.executescript(store_schema)
+
+    # return plain strings like the text parsers did
+    connection.text_factory = str
+
+    store_connection = (os.getpid(), connection)
+    return connection
+
+#############
+#
+# Makes sure that table(s) for source_name are up to date with
+# source_filenames, calling ingest_function(connection) if not
+#
+# returns connection to the store
+#
+#############
+def update_source(source_name, source_filenames, ingest_function):
+
+    connection = connect_midas_db_store()
+
+    source_stamp = ",".join([calculate_source_stamp(filename) for filename in source_filenames])
+
+    def get_stored_stamp():
+        row = connection.execute("SELECT stamp FROM sources WHERE name=?", (source_name,)).fetchone()
+        if row==None:
+            return None
+        else:
+            return row[0]
+
+    if get_stored_stamp()==source_stamp:
+        return connection
+
+    # lock the store, then check again in case
+    # another process ingested it while we were waiting
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        if get_stored_stamp()!=source_stamp:
+            sys.stderr.write("Ingesting %s into midas_db store...\n" % source_name)
+            ingest_function(connection)
+            connection.execute("INSERT OR REPLACE INTO sources VALUES (?,?)", (source_name, source_stamp))
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+
+    return connection
+
+###############################################################################
+#
+# Ingestion of individual midas_db files
+#
+###############################################################################
+
+def update_reference_genes(species_name):
+
+    features_filename = get_features_filename(species_name)
+
+    def ingest(connection):
+
+        features_file = gzip.open(features_filename, 'r')
+        features_file.readline() # header
+        gene_names = [line.split()[0].strip() for line in features_file]
+        features_file.close()
+
+        connection.execute("DELETE FROM reference_genes WHERE species_id=?", (species_name,))
+        connection.executemany("INSERT OR IGNORE INTO reference_genes VALUES (?,?)", ((species_name, gene_name) for gene_name in gene_names))
+
+    return update_source("features/%s" % species_name, [features_filename], ingest)
+
+def update_gene_info(species_name):
+
+    # centroid_genes depends on the reference genes too
+    update_reference_genes(species_name)
+
+    gene_info_filename = get_gene_info_filename(species_name)
+
+    def ingest(connection):
+
+        reference_genes = set(gene_name for (gene_name,) in connection.execute("SELECT gene_id FROM reference_genes WHERE species_id=?", (species_name,)))
+
+        gene_info_file = gzip.open(gene_info_filename, 'r')
+        gene_info_file.readline() # header
+
+        gene_info = []
+        centroid_gene_map = {}
+
+        for line in gene_info_file:
+
+            items = line.split("\t")
+            gene_id = items[0].strip()
+            genome_id = items[1].strip()
+            centroid_99 = items[2].strip()
+            centroid_95 = items[3].strip()
+
+            gene_info.append((species_name, len(gene_info), gene_id, genome_id, centroid_99, centroid_95))
+
+            # The gene_ids in the pangenome list are the centroids of gene clusters.
+            # Sometimes the gene in the reference genome is not chosen as the centroid.
+            # Map centroids to the gene in the reference genome (if it exists)
+            if centroid_95 not in centroid_gene_map:
+                centroid_gene_map[centroid_95] = centroid_95
+
+            if (gene_id in reference_genes) and (centroid_95 not in reference_genes):
+                centroid_gene_map[centroid_95] = gene_id
+
+        gene_info_file.close()
+
+        connection.execute("DELETE FROM gene_info WHERE species_id=?", (species_name,))
+        connection.execute("DELETE FROM centroid_genes WHERE species_id=?", (species_name,))
+        connection.executemany("INSERT INTO gene_info VALUES (?,?,?,?,?,?)", gene_info)
+        connection.executemany("INSERT INTO centroid_genes VALUES (?,?,?)", ((species_name, centroid_id, gene_id) for centroid_id, gene_id in centroid_gene_map.iteritems()))
+
+    return update_source("gene_info/%s" % species_name, [gene_info_filename, get_features_filename(species_name)], ingest)
+
+def update_species_info():
+
+    species_info_filename = "%sspecies_info.txt" % config.midas_directory
+
+    def ingest(connection):
+
+        species_info_file = open(species_info_filename, "r")
+        species_info_file.readline() # header
+        species_info = []
+        for line in species_info_file:
+            items = line.split("\t")
+            species_info.append((items[0].strip(), items[1].strip()))
+        species_info_file.close()
+
+        connection.execute("DELETE FROM species_info")
+        connection.executemany("INSERT INTO species_info (species_id, rep_genome_id) VALUES (?,?)", species_info)
+
+    return update_source("species_info", [species_info_filename], ingest)
+
+def update_genome_info():
+
+    genome_info_filename = "%sgenome_info.txt" % config.midas_directory
+
+    def ingest(connection):
+
+        genome_info_file = open(genome_info_filename, "r")
+        genome_info_file.readline() # header
+        genome_info = []
+        for line in genome_info_file:
+            items = line.split("\t")
+            # (rep_genome is kept unstripped, as in genome_ids_dictionary)
+            genome_info.append((items[0].strip(), items[5].strip(), items[2]))
+        genome_info_file.close()
+
+        connection.execute("DELETE FROM genome_info")
+        connection.executemany("INSERT INTO genome_info (genome_id, species_id, rep_genome) VALUES (?,?,?)", genome_info)
+
+    return update_source("genome_info", [genome_info_filename], ingest)
+
+def update_genome_taxonomy():
+
+    taxonomy_filename = "%sgenome_taxonomy.txt" % config.midas_directory
+
+    def ingest(connection):
+
+        taxonomy_file = open(taxonomy_filename, "r")
+        taxonomy_file.readline() # header
+        taxonomy = []
+        for line in taxonomy_file:
+            items = line.split("\t")
+            taxonomy.append(tuple([items[0].strip()]+[item.strip() for item in items[3:9]]))
+        taxonomy_file.close()
+
+        connection.execute("DELETE FROM genome_taxonomy")
+        connection.executemany("INSERT INTO genome_taxonomy (genome_id, kingdom, phylum, class_name, order_name, family, genus) VALUES (?,?,?,?,?,?,?)", taxonomy)
+
+    return update_source("genome_taxonomy", [taxonomy_filename], ingest)
+
+###############################################################################
+#
+# Queries
+#
+###############################################################################
+
+#############
+#
+# Set of genes in the reference genome used by MIDAS for species
+#
+#############
+def load_reference_genes(species_name):
+    connection = update_reference_genes(species_name)
+    return set(gene_name for (gene_name,) in connection.execute("SELECT gene_id FROM reference_genes WHERE species_id=?", (species_name,)))
+
+#############
+#
+# Map from pangenome centroids (95% clusters) to the gene in the
+# reference genome in the same cluster (or the centroid itself)
+#
+#############
+def load_centroid_gene_map(species_name):
+    connection = update_gene_info(species_name)
+    return dict(connection.execute("SELECT centroid_id, gene_id FROM centroid_genes WHERE species_id=?", (species_name,)))
+
+def get_centroid_gene(species_name, centroid_id):
+    connection = update_gene_info(species_name)
+    row = connection.execute("SELECT gene_id FROM centroid_genes WHERE species_id=? AND centroid_id=?", (species_name, centroid_id)).fetchone()
+    if row==None:
+        return None
+    return row[0]
+
+#############
+#
+# Map from every gene in the pangenome to its (reference corrected) centroid
+#
+#############
+def load_gene_centroid_map(species_name):
+    connection = update_gene_info(species_name)
+    # (ordered so that the last occurrence of a gene wins)
+    return dict(connection.execute("SELECT gene_info.gene_id, centroid_genes.gene_id FROM gene_info JOIN centroid_genes ON centroid_genes.species_id=gene_info.species_id AND centroid_genes.centroid_id=gene_info.centroid_95 WHERE gene_info.species_id=? ORDER BY gene_info.row", (species_name,)))
+
+def get_gene_centroid(species_name, gene_id):
+    connection = update_gene_info(species_name)
+    row = connection.execute("SELECT centroid_genes.gene_id FROM gene_info JOIN centroid_genes ON centroid_genes.species_id=gene_info.species_id AND centroid_genes.centroid_id=gene_info.centroid_95 WHERE gene_info.species_id=? AND gene_info.gene_id=? ORDER BY gene_info.row DESC LIMIT 1", (species_name, gene_id)).fetchone()
+    if row==None:
+        return None
+    return row[0]
+
+#############
+#
+# Map from centroid to list of ALL genes in its 95% cluster
+#
+#############
+def load_complete_centroid_gene_map(species_name):
+    connection = update_gene_info(species_name)
+    complete_centroid_gene_map = {}
+    for centroid_id, gene_id in connection.execute("SELECT centroid_95, gene_id FROM gene_info WHERE species_id=? ORDER BY row", (species_name,)):
+        if centroid_id not in complete_centroid_gene_map:
+            complete_centroid_gene_map[centroid_id] = [gene_id]
+        else:
+            complete_centroid_gene_map[centroid_id].append(gene_id)
+    return complete_centroid_gene_map
+
+def get_cluster_genes(species_name, centroid_id):
+    connection = update_gene_info(species_name)
+    return [gene_id for (gene_id,) in connection.execute("SELECT gene_id FROM gene_info WHERE species_id=? AND centroid_95=? ORDER BY row", (species_name, centroid_id))]
+
+#############
+#
+# Map from genome_id -> gene_id -> (centroid_99, centroid_95)
+#
+#############
+def get_pangenome_map(species_name):
+    connection = update_gene_info(species_name)
+    pangenome_map = {}
+    for genome_id, gene_id, centroid_99, centroid_95 in connection.execute("SELECT genome_id, gene_id, centroid_99, centroid_95 FROM gene_info WHERE species_id=? ORDER BY row", (species_name,)):
+        if genome_id not in pangenome_map:
+            pangenome_map[genome_id] = {}
+        pangenome_map[genome_id][gene_id] = (centroid_99, centroid_95)
+    return pangenome_map
+
+def get_number_of_genomes(species_name):
+    connection = update_gene_info(species_name)
+    return connection.execute("SELECT COUNT(DISTINCT genome_id) FROM gene_info WHERE species_id=?", (species_name,)).fetchone()[0]
+
+#############
+#
+# Genome id of the representative genome of species (None if not found)
+#
+#############
+def get_representative_genome_id(species_name):
+    connection = update_species_info()
+    row = connection.execute("SELECT rep_genome_id FROM species_info WHERE species_id=? ORDER BY row LIMIT 1", (species_name,)).fetchone()
+    if row==None:
+        return None
+    return row[0]
+
+#############
+#
+# List of all genome_ids of reference genomes of species
+#
+#############
+def get_ref_genome_ids(species_name):
+    connection = update_genome_info()
+    return [genome_id for (genome_id,) in connection.execute("SELECT genome_id FROM genome_info WHERE species_id=? ORDER BY row", (species_name,))]
+
+#############
+#
+# Map from every genome_id to [species_id, rep_genome]
+#
+#############
+def load_genome_ids_dictionary():
+    connection = update_genome_info()
+    return {genome_id: [species_id, rep_genome] for genome_id, species_id, rep_genome in connection.execute("SELECT genome_id, species_id, rep_genome FROM genome_info ORDER BY row")}
+
+#############
+#
+# Taxonomy of the representative genome of species
+#
+# returns (kingdom,phylum,class,order,family,genus) or None if not found
+#
+#############
+def get_species_taxonomy(species_name):
+
+    update_species_info()
+    connection = update_genome_taxonomy()
+
+    rep_genome_id = get_representative_genome_id(species_name)
+    if rep_genome_id==None:
+        return None
+
+    row = connection.execute("SELECT kingdom, phylum, class_name, order_name, family, genus FROM genome_taxonomy WHERE genome_id=? ORDER BY row DESC LIMIT 1", (rep_genome_id,)).fetchone()
+    if row==None:
+        return None
+    return tuple(row)
+
+#############
+#
+# Map from species -> (kingdom,phylum,class,order,family,genus)
+#
+#############
+def get_taxonomy_map():
+
+    update_species_info()
+    connection = update_genome_taxonomy()
+
+    # (last species wins if several share a representative genome)
+    genome_species_map = {genome_id: species_name for species_name, genome_id in connection.execute("SELECT species_id, rep_genome_id FROM species_info ORDER BY row")}
+
+    species_taxonomy_map = {}
+    for row in connection.execute("SELECT genome_id, kingdom, phylum, class_name, order_name, family, genus FROM genome_taxonomy ORDER BY row"):
+        if row[0] in genome_species_map:
+            species_taxonomy_map[genome_species_map[row[0]]] = tuple(row[1:])
+
+    return species_taxonomy_map
+
+###############################################################################
+#
+# Ingests all metadata for species (or all species in midas_db)
+#
+###############################################################################
+def build_midas_db_store(species_names=None):
+
+    if species_names==None:
+        species_names = [species_name for species_name in os.listdir(config.midas_directory+"pan_genomes") if not species_name.startswith('.')]
+
+    for filename, update_function in [("species_info.txt", update_species_info), ("genome_info.txt", update_genome_info), ("genome_taxonomy.txt", update_genome_taxonomy)]:
+        if os.path.isfile(config.midas_directory+filename):
+            update_function()
+
+    for species_name in species_names:
+        update_gene_info(species_name)
+
+    sys.stderr.write("Done! midas_db store has %d species\n" % len(species_names))
+
+if __name__=='__main__':
+
+    ################################################################################
+    #
+    # Standard header to read in argument information
+    #
+    ################################################################################
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--species", help="Ingests only these species (default: all species in midas_db)", nargs='*', default=None)
+    args = parser.parse_args()
+
+    species_names = args.species
+    ################################################################################
+
+    build_midas_db_store(species_names)
@@ -2,6 +2,7 @@ import config
 import gzip
 import os
 import os.path
+import midas_db_store_utils
 
 ###############################################################################
 #
@@ -9,45 +10,13 @@ import os.path
 #
 ###############################################################################
 def load_reference_genes(desired_species_name):
-    
-    features_file = gzip.open("%srep_genomes/%s/genome.features.gz" % (config.midas_directory, desired_species_name), 'r')
-    
-    features_file.readline() # header
-    reference_genes = []
-    for line in features_file:
-        items = line.split()
-        gene_name = items[0].strip()
-        reference_genes.append(gene_name)
-    features_file.close()    
-    
-    return set(reference_genes)
+    return midas_db_store_utils.load_reference_genes(desired_species_name)
 
 def get_pangenome_map(species_name):
-    
-    gene_info_filename = '%span_genomes/%s/gene_info.txt.gz' % (config.midas_directory, species_name)
-    file = gzip.open(gene_info_filename, 'r')
-    file.readline() # header
-    
-    pangenome_map = {}
-    
-    for line in file:
-        items = line.split("\t")
-        gene_id = items[0].strip()
-        genome_id = items[1].strip()
-        centroid_99 = items[2].strip()
-        centroid_95 = items[3].strip()
-        
-        if genome_id not in pangenome_map:
-            pangenome_map[genome_id] = {}
-        
-        pangenome_map[genome_id][gene_id] = (centroid_99, centroid_95)
-        
-    file.close()
-    return pangenome_map
-    
+    return midas_db_store_utils.get_pangenome_map(species_name)
+
 def get_number_of_genomes(species_name):
-    
-    return len(get_pangenome_map(species_name))
+    return midas_db_store_utils.get_number_of_genomes(species_name)
 
 def parse_species_list():
     
@@ -78,33 +47,11 @@ def load_centroid_gene_map(desired_species_name=None):
         desired_speciess = [desired_species_name]
     
     for desired_species_name in desired_speciess:
-        # First load reference genes
-        reference_genes = load_reference_genes(desired_species_name)
-    
-        gene_info_file = gzip.open("%span_genomes/%s/gene_info.txt.gz" % (config.midas_directory, desired_species_name), 'r')
-    
-        gene_info_file.readline() # header
-    
-        centroid_gene_map = {}
-    
-        for line in gene_info_file:
-        
-            items = line.split("\t") 
-            gene_id = items[0].strip()
-            centroid_id = items[3].strip()
-        
-            if centroid_id not in centroid_gene_map:
-                centroid_gene_map[centroid_id] = centroid_id
-            
-            if (gene_id in reference_genes) and (centroid_id not in reference_genes):
-                centroid_gene_map[centroid_id] = gene_id
-            
-        
-        gene_info_file.close()
+        centroid_gene_map = midas_db_store_utils.load_centroid_gene_map(desired_species_name)
     
     return centroid_gene_map
     
-    
+
 def parse_midas_shared_genes(desired_species):
     
     midas_shared_genes = set()
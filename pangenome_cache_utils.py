@@ -0,0 +1,158 @@
+###############################################################################
+#
+# Memory-mapped binary cache for MIDAS's pangenome (genes) data
+#
+# parse_midas_data.parse_pangenome_data used to decompress and parse
+# genes_reads, genes_depth and genes_presabs
+# on every call. The first call now converts them into a directory of .npy
+# arrays (genes/<species>/pangenome_cache/), together with the samples,
+# the gene names and the marker coverages.
+# Later calls memory-map the cache and only read the desired sample columns.
+#
+# The cache is rebuilt whenever one of its source files changes.
+#
+###############################################################################
+import numpy
+import sys
+import os
+import os.path
+
+import config
+import bz2_utils
+import sample_utils
+from snp_store_utils import calculate_source_stamp, read_cache_stamp, write_cache_directory, write_string_list, read_string_list
+
+pangenome_cache_directory_template = "%sgenes/%s/pangenome_cache/"
+
+# matrices stored in the cache
+# (name in cache -> MIDAS genes file)
+matrix_filenames = [('reads', 'genes_reads.txt.bz2'), ('depths', 'genes_depth.txt.bz2'), ('presabs', 'genes_presabs.txt.bz2')]
+
+def get_pangenome_cache_directory(species_name):
+    return pangenome_cache_directory_template % (config.data_directory, species_name)
+
+#############
+#
+# Returns a string that changes whenever one of the files the cache
+# was built from is rewritten (used to invalidate the cache)
+#
+#############
+def calculate_pangenome_source_stamp(species_name):
+
+    source_filenames = ["%sgenes/%s/%s" % (config.data_directory, species_name, filename) for name, filename in matrix_filenames]
+    source_filenames.append("%sgenes/%s/genes_summary.txt" % (config.data_directory, species_name))
+
+    return ",".join([calculate_source_stamp(filename) for filename in source_filenames])
+
+def pangenome_cache_exists(species_name):
+    return read_cache_stamp(get_pangenome_cache_directory(species_name)) == calculate_pangenome_source_stamp(species_name)
+
+###############################################################################
+#
+# Parses the MIDAS genes files
+#
+# returns map with 'samples', 'gene_names', 'marker_coverages', 
+# and genes x samples matrices 'reads', 'depths', and 'presabs'
+#
+###############################################################################
+def parse_pangenome_files(species_name):
+
+    # First read through gene_summary_file to get marker gene coverages
+    gene_summary_file = file("%sgenes/%s/genes_summary.txt" % (config.data_directory, species_name),"r")
+    gene_summary_file.readline() # header
+    marker_coverage_samples = []
+    marker_coverages = []
+    for summary_line in gene_summary_file:
+        items = summary_line.split()
+        marker_coverage_samples.append(items[0].strip())
+        marker_coverages.append(float(items[5]))
+    gene_summary_file.close()
+
+    marker_coverage_samples = sample_utils.parse_merged_sample_names(marker_coverage_samples)
+    marker_coverage_map = {sample: marker_coverage for sample,marker_coverage in zip(marker_coverage_samples, marker_coverages)}
+
+    gene_files = [bz2_utils.open_bz2_file("%sgenes/%s/%s" % (config.data_directory, species_name, filename)) for name, filename in matrix_filenames]
+
+    header_lines = [gene_file.readline() for gene_file in gene_files]
+    # (samples come from genes_presabs)
+    samples = sample_utils.parse_merged_sample_names(header_lines[-1].split()[1:])
+
+    # ordered vector of marker coverages (guaranteed to be in same order as samples)
+    marker_coverages = numpy.array([marker_coverage_map[sample] for sample in samples])
+
+    gene_names = []
+    matrices = [[] for gene_file in gene_files]
+
+    lines = [gene_file.readline() for gene_file in gene_files]
+    while lines[0]!="":
+
+        for line, matrix in zip(lines, matrices):
+            name, value_str = line.split(None,1)
+            matrix.append(numpy.fromstring(value_str, sep=" "))
+
+        gene_names.append(lines[-1].split(None,1)[0])
+
+        lines = [gene_file.readline() for gene_file in gene_files]
+
+    for gene_file in gene_files:
+        gene_file.close()
+
+    pangenome_data = {}
+    pangenome_data['samples'] = samples
+    pangenome_data['gene_names'] = gene_names
+    pangenome_data['marker_coverages'] = marker_coverages
+
+    for (name, filename), matrix in zip(matrix_filenames, matrices):
+        pangenome_data[name] = numpy.array(matrix, dtype=numpy.float64)
+
+    return pangenome_data
+
+###############################################################################
+#
+# Builds the cache from the MIDAS genes files
+#
+# returns the (in memory) parsed data, see parse_pangenome_files
+#
+###############################################################################
+def create_pangenome_cache(species_name):
+
+    source_stamp = calculate_pangenome_source_stamp(species_name)
+
+    sys.stderr.write("Creating pangenome cache for %s...\n" % species_name)
+    pangenome_data = parse_pangenome_files(species_name)
+
+    def write_pangenome_cache(cache_directory):
+
+        write_string_list(cache_directory+"samples.txt", pangenome_data['samples'])
+        write_string_list(cache_directory+"gene_names.txt", pangenome_data['gene_names'])
+
+        numpy.save(cache_directory+"marker_coverages.npy", pangenome_data['marker_coverages'])
+        for name, filename in matrix_filenames:
+            # column-major, so that a subset of sample columns is contiguous on disk
+            numpy.save(cache_directory+name+".npy", numpy.asfortranarray(pangenome_data[name]))
+
+    if write_cache_directory(get_pangenome_cache_directory(species_name), source_stamp, write_pangenome_cache):
+        sys.stderr.write("Done! Cached %d genes\n" % len(pangenome_data['gene_names']))
+
+    return pangenome_data
+
+###############################################################################
+#
+# Loads the (memory-mapped) cache
+#
+# returns map with same keys as parse_pangenome_files
+#
+###############################################################################
+def load_pangenome_cache(species_name):
+
+    cache_directory = get_pangenome_cache_directory(species_name)
+
+    pangenome_data = {}
+    pangenome_data['samples'] = numpy.array(read_string_list(cache_directory+"samples.txt"))
+    pangenome_data['gene_names'] = read_string_list(cache_directory+"gene_names.txt")
+
+    pangenome_data['marker_coverages'] = numpy.load(cache_directory+"marker_coverages.npy")
+    for name, filename in matrix_filenames:
+        pangenome_data[name] = numpy.load(cache_directory+name+".npy", mmap_mode='r')
+
+    return pangenome_data
@@ -1,5 +1,6 @@
 import numpy
 import parse_midas_data
+import metadata_cache_utils
 
 def parse_isolate_metadata_map():
     
@@ -38,10 +39,19 @@ def parse_isolate_metadata_map():
 # Loads metadata for HMP samples 
 # Returns map from sample -> (subject_id, sample_id, accession_id, country, continent, temporal_order)
 #
+# (memoized, see metadata_cache_utils)
+#
 ###############################################################################
+sample_metadata_filenames = ["HMP1-2_ids_order.txt", "qin_ids.txt", "kuleshov_ids.txt", "twin_ids_order.txt", "korpela_twin_ids.txt"]
+
 def parse_sample_metadata_map(): 
     import config
     
+    return metadata_cache_utils.load_cached_metadata("sample_metadata_map", [config.scripts_directory+filename for filename in sample_metadata_filenames], parse_sample_metadata_files)
+    
+def parse_sample_metadata_files(): 
+    import config
+    
     sample_metadata_map = {}
     
     # First load HMP metadata
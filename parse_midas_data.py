@@ -2,6 +2,14 @@ import numpy
 import sys
 import bz2
 import gzip
+import bisect
+import bz2_utils
+import pangenome_cache_utils
+import centroid_fasta_utils
+import metadata_cache_utils
+import midas_db_store_utils
+import site_key_utils
+import sfs_utils
 import os.path 
 import stats_utils 
 from math import floor, ceil
@@ -37,8 +45,13 @@ from sample_utils import *
 #
 # Returns a list of all species that MIDAS called SNPS for
 #
+# (memoized, see metadata_cache_utils)
+#
 #############
 def parse_species_list():
+    return metadata_cache_utils.load_cached_metadata("species_list", [data_directory+"snps/species_snps.txt"], parse_species_list_file)
+
+def parse_species_list_file():
     
     species_names = []
     
@@ -97,12 +110,17 @@ def parse_good_species_list(min_marker_coverage=config.good_species_min_coverage
 #          with species sorted in descending order of total coverage;
 #          ordered list of sample ids; ordered list of species names;
 #
+# (memoized, see metadata_cache_utils)
+#
 ###############################################################################
 def parse_global_marker_gene_coverages():
+    return metadata_cache_utils.load_cached_metadata("global_marker_gene_coverages", ["%sspecies/coverage.txt.bz2" % data_directory, data_directory+"snps/species_snps.txt"], parse_global_marker_gene_coverages_file)
+
+def parse_global_marker_gene_coverages_file():
 
     desired_species_names = set(parse_species_list())
 
-    file = bz2.BZ2File("%sspecies/coverage.txt.bz2" %  (data_directory),"r")
+    file = bz2_utils.open_bz2_file("%sspecies/coverage.txt.bz2" %  (data_directory))
     line = file.readline() # header
     samples = line.split()[1:]
     species = []
@@ -312,6 +330,31 @@ def calculate_absolute_depth_threshold_map(species_coverage_vector, samples, avg
     return depth_threshold_map
   
 
+#############
+#
+# Reads up to num_lines lines from file
+# (returns fewer if file ends)
+#
+#############
+def read_line_batch(file, num_lines):
+    lines = []
+    for i in xrange(0,num_lines):
+        line = file.readline()
+        if line=="":
+            break
+        lines.append(line)
+    return lines
+
+#############
+#
+# Converts numeric columns of a batch of "site_id<tab>x1<tab>x2..." lines
+# to a (lines x columns) matrix in a single pass
+#
+#############
+def parse_numeric_line_batch(lines):
+    values = numpy.fromstring(" ".join([line.split(None,1)[1] for line in lines]), sep=" ")
+    return values.reshape((len(lines), -1))
+
 ###############################################################################
 #
 # Reads midas output and prints to stdout in a format 
@@ -319,8 +362,63 @@ def calculate_absolute_depth_threshold_map(species_coverage_vector, samples, avg
 #
 # In the process, filters sites that fail to meet the depth requirements
 #
+# Sites are processed in batches of batch_size lines, which are parsed
+# and filtered as numpy arrays
+#
 ###############################################################################
-def pipe_snps(species_name, min_nonzero_median_coverage=config.pipe_snps_min_nonzero_median_coverage, lower_factor=config.pipe_snps_lower_depth_factor, upper_factor=config.pipe_snps_upper_depth_factor, min_samples=config.pipe_snps_min_samples, debug=False):
+def pipe_snps(species_name, min_nonzero_median_coverage=config.pipe_snps_min_nonzero_median_coverage, lower_factor=config.pipe_snps_lower_depth_factor, upper_factor=config.pipe_snps_upper_depth_factor, min_samples=config.pipe_snps_min_samples, debug=False, batch_size=config.pipe_snps_batch_size):
+
+    for batch_idx, (samples, site_id_strs, alts, depths) in enumerate(iterate_pipe_snps_batches(species_name, min_nonzero_median_coverage, lower_factor, upper_factor, min_samples, debug, batch_size)):
+        
+        if batch_idx==0:
+            # print header
+            print_str = "\t".join(["site_id"]+samples)
+            print print_str
+        
+        print_strs = format_pipe_snps_lines(site_id_strs, alts, depths)
+        if len(print_strs) > 0:
+            print "\n".join(print_strs)
+    
+    # returns nothing
+
+#############
+#
+# Formats filtered sites as lines of the annotated SNPs file 
+# (without trailing newlines). If pvalues are supplied, they 
+# are appended to the site ids.
+#
+#############
+def format_pipe_snps_lines(site_id_strs, alts, depths, pvalues=None):
+    
+    num_samples = alts.shape[1]
+    
+    # each line is formatted with a single string operation
+    if pvalues is None:
+        print_format = "\t".join(["%s"]+["%g,%g"]*num_samples)
+    else:
+        print_format = "\t".join(["%s|%g"]+["%g,%g"]*num_samples)
+    
+    # interleave (A,D) for each sample
+    read_counts = numpy.zeros((len(site_id_strs), 2*num_samples))
+    read_counts[:,0::2] = alts
+    read_counts[:,1::2] = depths
+    
+    if pvalues is None:
+        return [print_format % tuple([site_id_str]+site_read_counts) for site_id_str, site_read_counts in zip(site_id_strs, read_counts.tolist())]
+    else:
+        return [print_format % tuple([site_id_str, pvalue]+site_read_counts) for site_id_str, pvalue, site_read_counts in zip(site_id_strs, pvalues, read_counts.tolist())]
+
+###############################################################################
+#
+# Does the work for pipe_snps
+#
+# Yields (samples, site_id_strs, alts, depths) for each batch of sites 
+# that pass the filters, where alts and depths are (sites x samples) matrices.
+# The first batch is always yielded (possibly empty), so that the header
+# can be written even if no sites pass.
+#
+###############################################################################
+def iterate_pipe_snps_batches(species_name, min_nonzero_median_coverage=config.pipe_snps_min_nonzero_median_coverage, lower_factor=config.pipe_snps_lower_depth_factor, upper_factor=config.pipe_snps_upper_depth_factor, min_samples=config.pipe_snps_min_samples, debug=False, batch_size=config.pipe_snps_batch_size):
 
 
 # lower_factor = 0.3 is the default to be consistent with MIDAS gene presence criterion
@@ -338,10 +436,10 @@ def pipe_snps(species_name, min_nonzero_median_coverage=config.pipe_snps_min_non
     
    
     # Open MIDAS output files
-    ref_freq_file = bz2.BZ2File("%ssnps/%s/snps_ref_freq.txt.bz2" % (data_directory, species_name),"r")
-    depth_file = bz2.BZ2File("%ssnps/%s/snps_depth.txt.bz2" % (data_directory, species_name),"r")
-    alt_allele_file = bz2.BZ2File("%ssnps/%s/snps_alt_allele.txt.bz2" % (data_directory, species_name),"r")
-    info_file = bz2.BZ2File("%ssnps/%s/snps_info.txt.bz2" % (data_directory, species_name),"r")
+    ref_freq_file = bz2_utils.open_bz2_file("%ssnps/%s/snps_ref_freq.txt.bz2" % (data_directory, species_name))
+    depth_file = bz2_utils.open_bz2_file("%ssnps/%s/snps_depth.txt.bz2" % (data_directory, species_name))
+    alt_allele_file = bz2_utils.open_bz2_file("%ssnps/%s/snps_alt_allele.txt.bz2" % (data_directory, species_name))
+    info_file = bz2_utils.open_bz2_file("%ssnps/%s/snps_info.txt.bz2" % (data_directory, species_name))
     marker_file = bz2.BZ2File("%ssnps/%s/marker_coverage.txt.bz2" % (data_directory, species_name))
     
     # get header lines from each file
@@ -384,9 +482,8 @@ def pipe_snps(species_name, min_nonzero_median_coverage=config.pipe_snps_min_non
     
     #print lower_depth_threshold_vector
     
-    # print header
-    print_str = "\t".join(["site_id"]+samples)
-    print print_str
+    # header batch
+    yield samples, [], numpy.zeros((0,len(samples))), numpy.zeros((0,len(samples)))
     
     # Only going to look at 1D, 2D, 3D, and 4D sites
     # (we will restrict to 1D and 4D downstream)
@@ -405,122 +502,307 @@ def pipe_snps(species_name, min_nonzero_median_coverage=config.pipe_snps_min_non
     num_sites_processed = 0
     while True:
             
-        # load next lines
-        depth_line = depth_file.readline()
-        ref_freq_line = ref_freq_file.readline()
-        alt_line = alt_allele_file.readline()
-        info_line = info_file.readline()
+        # load next batch of lines
+        depth_lines = read_line_batch(depth_file, batch_size)
+        ref_freq_lines = read_line_batch(ref_freq_file, len(depth_lines))
+        alt_lines = read_line_batch(alt_allele_file, len(depth_lines))
+        info_lines = read_line_batch(info_file, len(depth_lines))
         
         # quit if file has ended
-        if depth_line=="":
+        if len(depth_lines)==0:
             break
         
         # parse site info
-        info_items = info_line.split("\t")
-        variant_type = info_items[5]
+        site_id_strs = []
+        site_idxs = []
+        for site_idx in xrange(0,len(depth_lines)):
         
-        # make sure it is either a 1D or 4D site
-        if not variant_type in allowed_variant_types:
-            continue
-    
-        # continue parsing site info
-        gene_name = info_items[6]
-        site_id_items = info_items[0].split("|")
-        # NRG: added this if condition to deal with extra 'accn' in db swap. 
-        if site_id_items[0]=='accn':
-            contig = site_id_items[1]
-            location = site_id_items[2]
-        else:
-            contig = site_id_items[0] 
-            location = site_id_items[1]
+            info_items = info_lines[site_idx].split("\t")
+            variant_type = info_items[5]
         
+            # make sure it is either a 1D or 4D site
+            if not variant_type in allowed_variant_types:
+                continue
     
-        # now parse allele count info
-        depths = numpy.array([float(item) for item in depth_line.split()[1:]])
-        ref_freqs = numpy.array([float(item) for item in ref_freq_line.split()[1:]])
+            # continue parsing site info
+            gene_name = info_items[6]
+            site_id_items = info_items[0].split("|")
+            # NRG: added this if condition to deal with extra 'accn' in db swap. 
+            if site_id_items[0]=='accn':
+                contig = site_id_items[1]
+                location = site_id_items[2]
+            else:
+                contig = site_id_items[0] 
+                location = site_id_items[1]
+            
+            # BG: 05/18: moving the polarization part to another part of the pipeline
+            # so that we can use HMP polarization with other datasets. 
+            # at the moment, still saving polarization state.
+            polarization = "R"    
+            site_id_strs.append("|".join([contig, location, gene_name, variant_type, polarization]))
+            site_idxs.append(site_idx)
+        
+        if len(site_idxs)==0:
+            continue
         
-        depths = depths[passed_samples]
-        ref_freqs = ref_freqs[passed_samples]
+        # now parse allele count info (sites x samples)
+        depths = parse_numeric_line_batch([depth_lines[site_idx] for site_idx in site_idxs])
+        ref_freqs = parse_numeric_line_batch([ref_freq_lines[site_idx] for site_idx in site_idxs])
         
-        #if (ref_freqs==1.0).all():
-        #    sys.stderr.write("Non-polymorphic site!\n")
+        depths = depths[:,passed_samples]
+        ref_freqs = ref_freqs[:,passed_samples]
         
         refs = numpy.round(ref_freqs*depths)   
         alts = depths-refs
         
-        passed_sites = (depths>=lower_depth_threshold_vector)*1.0
-        passed_sites *= (depths<=upper_depth_threshold_vector)
-        
-        #print passed_sites.sum(), total_passed_samples, passed_sites.sum()/total_passed_samples
+        passed_sites = (depths>=lower_depth_threshold_vector[None,:])*1.0
+        passed_sites *= (depths<=upper_depth_threshold_vector[None,:])
         
         # make sure the site is prevalent in enough samples to count as "core"
-        if (passed_sites).sum()*1.0/total_passed_samples < prevalence_threshold:
-            continue
-            #passed_sites *= 0
-            
-        refs = refs*passed_sites
-        alts = alts*passed_sites
-        depths = depths*passed_sites
-        
-        total_alts = alts.sum()
-        total_refs = depths.sum()
-        total_depths = total_alts+total_refs
+        prevalent_sites = numpy.logical_not(passed_sites.sum(axis=1)*1.0/total_passed_samples < prevalence_threshold)
         
-        # BG: 05/18: moving the polarization part to another part of the pipeline
-        # so that we can use HMP polarization with other datasets. 
-        # at the moment, still saving polarization state.
+        refs = refs[prevalent_sites]*passed_sites[prevalent_sites]
+        alts = alts[prevalent_sites]*passed_sites[prevalent_sites]
+        site_id_strs = [site_id_strs[i] for i in numpy.nonzero(prevalent_sites)[0]]
         
-        polarization = "R"    
-        new_site_id_str = "|".join([contig, location, gene_name, variant_type, polarization])
+        depths = alts+refs
         
+        if debug:
+            # stop after the first 10k sites
+            num_remaining_sites = 10000-num_sites_processed
+            site_id_strs = site_id_strs[:num_remaining_sites]
+            alts = alts[:num_remaining_sites]
+            depths = depths[:num_remaining_sites]
         
-        # print string
-        read_strs = ["%g,%g" % (A,A+R) for A,R in zip(alts, refs)]
-        print_str = "\t".join([new_site_id_str]+read_strs)
+        if len(site_id_strs) > 0:
+            yield samples, site_id_strs, alts, depths
         
-        print print_str
-        #print total_alts
-        
-        num_sites_processed+=1
-        if num_sites_processed%10000==0:
-            #sys.stderr.write("%dk sites processed...\n" % (num_sites_processed/1000))   
-            if debug:
-                break
+        num_sites_processed+=len(site_id_strs)
+        if debug and num_sites_processed>=10000:
+            break
     
     ref_freq_file.close()
     depth_file.close()
     alt_allele_file.close()
     info_file.close()
+
+###############################################################################
+#
+# Parses a single site line from an annotated SNPs file
+#
+# returns (contig, location, gene_name, variant_type, polarization, pvalue, alts, depths)
+# where alts and depths are vectors over desired_sample_idxs, or None
+# if site is outside allowed_genes or allowed_variant_types
+#
+###############################################################################
+def parse_annotated_snps_site(line, desired_sample_idxs, allowed_genes=set([]), allowed_variant_types=set(['1D','2D','3D','4D'])):
+
+    # Load information about site
+    site_id = line.split(None,1)[0]
+    info_items = site_id.split("|")
+    chromosome = info_items[0]
+    location = long(info_items[1])
+    gene_name = info_items[2]
+    variant_type = info_items[3]
+    
+    if len(info_items) > 5: # for backwards compatability
+        polarization = info_items[4]
+        pvalue = float(info_items[5])
+    else: 
+        polarization="R" # not correct, but avoids a crash
+        pvalue = float(info_items[4])
+    
+    if (not variant_type in allowed_variant_types) or (len(allowed_genes)>0 and (not gene_name in allowed_genes)):
+        # don't bother parsing the allele counts
+        return chromosome, location, gene_name, variant_type, polarization, pvalue, None, None
     
-    # returns nothing
+    items = line.split()
+    
+    # Load alt and depth counts
+    alts = []
+    depths = []
+    
+    for idx in desired_sample_idxs:    
+        item = items[1+idx]
+        subitems = item.split(",")
+        alts.append(long(subitems[0]))
+        depths.append(long(subitems[1]))
+    alts = numpy.array(alts, dtype=numpy.int64)
+    depths = numpy.array(depths, dtype=numpy.int64)
+    
+    return chromosome, location, gene_name, variant_type, polarization, pvalue, alts, depths
 
 ###############################################################################
 #
-# Loads list of SNPs and counts of target sites from annotated SNPs file
+# Iterates over the sites in an (open) annotated SNPs file, 
+# starting at initial_line_number
 #
-# returns (lots of things, see below)
+# Yields (line_number, contig, location, gene_name, variant_type, polarization, pvalue, alts, depths)
+# where alts and depths are vectors over desired_sample_idxs, or None
+# for sites outside allowed_genes or allowed_variant_types
+#
+# If gene_ranges (from snp_store_utils.load_gene_index) is supplied, 
+# seeks directly to initial_line_number and skips over genes with 
+# no allowed sites, yielding only their first site
+# (enough for parse_snps to find chunk boundaries)
 #
 ###############################################################################
-def parse_snps(species_name, debug=False, allowed_samples=[], allowed_genes=[], allowed_variant_types=['1D','2D','3D','4D'], initial_line_number=0, chunk_size=1000000000):
+def iterate_annotated_snps_sites(snp_file, desired_sample_idxs, initial_line_number=0, allowed_genes=set([]), allowed_variant_types=set(['1D','2D','3D','4D']), gene_ranges=None):
+
+    if gene_ranges is None:
+        # have to read through the whole file
+        line_number = -1
+        for line in snp_file:
+        
+            line_number += 1
+                
+            if line_number < initial_line_number:
+                continue
+        
+            yield (line_number,)+parse_annotated_snps_site(line, desired_sample_idxs, allowed_genes, allowed_variant_types)
+        
+        return
+    
+    initial_line_number = max([initial_line_number, 0])
+    
+    # find gene range containing initial line
+    range_idx = bisect.bisect_right([gene_range['line_number'] for gene_range in gene_ranges], initial_line_number)-1
+    range_idx = max([range_idx, 0])
+    
+    for gene_range in gene_ranges[range_idx:]:
+        
+        start_line_number = max([gene_range['line_number'], initial_line_number])
+        end_line_number = gene_range['line_number']+gene_range['num_sites']
+        
+        if start_line_number >= end_line_number:
+            continue
+        
+        gene_allowed = (len(allowed_genes)==0 or (gene_range['gene_name'] in allowed_genes))
+        gene_allowed = gene_allowed and any([variant_type in allowed_variant_types for variant_type in gene_range['variant_type_counts']])
+        
+        if not gene_allowed:
+            end_line_number = start_line_number+1
+        
+        # (no seek needed if we are already there)
+        if snp_file.tell()!=gene_range['byte_offset']:
+            snp_file.seek(gene_range['byte_offset'])
+        
+        # initial line can be in the middle of the first range
+        for line_number in xrange(gene_range['line_number'], start_line_number):
+            snp_file.readline()
+        
+        for line_number in xrange(start_line_number, end_line_number):
+            line = snp_file.readline()
+            yield (line_number,)+parse_annotated_snps_site(line, desired_sample_idxs, allowed_genes, allowed_variant_types)
+        
+###############################################################################
+#
+# Compact storage for the allele counts and passed sites returned by parse_snps
+#
+# Allele counts are stored as unsigned ints (uint16 if all counts in a
+# gene fit, otherwise uint32), and passed sites as int32. Code that does
+# arithmetic on them upcasts first (e.g. allele_counts*1.0),
+# since e.g. allele_counts-1 would wrap around.
+#
+###############################################################################
+passed_sites_dtype = numpy.int32
+
+def compact_allele_counts(allele_counts):
+    
+    if allele_counts.size==0 or allele_counts.max() <= numpy.iinfo(numpy.uint16).max:
+        return allele_counts.astype(numpy.uint16)
+    else:
+        return allele_counts.astype(numpy.uint32)
+
+###############################################################################
+#
+# Passed sites
+#
+# Instead of a samples x samples matrix for every gene and variant type, 
+# parse_snps stores the distinct patterns of which samples have coverage at
+# a site (passed_sites['depth_patterns'], a patterns x samples boolean matrix)
+# and the number of sites with each pattern (passed_sites['pattern_counts']).
+# Most sites share a handful of patterns, so this is much smaller.
+#
+# The matrix of sites where both samples can be called is calculated 
+# on demand with calculate_passed_sites_matrix
+#
+###############################################################################
+
+# depth_pattern_counts = map from packed bits -> number of sites
+def unpack_depth_patterns(depth_pattern_counts, num_samples):
+    
+    packed_patterns = sorted(depth_pattern_counts.keys())
+    pattern_counts = numpy.array([depth_pattern_counts[packed_pattern] for packed_pattern in packed_patterns], dtype=passed_sites_dtype)
+    
+    # (packbits pads each pattern to a whole number of bytes)
+    depth_patterns = numpy.unpackbits(numpy.fromstring("".join(packed_patterns), dtype=numpy.uint8)).reshape((len(packed_patterns), (num_samples+7)/8*8))[:,:num_samples].astype(numpy.bool_)
+    
+    return depth_patterns, pattern_counts
+
+####
+#
+# Returns samples x samples matrix of the number of sites in 
+# passed_sites (= passed_sites_map[gene_name][variant_type])
+# where both samples have coverage. 
+# 
+# sample_idxs = optional subset of samples
+#
+####
+def calculate_passed_sites_matrix(passed_sites, sample_idxs=None):
+    
+    depth_patterns = passed_sites['depth_patterns']
+    if sample_idxs is not None:
+        depth_patterns = depth_patterns[:,sample_idxs]
     
+    # (exact in floating point, and much faster than an integer product)
+    weighted_depth_patterns = depth_patterns*(passed_sites['pattern_counts']*1.0)[:,None]
+    return numpy.dot(weighted_depth_patterns.T, depth_patterns*1.0).astype(passed_sites_dtype)
+
+###############################################################################
+#
+# Opens the SNP data for species_name (the columnar store in snp_store_utils
+# if one has been created for this species, otherwise the text file)
+#
+# returns (desired_samples, desired_sample_idxs, site_records, close_function)
+# where site_records iterates over sites as in iterate_annotated_snps_sites 
+# (with the population freq and site key of each allowed site appended, 
+#  see site_key_utils)
+#
+###############################################################################
+def open_snp_sites(species_name, allowed_samples=[], allowed_genes=set([]), allowed_variant_types=set(['1D','2D','3D','4D']), initial_line_number=0):
+
     import calculate_snp_prevalences
+    import snp_store_utils
+    
     # Load population freqs (for polarization purposes)    
-    population_freqs = calculate_snp_prevalences.parse_population_freqs(species_name, polarize_by_consensus=False)
+    population_freq_table = calculate_snp_prevalences.load_population_freq_table(species_name, polarize_by_consensus=False)
    
-    # Open post-processed MIDAS output
-    snp_file =  bz2.BZ2File("%ssnps/%s/annotated_snps.txt.bz2" % (data_directory, species_name),"r")
+    use_snp_store = snp_store_utils.snp_store_exists(species_name)
+   
+    if use_snp_store:
+        snp_store = snp_store_utils.load_snp_store(species_name)
+        items = snp_store['samples']
+    else:
+        # None if there is no (up to date) index
+        gene_ranges = snp_store_utils.load_gene_index(species_name)
+        
+        # Open post-processed MIDAS output
+        if gene_ranges is None:
+            snp_file =  bz2_utils.open_bz2_file("%ssnps/%s/annotated_snps.txt.bz2" % (data_directory, species_name))
+        else:
+            # need to be able to seek
+            snp_file =  bz2.BZ2File("%ssnps/%s/annotated_snps.txt.bz2" % (data_directory, species_name),"r")
+    
+        line = snp_file.readline() # header
+        items = line.split()[1:]    
     
-    line = snp_file.readline() # header
-    items = line.split()[1:]    
     samples = sample_utils.parse_merged_sample_names(items)
     
     if len(allowed_samples)==0:
         allowed_sample_set = set(samples)
     else:
         allowed_sample_set = (set(allowed_samples) & set(samples))
-        
-    allowed_genes = set(allowed_genes)
-    allowed_variant_types = set(allowed_variant_types)
     
     # This is a hack because there were some mistaken repeats in an old data file
     # should be able to remove later
@@ -540,85 +822,118 @@ def parse_snps(species_name, debug=False, allowed_samples=[], allowed_genes=[],
     
     #print len(samples), len(desired_sample_idxs), len(allowed_samples), len(desired_samples), len(allowed_sample_set)
 
+    if use_snp_store:
     
-    # map from gene_name -> var_type -> (list of locations, matrix of allele counts)
-    allele_counts_map = {}
-    # map from gene_name -> var_type -> (location, sample x sample matrix of whether both samples can be called at that site)
-    passed_sites_map = {}
-    
-    num_sites_processed = 0
-    line_number = -1
-    final_line_number = -1
-    previous_gene_name = ""
-    gene_name = ""
-    for line in snp_file:
-        
-        line_number += 1
-        previous_gene_name = gene_name
-                
-        if line_number < initial_line_number:
-            continue
-        
-        items = line.split()
-        # Load information about site
-        info_items = items[0].split("|")
-        chromosome = info_items[0]
-        location = long(info_items[1])
-        gene_name = info_items[2]
-        variant_type = info_items[3]
-        
-        if len(info_items) > 5: # for backwards compatability
-            polarization = info_items[4]
-            pvalue = float(info_items[5])
-        else: 
-            polarization="R" # not correct, but avoids a crash
-            pvalue = float(info_items[4])
+        def iterate_store_sites():
             
+            # site keys and population freqs are calculated 
+            # for a whole chunk of the store at once
+            store_contig_ids = site_key_utils.get_contig_ids(species_name, snp_store['contigs'])
+            chunk_start_idx = 0
+            site_keys = numpy.zeros(0, dtype=numpy.int64)
+            population_freqs = numpy.zeros(0)
+            
+            for site_record in snp_store_utils.iterate_snp_store_sites(snp_store, desired_sample_idxs, initial_line_number, allowed_genes, allowed_variant_types):
+            
+                line_number = site_record[0]
+                population_freq = None
+                site_key = None
+                if site_record[-1] is not None:
+                    if not (chunk_start_idx <= line_number < chunk_start_idx+len(site_keys)):
+                        chunk_start_idx = line_number-line_number%snp_store['chunk_size']
+                        chunk_end_idx = min([chunk_start_idx+snp_store['chunk_size'], snp_store['num_sites']])
+                        site_keys = site_key_utils.pack_site_keys(store_contig_ids[snp_store['contig_idxs'][chunk_start_idx:chunk_end_idx]], snp_store['locations'][chunk_start_idx:chunk_end_idx])
+                        population_freqs = calculate_snp_prevalences.lookup_site_freqs_by_key(population_freq_table, site_keys)
+                    
+                    population_freq = population_freqs[line_number-chunk_start_idx]
+                    site_key = site_keys[line_number-chunk_start_idx]
+                
+                yield site_record+(population_freq, site_key)
         
-        if num_sites_processed >= chunk_size and gene_name!=previous_gene_name:
-            # We are done for now!
-            final_line_number = line_number
-            break
+        site_records = iterate_store_sites()
+        close_function = lambda: None
         
-                
-        if not variant_type in allowed_variant_types:
-            continue
+    else:
+    
+        def iterate_text_sites():
             
-        if len(allowed_genes)>0 and (not gene_name in allowed_genes):
-            continue
-        
-        # Load alt and depth counts
-        # Load alt and depth counts
-        alts = []
-        depths = []
+            for site_record in iterate_annotated_snps_sites(snp_file, desired_sample_idxs, initial_line_number, allowed_genes, allowed_variant_types, gene_ranges):
+            
+                population_freq = None
+                site_key = None
+                if site_record[-1] is not None:
+                    site_key = site_key_utils.calculate_site_key(species_name, site_record[1], site_record[2])
+                    population_freq = calculate_snp_prevalences.lookup_site_freq_by_key(population_freq_table, site_key)
+                
+                yield site_record+(population_freq, site_key)
         
-        for idx in desired_sample_idxs:    
-            item = items[1+idx]
-            subitems = item.split(",")
-            alts.append(float(subitems[0]))
-            depths.append(float(subitems[1]))
-        alts = numpy.array(alts)
-        depths = numpy.array(depths)
+        site_records = iterate_text_sites()
+        close_function = snp_file.close
         
+    return desired_samples, desired_sample_idxs, site_records, close_function
+
+###############################################################################
+#
+# Iterates over contiguous runs of sites from the same gene
+#
+# site_records = sites from open_snp_sites
+# num_samples = number of desired samples
+#
+# Yields (line_number, gene_name, gene_allele_counts, gene_passed_sites, num_snps) 
+# where line_number is that of the first site in the run,
+# gene_allele_counts and gene_passed_sites are the entries of 
+# allele_counts_map and passed_sites_map for the gene (see parse_snps), 
+# or None if none of the sites are allowed, and num_snps is the number 
+# of SNPs in gene_allele_counts
+#
+# (stops in the middle of a gene if debug and >=1000 SNPs have been processed, 
+#  like parse_snps)
+#
+###############################################################################
+def iterate_snp_gene_runs(site_records, num_samples, allowed_variant_types=set(['1D','2D','3D','4D']), debug=False):
+
+    num_sites_processed = 0
+    
+    run_line_number = -1
+    run_gene_name = None
+    gene_allele_counts = None
+    gene_passed_sites = None
+    num_snps = 0
+    
+    for line_number, chromosome, location, gene_name, variant_type, polarization, pvalue, alts, depths, population_freq, site_key in site_records:
         
-        # polarize
-        if (chromosome, location) in population_freqs:
-            population_freq = population_freqs[(chromosome, location)]
-        else:
-            population_freq = 0
+        if gene_name!=run_gene_name:
+            if run_gene_name is not None:
+                yield finish_snp_gene_run(run_line_number, run_gene_name, gene_allele_counts, gene_passed_sites, num_snps, num_samples)
+            
+            run_line_number = line_number
+            run_gene_name = gene_name
+            gene_allele_counts = None
+            gene_passed_sites = None
+            num_snps = 0
+        
+        if alts is None:
+            # not an allowed gene or variant type
+            continue
         
         # polarize SFS according to population freq
         if population_freq>0.5:
             alts = depths-alts
             polarization = 'A'
      
-        passed_sites = (depths>0)*1.0
-        if gene_name not in passed_sites_map:
-            passed_sites_map[gene_name] = {v: {'location': (chromosome,location), 'sites': numpy.zeros((len(desired_samples), len(desired_samples)))} for v in allowed_variant_types}
+        passed_sites = (depths>0)
+        if gene_passed_sites is None:
+            gene_passed_sites = {v: {'location': (chromosome,location), 'depth_patterns': {}} for v in allowed_variant_types}
             
-            allele_counts_map[gene_name] = {v: {'locations':[], 'alleles':[]} for v in allowed_variant_types}
+            gene_allele_counts = {v: {'locations':[], 'site_keys':[], 'alleles':[]} for v in allowed_variant_types}
         
-        passed_sites_map[gene_name][variant_type]['sites'] += passed_sites[:,None]*passed_sites[None,:]
+        # count sites by which samples are covered
+        # (pairwise passed sites are calculated later, see calculate_passed_sites_matrix)
+        depth_pattern = numpy.packbits(passed_sites).tostring()
+        depth_patterns = gene_passed_sites[variant_type]['depth_patterns']
+        if depth_pattern not in depth_patterns:
+            depth_patterns[depth_pattern] = 0
+        depth_patterns[depth_pattern] += 1
         
         # zero out non-passed sites
         # (shouldn't be needed anymore)    
@@ -636,26 +951,144 @@ def parse_snps(species_name, debug=False, allowed_samples=[], allowed_genes=[],
         #snp_passed = (freq>0.01) and (total_alts>=4) and ((total_depths-total_alts)>=4)
         
         if snp_passed:
-            allele_counts = numpy.transpose(numpy.array([alts,depths-alts]))
+            allele_counts = numpy.transpose(numpy.array([alts,depths-alts])).astype(numpy.uint32)
         
-            allele_counts_map[gene_name][variant_type]['locations'].append((chromosome, location))
-            allele_counts_map[gene_name][variant_type]['alleles'].append(allele_counts)
+            gene_allele_counts[variant_type]['locations'].append((chromosome, location))
+            gene_allele_counts[variant_type]['site_keys'].append(site_key)
+            gene_allele_counts[variant_type]['alleles'].append(allele_counts)
         
+            num_snps+=1
             num_sites_processed+=1
         
             if num_sites_processed>0 and num_sites_processed%1000==0:
                 sys.stderr.write("%dk sites processed...\n" % (num_sites_processed/1000))   
                 if debug:
                     break
-         
-    snp_file.close()
-
-    #print line_number, final_line_number, num_sites_processed
+    
+    if run_gene_name is not None:
+        yield finish_snp_gene_run(run_line_number, run_gene_name, gene_allele_counts, gene_passed_sites, num_snps, num_samples)
 
-    for gene_name in passed_sites_map.keys():
-        for variant_type in passed_sites_map[gene_name].keys():
+def finish_snp_gene_run(line_number, gene_name, gene_allele_counts, gene_passed_sites, num_snps, num_samples):
+    
+    if gene_passed_sites is not None:
+        for variant_type in gene_passed_sites.keys():
             
-            allele_counts_map[gene_name][variant_type]['alleles'] = numpy.array(allele_counts_map[gene_name][variant_type]['alleles'])
+            gene_passed_sites[variant_type]['depth_patterns'], gene_passed_sites[variant_type]['pattern_counts'] = unpack_depth_patterns(gene_passed_sites[variant_type]['depth_patterns'], num_samples)
+            gene_allele_counts[variant_type]['site_keys'] = numpy.array(gene_allele_counts[variant_type]['site_keys'], dtype=numpy.int64)
+            gene_allele_counts[variant_type]['alleles'] = compact_allele_counts(numpy.array(gene_allele_counts[variant_type]['alleles'], dtype=numpy.uint32))
+    
+    return line_number, gene_name, gene_allele_counts, gene_passed_sites, num_snps
+
+####
+#
+# Adds the SNPs and passed sites of a later run of sites from the same gene
+# to gene_allele_counts and gene_passed_sites (e.g. if a gene's sites aren't
+# contiguous in the file)
+#
+####
+def merge_snp_gene_runs(gene_allele_counts, gene_passed_sites, run_allele_counts, run_passed_sites):
+
+    for variant_type in gene_passed_sites.keys():
+    
+        gene_allele_counts[variant_type]['locations'].extend(run_allele_counts[variant_type]['locations'])
+        gene_allele_counts[variant_type]['site_keys'] = numpy.hstack([gene_allele_counts[variant_type]['site_keys'], run_allele_counts[variant_type]['site_keys']])
+        alleles = [allele_counts for allele_counts in [gene_allele_counts[variant_type]['alleles'], run_allele_counts[variant_type]['alleles']] if len(allele_counts)>0]
+        if len(alleles)>0:
+            gene_allele_counts[variant_type]['alleles'] = compact_allele_counts(numpy.concatenate([allele_counts.astype(numpy.uint32) for allele_counts in alleles]))
+    
+        depth_pattern_counts = {}
+        for passed_sites in [gene_passed_sites[variant_type], run_passed_sites[variant_type]]:
+            for depth_pattern, pattern_count in zip(passed_sites['depth_patterns'], passed_sites['pattern_counts']):
+                packed_pattern = numpy.packbits(depth_pattern).tostring()
+                if packed_pattern not in depth_pattern_counts:
+                    depth_pattern_counts[packed_pattern] = 0
+                depth_pattern_counts[packed_pattern] += pattern_count
+        
+        gene_passed_sites[variant_type]['depth_patterns'], gene_passed_sites[variant_type]['pattern_counts'] = unpack_depth_patterns(depth_pattern_counts, gene_passed_sites[variant_type]['depth_patterns'].shape[1])
+
+###############################################################################
+#
+# Streaming version of parse_snps
+#
+# Only one gene's SNPs are held in memory at a time 
+# (instead of a whole chunk), so there is no need for chunks
+#
+# returns desired_samples, and a generator of 
+# (gene_name, gene_allele_counts, gene_passed_sites) 
+# where gene_allele_counts = allele_counts_map[gene_name] and
+# gene_passed_sites = passed_sites_map[gene_name] (see parse_snps)
+#
+# (a gene whose sites aren't contiguous in the file is yielded once per run
+#  of sites. The matrix functions in diversity_utils sum over genes, 
+#  so this doesn't change their results, see e.g. 
+#  diversity_utils.calculate_pi_matrix_from_snp_genes)
+#
+###############################################################################
+def parse_snp_genes(species_name, debug=False, allowed_samples=[], allowed_genes=[], allowed_variant_types=['1D','2D','3D','4D']):
+
+    allowed_genes = set(allowed_genes)
+    allowed_variant_types = set(allowed_variant_types)
+    
+    desired_samples, desired_sample_idxs, site_records, close_function = open_snp_sites(species_name, allowed_samples, allowed_genes, allowed_variant_types)
+    
+    def iterate_snp_genes():
+        
+        try:
+            for line_number, gene_name, gene_allele_counts, gene_passed_sites, num_snps in iterate_snp_gene_runs(site_records, len(desired_samples), allowed_variant_types, debug):
+                if gene_passed_sites is not None:
+                    yield gene_name, gene_allele_counts, gene_passed_sites
+        finally:
+            close_function()
+    
+    return desired_samples, iterate_snp_genes()
+
+###############################################################################
+#
+# Loads list of SNPs and counts of target sites from annotated SNPs file
+#
+# (uses the columnar store in snp_store_utils instead of the text file
+#  if one has been created for this species, and the gene-range index
+#  to seek within the text file otherwise)
+#
+# returns (lots of things, see below)
+#
+###############################################################################
+def parse_snps(species_name, debug=False, allowed_samples=[], allowed_genes=[], allowed_variant_types=['1D','2D','3D','4D'], initial_line_number=0, chunk_size=1000000000):
+    
+    allowed_genes = set(allowed_genes)
+    allowed_variant_types = set(allowed_variant_types)
+    
+    desired_samples, desired_sample_idxs, site_records, close_function = open_snp_sites(species_name, allowed_samples, allowed_genes, allowed_variant_types, initial_line_number)
+    
+    # map from gene_name -> var_type -> (list of locations, array of site keys, matrix of allele counts)
+    allele_counts_map = {}
+    # map from gene_name -> var_type -> (location, sample x sample matrix of whether both samples can be called at that site)
+    passed_sites_map = {}
+    
+    num_sites_processed = 0
+    final_line_number = -1
+    for line_number, gene_name, gene_allele_counts, gene_passed_sites, num_snps in iterate_snp_gene_runs(site_records, len(desired_samples), allowed_variant_types, debug):
+        
+        if num_sites_processed >= chunk_size:
+            # We are done for now!
+            final_line_number = line_number
+            break
+        
+        if gene_passed_sites is None:
+            # not an allowed gene or variant type
+            continue
+        
+        if gene_name not in passed_sites_map:
+            passed_sites_map[gene_name] = gene_passed_sites
+            allele_counts_map[gene_name] = gene_allele_counts
+        else:
+            merge_snp_gene_runs(allele_counts_map[gene_name], passed_sites_map[gene_name], gene_allele_counts, gene_passed_sites)
+        
+        num_sites_processed += num_snps
+    
+    close_function()
+
+    #print line_number, final_line_number, num_sites_processed
 
     return desired_samples, allele_counts_map, passed_sites_map, final_line_number
 
@@ -671,14 +1104,9 @@ def parse_snps(species_name, debug=False, allowed_samples=[], allowed_genes=[],
 ###############################################################################
 def parse_within_sample_pi_new(species_name, allowed_genes=set([]), allowed_variant_types=set(['4D']), debug=False):
     
-    samples, sfs_map = parse_within_sample_sfs(species_name, allowed_variant_types)
+    samples, sfs_arrays = parse_within_sample_sfs_arrays(species_name, allowed_variant_types)
     
-    total_pi = []
-    total_opportunities = []
-    for sample in samples: 
-        p,n = diversity_utils.calculate_pi_from_sfs_map(sfs_map[sample])
-        total_pi.append(p)
-        total_opportunities.append(n)
+    total_pi, total_opportunities = sfs_utils.calculate_pi_from_sfs_arrays(sfs_arrays)
         
     total_pi = numpy.array(total_pi)*1.0
     total_opportunities = numpy.array(total_opportunities)*1.0
@@ -696,52 +1124,109 @@ def parse_within_sample_pi_new(species_name, allowed_genes=set([]), allowed_vari
 #
 # returns vector of samples, vector of sfs maps
 #
-# (
+# (see parse_within_sample_sfs_arrays)
 #
 ###############################################################################
 def parse_within_sample_sfs(species_name, allowed_variant_types=set(['1D','2D','3D','4D'])):
     
-    # First write (filtered) genome-wide coverage distribution
+    samples, sfs_arrays = parse_within_sample_sfs_arrays(species_name, allowed_variant_types)
+    
+    return samples, sfs_utils.calculate_sfs_maps_from_sfs_arrays(sfs_arrays)
+
+###############################################################################
+#
+# Same as parse_within_sample_sfs, but returns the SFSs of all samples
+# as parallel arrays (see sfs_utils)
+#
+# returns vector of samples, sfs_arrays
+#
+###############################################################################
+def parse_within_sample_sfs_arrays(species_name, allowed_variant_types=set(['1D','2D','3D','4D'])):
+    
     sfs_file = bz2.BZ2File("%ssnps/%s/within_sample_sfs.txt.bz2" % (data_directory, species_name),"r")
     sfs_file.readline() # header
     
-    sfs_map = {}
     samples = []
+    sample_idx_map = {}
+    line_sample_idxs = []
+    line_sfss = []
     for line in sfs_file:
-        items = line.split("\t")
+        items = line.split("\t",2)
         sample = sample_utils.parse_merged_sample_names([items[0].strip()])[0]
         
         variant_type = items[1].strip()
-        sfs_items = items[2:]
-        
         
         if variant_type not in allowed_variant_types:
             continue
         
-        if sample not in sfs_map:
-            sfs_map[sample] = {}
+        if sample not in sample_idx_map:
+            sample_idx_map[sample] = len(samples)
             samples.append(sample)
-            
         
-            
-        for sfs_item in sfs_items:
-            subitems = sfs_item.split(",")
-            D = long(subitems[0])
-            A = long(subitems[1])
-            n = long(subitems[2])
-            reverse_n = float(subitems[3])
-            
-            if D<0.5:
-                continue
+        if len(items) < 3:
+            continue
+        
+        # D,A,n,reverse_n for each (D,A)
+        line_sfs = numpy.fromstring(items[2].replace("\t",","), sep=",").reshape((-1,4))
+        
+        line_sfss.append(line_sfs)
+        line_sample_idxs.append(numpy.ones(len(line_sfs),dtype=numpy.int64)*sample_idx_map[sample])
+        
+    sfs_file.close()
     
-            if (A,D) not in sfs_map[sample]:
-                sfs_map[sample][(D,A)] = [0,0.0]
-                
-            sfs_map[sample][(D,A)][0] += n
-            sfs_map[sample][(D,A)][1] += reverse_n
-            
-            
-    return numpy.array(samples), sfs_map
+    if len(line_sfss)==0:
+        line_sfss.append(numpy.zeros((0,4)))
+        line_sample_idxs.append(numpy.zeros(0,dtype=numpy.int64))
+    
+    sfs = numpy.vstack(line_sfss)
+    sample_idxs = numpy.hstack(line_sample_idxs)
+    
+    depths = sfs[:,0].astype(numpy.int64)
+    alts = sfs[:,1].astype(numpy.int64)
+    counts = sfs[:,2].astype(numpy.int64)
+    reverse_counts = sfs[:,3]
+    
+    good_idxs = (depths>=1)
+    
+    # sort by sample, D, A (stable, so that lines stay in file order)
+    sorted_idxs = numpy.nonzero(good_idxs)[0]
+    sorted_idxs = sorted_idxs[numpy.lexsort((alts[sorted_idxs], depths[sorted_idxs], sample_idxs[sorted_idxs]))]
+    
+    sample_idxs = sample_idxs[sorted_idxs]
+    depths = depths[sorted_idxs]
+    alts = alts[sorted_idxs]
+    counts = counts[sorted_idxs]
+    reverse_counts = reverse_counts[sorted_idxs]
+    
+    # (the same (sample,D,A) can appear once for each variant type)
+    entry_starts = numpy.ones(len(sample_idxs),dtype=numpy.bool_)
+    entry_starts[1:] = (sample_idxs[1:]!=sample_idxs[:-1])+(depths[1:]!=depths[:-1])+(alts[1:]!=alts[:-1])
+    start_idxs = numpy.nonzero(entry_starts)[0]
+    end_idxs = numpy.hstack([start_idxs[1:], [len(entry_starts)]])-1
+    
+    # As in the original dict-based parser, counts of fixed sites (A==D) 
+    # are summed across variant types, while other sites keep the 
+    # counts of the last variant type
+    # (summed one variant type at a time, in file order)
+    entry_sizes = end_idxs-start_idxs+1
+    summed_counts = numpy.zeros(len(start_idxs), dtype=numpy.int64)
+    summed_reverse_counts = numpy.zeros(len(start_idxs))
+    for k in xrange(0, entry_sizes.max() if len(entry_sizes)>0 else 0):
+        entry_idxs = numpy.nonzero(entry_sizes>k)[0]
+        summed_counts[entry_idxs] += counts[start_idxs[entry_idxs]+k]
+        summed_reverse_counts[entry_idxs] += reverse_counts[start_idxs[entry_idxs]+k]
+    
+    fixed_sites = (alts[start_idxs]==depths[start_idxs])
+    
+    sfs_arrays = {}
+    sfs_arrays['samples'] = numpy.array(samples)
+    sfs_arrays['sample_idxs'] = sample_idxs[start_idxs]
+    sfs_arrays['depths'] = depths[start_idxs]
+    sfs_arrays['alts'] = alts[start_idxs]
+    sfs_arrays['counts'] = numpy.where(fixed_sites, summed_counts, counts[end_idxs])
+    sfs_arrays['reverse_counts'] = numpy.where(fixed_sites, summed_reverse_counts, reverse_counts[end_idxs])
+    
+    return numpy.array(samples), sfs_arrays
 
 def pangenome_data_exists(species_name):
    gene_reads_filename =  "%sgenes/%s/genes_reads.txt.bz2" % (data_directory, species_name)
@@ -758,45 +1243,15 @@ def parse_pangenome_data(species_name, allowed_samples = [], allowed_genes=[], c
     
     if not pangenome_data_exists(species_name):
         return [], [], [], [], [], []
-        
-    # Open post-processed MIDAS output
-    # Raw read counts
-    gene_reads_file =  bz2.BZ2File("%sgenes/%s/genes_reads.txt.bz2" % (data_directory, species_name),"r")
-    # Depth (read counts / length?)
-    gene_depth_file =  bz2.BZ2File("%sgenes/%s/genes_depth.txt.bz2" % (data_directory, species_name),"r")
-    # Presence absence calls
-    gene_presabs_file =  bz2.BZ2File("%sgenes/%s/genes_presabs.txt.bz2" % (data_directory, species_name),"r")
     
-    # First read through gene_summary_file to get marker gene coverages
-    # Gene summary file
-    gene_summary_file = file("%sgenes/%s/genes_summary.txt" % (data_directory, species_name),"r")
-    marker_coverage_map = {}
-    gene_summary_file.readline() # header
-    marker_coverage_samples = []
-    marker_coverages = []
-    for summary_line in gene_summary_file:
-        items = summary_line.split()
-        sample = items[0].strip()
-        marker_coverage = float(items[5])
-        marker_coverage_samples.append(sample)
-        marker_coverages.append(marker_coverage)
-
-    gene_summary_file.close()
-
-    marker_coverage_samples = sample_utils.parse_merged_sample_names(marker_coverage_samples)
-
-    marker_coverage_map = {sample: marker_coverage for sample,marker_coverage in zip(marker_coverage_samples, marker_coverages)}
-    
-    # Now read through remaining files
-    reads_line = gene_reads_file.readline() # header
-    depth_line = gene_depth_file.readline() # header
-    presabs_line = gene_presabs_file.readline() # header
-    items = presabs_line.split()
-    
-    samples = sample_utils.parse_merged_sample_names(items[1:])
+    # Parsed data is cached in binary form
+    # the first time, and memory-mapped after that
+    if pangenome_cache_utils.pangenome_cache_exists(species_name):
+        pangenome_data = pangenome_cache_utils.load_pangenome_cache(species_name)
+    else:
+        pangenome_data = pangenome_cache_utils.create_pangenome_cache(species_name)
     
-    # ordered vector of marker coverages (guaranteed to be in same order as samples)
-    marker_coverages = numpy.array([marker_coverage_map[sample] for sample in samples])
+    samples = pangenome_data['samples']
     
     if len(allowed_samples)==0:
         allowed_samples = set(samples)
@@ -806,82 +1261,26 @@ def parse_pangenome_data(species_name, allowed_samples = [], allowed_genes=[], c
     desired_sample_idxs = numpy.array([sample in allowed_samples for sample in samples])
     desired_samples = samples[desired_sample_idxs]
     
-    marker_coverages = marker_coverages[desired_sample_idxs]
-    gene_presence_matrix = []
-    gene_reads_matrix = []
-    gene_depth_matrix = []
-    gene_names = []
-    
-    num_genes_processed = 0
-    
-    reads_line = gene_reads_file.readline() # header
-    depth_line = gene_depth_file.readline() # header
-    presabs_line = gene_presabs_file.readline() # header
-    
-    while reads_line!="":
-        
-        # Loop through!
-        
-        items = presabs_line.split()
-        gene_name = items[0]
-        gene_presences = numpy.array([float(item) for item in items[1:]])[desired_sample_idxs]
-        
-        if True: #gene_presences.sum() > 0.5:
-        
-            gene_reads = numpy.array([float(item) for item in reads_line.split()[1:]])[desired_sample_idxs]
-            gene_depths = numpy.array([float(item) for item in depth_line.split()[1:]])[desired_sample_idxs]
-            
-            # Note to self: not uniform across samples!
-            #gene_lengths = gene_reads/(gene_depths+(gene_reads<0.5))
-            #print gene_lengths
-            
-            # gene is present in at least one individual! 
-            gene_presence_matrix.append(gene_presences)
-            gene_depth_matrix.append(gene_depths)
-            gene_reads_matrix.append(gene_reads)
-            gene_names.append(gene_name)    
-        
-        num_genes_processed+=1
-        
-        reads_line = gene_reads_file.readline() # header
-        depth_line = gene_depth_file.readline() # header
-        presabs_line = gene_presabs_file.readline() # header
-    
-        
-    gene_reads_file.close()
-    gene_depth_file.close()
-    gene_presabs_file.close()
-    gene_presence_matrix = numpy.array(gene_presence_matrix)
-    gene_depth_matrix = numpy.array(gene_depth_matrix)
-    gene_reads_matrix = numpy.array(gene_reads_matrix)
+    marker_coverages = pangenome_data['marker_coverages'][desired_sample_idxs]
 
     if convert_centroid_names:
-        new_gene_names = []
+        # (centroid map is only loaded when it is needed)
         centroid_gene_map = load_centroid_gene_map(species_name)
-        for gene_name in gene_names:
-            new_gene_names.append(centroid_gene_map[gene_name])
+        new_gene_names = [centroid_gene_map[gene_name] for gene_name in pangenome_data['gene_names']]
     else:
-        new_gene_names=gene_names
-    
+        new_gene_names = pangenome_data['gene_names']
     
     new_gene_names = numpy.array(new_gene_names)
         
     # Now weed out disallowed genes if provided
     disallowed_genes=set(disallowed_genes)
-    allowed_gene_idxs = []
-    for gene_idx in xrange(0,len(new_gene_names)):
-        
-        if new_gene_names[gene_idx] in disallowed_genes:
-            # don't include
-            pass
-        else:
-            allowed_gene_idxs.append(gene_idx)
-    allowed_gene_idxs = numpy.array(allowed_gene_idxs)
+    allowed_gene_idxs = numpy.array([gene_idx for gene_idx in xrange(0,len(new_gene_names)) if new_gene_names[gene_idx] not in disallowed_genes])
     
     new_gene_names = new_gene_names[allowed_gene_idxs]
-    gene_presence_matrix = gene_presence_matrix[allowed_gene_idxs,:]
-    gene_depth_matrix = gene_depth_matrix[allowed_gene_idxs,:]
-    gene_reads_matrix = gene_reads_matrix[allowed_gene_idxs,:]
+    # (only the desired sample columns are read from disk)
+    gene_presence_matrix = pangenome_data['presabs'][:,desired_sample_idxs][allowed_gene_idxs,:]
+    gene_depth_matrix = pangenome_data['depths'][:,desired_sample_idxs][allowed_gene_idxs,:]
+    gene_reads_matrix = pangenome_data['reads'][:,desired_sample_idxs][allowed_gene_idxs,:]
     
     return desired_samples, new_gene_names, gene_presence_matrix, gene_depth_matrix, marker_coverages, gene_reads_matrix
 
@@ -903,33 +1302,7 @@ def parse_pangenome_data(species_name, allowed_samples = [], allowed_genes=[], c
 #
 ###
 def load_centroid_gene_map(desired_species_name):
-    
-    # First load reference genes
-    reference_genes = load_reference_genes(desired_species_name)
-    
-    gene_info_file = gzip.open("%span_genomes/%s/gene_info.txt.gz" % (midas_directory, desired_species_name), 'r')
-    
-    gene_info_file.readline() # header
-    
-    centroid_gene_map = {}
-    
-    for line in gene_info_file:
-        
-        items = line.split("\t") 
-        gene_id = items[0].strip()
-        centroid_id = items[3].strip()
-        
-        if centroid_id not in centroid_gene_map:
-            centroid_gene_map[centroid_id] = centroid_id
-            
-        if (gene_id in reference_genes) and (centroid_id not in reference_genes):
-            centroid_gene_map[centroid_id] = gene_id
-            
-        
-    gene_info_file.close()
-    
-    return centroid_gene_map
-
+    return midas_db_store_utils.load_centroid_gene_map(desired_species_name)
 
 ####
 #
@@ -937,31 +1310,7 @@ def load_centroid_gene_map(desired_species_name):
 #
 ###
 def load_gene_centroid_map(desired_species_name):
-    
-    gene_info_file = gzip.open("%span_genomes/%s/gene_info.txt.gz" % (midas_directory, desired_species_name), 'r')
-    
-    gene_info_file.readline() # header
-    
-    gene_centroid_map = {}
-    
-    for line in gene_info_file:
-        
-        items = line.split("\t") 
-        gene_id = items[0].strip()
-        centroid_id = items[3].strip()
-        
-        gene_centroid_map[gene_id] = centroid_id    
-        
-    gene_info_file.close()
-    
-    centroid_new_centroid_map = load_centroid_gene_map(desired_species_name)
-    
-    for gene_id in gene_centroid_map.keys():
-        new_centroid = centroid_new_centroid_map[gene_centroid_map[gene_id]]
-        gene_centroid_map[gene_id] = new_centroid
-        
-    return gene_centroid_map
-
+    return midas_db_store_utils.load_gene_centroid_map(desired_species_name)
 
 ####
 #
@@ -969,30 +1318,7 @@ def load_gene_centroid_map(desired_species_name):
 #
 ###
 def load_complete_centroid_gene_map(desired_species_name):
-    
-    gene_info_file = gzip.open("%span_genomes/%s/gene_info.txt.gz" % (midas_directory, desired_species_name), 'r')
-    
-    gene_info_file.readline() # header
-    
-    complete_centroid_gene_map = {}
-    
-    for line in gene_info_file:
-        
-        items = line.split("\t") 
-        gene_id = items[0].strip()
-        centroid_id = items[3].strip()
-        
-        if centroid_id not in complete_centroid_gene_map:
-            complete_centroid_gene_map[centroid_id] = [gene_id]
-        else:
-            complete_centroid_gene_map[centroid_id].append(gene_id)
-            
-        
-    gene_info_file.close()
-    
-    return complete_centroid_gene_map
-
-
+    return midas_db_store_utils.load_complete_centroid_gene_map(desired_species_name)
 
 ###############################################################################
 #
@@ -1034,20 +1360,8 @@ def load_pangenome_genes(species_name):
 #
 ###############################################################################
 def load_reference_genes(desired_species_name):
+    return midas_db_store_utils.load_reference_genes(desired_species_name)
 
-    
-    features_file = gzip.open("%srep_genomes/%s/genome.features.gz" % (midas_directory, desired_species_name), 'r')
-    
-    features_file.readline() # header
-    reference_genes = []
-    for line in features_file:
-        items = line.split()
-        gene_name = items[0].strip()
-        reference_genes.append(gene_name)
-    features_file.close()    
-    
-    return set(reference_genes)
-    
 ################################################################################
 #
 # Loads metaphlan2 genes (that are present in the reference genome)
@@ -1294,15 +1608,18 @@ def calculate_time_pairs(subject_sample_time_map, samples):
     visno=[]
     day=[]
 
+    # idx of each timepoint's sample in samples (-1 if missing)
+    sample_idx_map = sample_utils.calculate_timepoint_sample_idx_map(subject_sample_time_map, samples)
+
     for subject_id in subject_sample_time_map.keys():
         visnos=subject_sample_time_map[subject_id].keys() #visit numbers
         if (len(visnos) > 1) and (1 in visnos):           
-            if (subject_sample_time_map[subject_id][1][0][0] in samples): #check if first visit in samples 
+            if (sample_idx_map[subject_id][1] >= 0): #check if first visit in samples 
                 #iterate through visit numbers. Append the index, day, and visnos to their lists
                 for i in visnos:        
-                    if (subject_sample_time_map[subject_id][i][0][0] in samples) and (i !=1):
-                        index1.append(samples.tolist().index(subject_sample_time_map[subject_id][1][0][0]))
-                        index2.append(samples.tolist().index(subject_sample_time_map[subject_id][i][0][0]))
+                    if (sample_idx_map[subject_id][i] >= 0) and (i !=1):
+                        index1.append(sample_idx_map[subject_id][1])
+                        index2.append(sample_idx_map[subject_id][i])
                         visno.append(i)
                         day.append(subject_sample_time_map[subject_id][i][0][1])
         
@@ -1327,21 +1644,24 @@ def calculate_all_time_pairs(subject_sample_time_map, samples):
     visno2=[]
     day=[]
 
+    # idx of each timepoint's sample in samples (-1 if missing)
+    sample_idx_map = sample_utils.calculate_timepoint_sample_idx_map(subject_sample_time_map, samples)
+
     for subject_id in subject_sample_time_map.keys():
         visnos=subject_sample_time_map[subject_id].keys() #visit numbers
         if (len(visnos) > 1):            
             #iterate through visit numbers. Append the index, day, and visnos to their lists
             for i in range(0, len(visnos)):        
                 for j in range(i+1, len(visnos)):
-                    if (subject_sample_time_map[subject_id][visnos[i]][0][0] in samples and subject_sample_time_map[subject_id][visnos[j]][0][0] in samples):
+                    if (sample_idx_map[subject_id][visnos[i]] >= 0 and sample_idx_map[subject_id][visnos[j]] >= 0):
                         if visnos[i] < visnos[j]:
                             first=visnos[i]
                             second=visnos[j]
                         else:
                             first=visnos[j]
                             second=visnos[i]
-                        index1.append(samples.tolist().index(subject_sample_time_map[subject_id][first][0][0]))
-                        index2.append(samples.tolist().index(subject_sample_time_map[subject_id][second][0][0]))
+                        index1.append(sample_idx_map[subject_id][first])
+                        index2.append(sample_idx_map[subject_id][second])
                         visno1.append(first)
                         visno2.append(second)
                         day.append(subject_sample_time_map[subject_id][second][0][1]-subject_sample_time_map[subject_id][first][0][1])
@@ -1367,16 +1687,19 @@ def calculate_unique_time_pairs(subject_sample_time_map, samples):
     visno=[]
     day=[]
 
+    # idx of each timepoint's sample in samples (-1 if missing)
+    sample_idx_map = sample_utils.calculate_timepoint_sample_idx_map(subject_sample_time_map, samples)
+
     for subject_id in subject_sample_time_map.keys():
         visnos=subject_sample_time_map[subject_id].keys() #visit numbers
         if (len(visnos) > 1) and (1 in visnos):           
-            if (subject_sample_time_map[subject_id][1][0][0] in samples): #check if first visit in samples 
+            if (sample_idx_map[subject_id][1] >= 0): #check if first visit in samples 
                 #iterate through visit numbers. Append the index, day, and visnos to their lists
                 unique_pair_found=False
                 for i in [2,3]:
-                    if i in subject_sample_time_map[subject_id].keys() and subject_sample_time_map[subject_id][i][0][0] in samples and unique_pair_found==False:
-                        index1.append(samples.tolist().index(subject_sample_time_map[subject_id][1][0][0])) 
-                        index2.append(samples.tolist().index(subject_sample_time_map[subject_id][i][0][0]))
+                    if i in subject_sample_time_map[subject_id].keys() and sample_idx_map[subject_id][i] >= 0 and unique_pair_found==False:
+                        index1.append(sample_idx_map[subject_id][1]) 
+                        index2.append(sample_idx_map[subject_id][i])
                         visno.append(i)
                         day.append(subject_sample_time_map[subject_id][i][0][1])
                         unique_pair_found=True
@@ -1393,18 +1716,7 @@ def calculate_unique_time_pairs(subject_sample_time_map, samples):
 #########################################################################################
 
 def representative_genome_id(desired_species_name):
-    species_info = open("%sspecies_info.txt" % midas_directory)
-    species_info.readline() #header
-    
-    genome_id_to_return=''
-    for line in species_info:
-        items = line.split("\t")
-        species_id = items[0].strip()
-        rep_genome = items[1].strip()
-        if desired_species_name == species_id:
-            genome_id_to_return=rep_genome
-            return genome_id_to_return
-
+    return midas_db_store_utils.get_representative_genome_id(desired_species_name)
 
 ##########################################################
 #
@@ -1412,18 +1724,7 @@ def representative_genome_id(desired_species_name):
 #
 #########################################################
 def get_ref_genome_ids(desired_species_name):
-    
-    genome_ids=[]
-    genome_info = open("%sgenome_info.txt" % midas_directory)
-    genome_info.readline() #header
-    for line in genome_info:
-        items = line.split("\t")
-        genome_id = items[0].strip()
-        species_id=items[5].strip() 
-        if desired_species_name == species_id:
-            genome_ids.append(genome_id)
-    return genome_ids
-
+    return midas_db_store_utils.get_ref_genome_ids(desired_species_name)
 
 ##########################################################
 #
@@ -1431,19 +1732,7 @@ def get_ref_genome_ids(desired_species_name):
 #
 #########################################################
 def genome_ids_dictionary():
-    
-    genome_ids={}
-    genome_info = open("%sgenome_info.txt" % midas_directory)
-    genome_info.readline() #header
-    for line in genome_info:
-        items = line.split("\t")
-        genome_id = items[0].strip()
-        species_id=items[5].strip() 
-        rep_genome=items[2]
-        genome_ids[genome_id]=[species_id, rep_genome]
-    return genome_ids
-
-
+    return midas_db_store_utils.load_genome_ids_dictionary()
 
 ##########################################################
 #
@@ -1524,19 +1813,21 @@ def parse_intermediate_species_file(sample_id, inFN):
 # 
 # Read in centroids fasta sequences
 #
+# returns map from gene -> sequence for gene_names
+# (or for all genes if gene_names is None). 
+# Sequences are read from an indexed cache
+# (see centroid_fasta_utils), so only the requested
+# genes are read from disk
+#
 #########################################
-def load_centroid_fasta(species_name):
-    centroid_fastas={} # key=gene, value=sequence
-    centroid_file = gzip.open("%span_genomes/%s/centroids.ffn.gz" % (midas_directory, species_name), 'r')
-    for line in centroid_file:
-        line=line.strip()
-        if line[0]=='>':
-            gene_name=line[1:len(line)]
-            centroid_fastas[gene_name]=''
-        else:
-            centroid_fastas[gene_name]+= line
-
-    return centroid_fastas
+def load_centroid_fasta(species_name, gene_names=None):
+    
+    centroid_fasta_index = centroid_fasta_utils.load_centroid_fasta_index(species_name)
+    
+    if gene_names is None:
+        gene_names = centroid_fasta_index['gene_names']
+        
+    return centroid_fasta_utils.get_centroid_sequences(centroid_fasta_index, gene_names)
     
 
 
@@ -139,8 +139,7 @@ avg_pi_per_gene={}
 pi_per_gene={}
 passed_sites_per_gene={}
 num_people_with_data={}
-for gene_name in core_genes:
-    gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites= diversity_utils.calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=[gene_name])
+for gene_name, gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites in diversity_utils.iterate_gene_pi_matrices(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=core_genes):
     # check if the values of gene_passed_sites are less than 5. If so, then zero out these idxs for gene_passed_sites, gene_pi_matrix, and gene_avg_pi_matrix. Basically all of these people or pairs of people have too few sites to compute realiable statistics. 
     low_passed_sites_idxs=(gene_passed_sites)<min_passed_sites_per_gene
     gene_passed_sites[low_passed_sites_idxs] =0
@@ -168,8 +167,7 @@ avg_pi_per_gene={}
 pi_per_gene={}
 passed_sites_per_gene={}
 num_people_with_data={}
-for gene_name in variable_genes:
-    gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites= diversity_utils.calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=[gene_name])
+for gene_name, gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites in diversity_utils.iterate_gene_pi_matrices(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=variable_genes):
     # check if the values of gene_passed_sites are less than 5. If so, then zero out these idxs for gene_passed_sites, gene_pi_matrix, and gene_avg_pi_matrix. Basically all of these people or pairs of people have too few sites to compute realiable statistics. 
     low_passed_sites_idxs=(gene_passed_sites)<min_passed_sites_per_gene
     gene_passed_sites[low_passed_sites_idxs] =0
@@ -198,8 +196,7 @@ avg_pi_per_gene={}
 pi_per_gene={}
 passed_sites_per_gene={}
 num_people_with_data={}
-for gene_name in gene_names: #gene_names has both core and variable genes. 
-    gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites= diversity_utils.calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=[gene_name])
+for gene_name, gene_pi_matrix, gene_avg_pi_matrix, gene_passed_sites in diversity_utils.iterate_gene_pi_matrices(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=gene_names): #gene_names has both core and variable genes. 
     # check if the values of gene_passed_sites are less than 5. If so, then zero out these idxs for gene_passed_sites, gene_pi_matrix, and gene_avg_pi_matrix. Basically all of these people or pairs of people have too few sites to compute realiable statistics. 
     low_passed_sites_idxs=(gene_passed_sites)<min_passed_sites_per_gene
     gene_passed_sites[low_passed_sites_idxs] =0
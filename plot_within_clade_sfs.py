@@ -27,6 +27,7 @@ import sys
 import numpy
 
 import diversity_utils
+import snp_container_utils
 import gene_diversity_utils
 import calculate_substitution_rates
 import clade_utils
@@ -269,9 +270,12 @@ while final_line_number >= 0:
     nonsynonymous_difference_matrix += chunk_nonsynonymous_difference_matrix
     nonsynonymous_opportunity_matrix += chunk_nonsynonymous_opportunity_matrix
   
+    # (one flat array of allele counts, so each SFS below is a single pass over the sites)
+    snp_container = snp_container_utils.create_snp_container_from_maps(allele_counts_map, passed_sites_map, len(snp_samples))
+    
     sys.stderr.write("Calculating the SFS...\n")
-    chunk_synonymous_freqs = diversity_utils.calculate_pooled_freqs(allele_counts_map, passed_sites_map, allowed_variant_types = set(['4D']), allowed_genes=core_genes)
-    chunk_nonsynonymous_freqs = diversity_utils.calculate_pooled_freqs(allele_counts_map, passed_sites_map, allowed_variant_types = set(['1D']), allowed_genes=core_genes)
+    chunk_synonymous_freqs = diversity_utils.calculate_pooled_freqs_from_snp_container(snp_container, allowed_variant_types = set(['4D']), allowed_genes=core_genes)
+    chunk_nonsynonymous_freqs = diversity_utils.calculate_pooled_freqs_from_snp_container(snp_container, allowed_variant_types = set(['1D']), allowed_genes=core_genes)
         
     chunk_synonymous_sfs, dummy = numpy.histogram(chunk_synonymous_freqs, bins=maf_bins) 
     synonymous_sfs += chunk_synonymous_sfs
@@ -280,8 +284,8 @@ while final_line_number >= 0:
     nonsynonymous_sfs += chunk_nonsynonymous_sfs
     
     sys.stderr.write("Calculating count SFS...\n")
-    chunk_synonymous_counts, chunk_synonymous_weights = diversity_utils.calculate_pooled_counts(allele_counts_map, passed_sites_map, allowed_variant_types = set(['4D']), allowed_genes=core_genes,pi_min_k=4)
-    chunk_nonsynonymous_counts, chunk_nonsynonymous_weights = diversity_utils.calculate_pooled_counts(allele_counts_map, passed_sites_map, allowed_variant_types = set(['1D']), allowed_genes=core_genes,pi_min_k=4)
+    chunk_synonymous_counts, chunk_synonymous_weights = diversity_utils.calculate_pooled_counts_from_snp_container(snp_container, allowed_variant_types = set(['4D']), allowed_genes=core_genes,pi_min_k=4)
+    chunk_nonsynonymous_counts, chunk_nonsynonymous_weights = diversity_utils.calculate_pooled_counts_from_snp_container(snp_container, allowed_variant_types = set(['1D']), allowed_genes=core_genes,pi_min_k=4)
         
     chunk_synonymous_count_sfs, dummy = numpy.histogram(chunk_synonymous_counts, bins=count_bins) 
     synonymous_count_sfs += chunk_synonymous_count_sfs
@@ -42,10 +42,20 @@ sys.stderr.write('Done calculating coverage distribution!\n')
 
 # Calculate error pvalues
 # this produces the file annotated_snps.txt.bz2, which contains SNPs that fall between 0.3*median and 3*median, where median=median coverage of a SNP in a sample. The output is in the form of Alt, Ref, where Ref=consensus allele across samples (so, the output is polarized relative to the major allele in the sample). 
+# (pvalues are set to 0 unless --calculate-pvalues is passed to calculate_error_pvalues.py)
 sys.stderr.write('Calculating error pvalues...\n')
 #os.system('python %scalculate_error_pvalues.py %s' % (parse_midas_data.scripts_directory, species_name))
 sys.stderr.write('Done calculating error pvalues!\n')
 
+# Single pass over annotated SNPs
+# this produces the annotated_snps_store/ directory (read by parse_snps instead of annotated_snps.txt.bz2 when it is up to date).
+# Pass --snp-prevalences and/or --within-sample-sfs to also produce the list in snp_prevalences/ and within_sample_sfs.txt.bz2
+# from the same decompression of annotated_snps.txt.bz2, instead of running the steps below.
+# (by default existing snp_prevalences and within_sample_sfs files are left alone)
+sys.stderr.write('Scanning annotated SNPs...\n')
+os.system('python %ssnp_scan_utils.py %s' % (parse_midas_data.scripts_directory, species_name))
+sys.stderr.write('Done scanning annotated SNPs!\n')
+
 # Calculate snp prevalences
 # this produces a list in snp_prevalences/ directory to be loaded later
 # (can disable this and supply the list externally.)
@@ -0,0 +1,137 @@
+###############################################################################
+#
+# Integer sample ids
+#
+# Samples (and subjects) used to be matched by name between the SNP sample
+# order, the pangenome sample order and the metadata tables, one list.index
+# or string comparison at a time. This module interns each name once, and
+# gives it an integer id that stays the same for the rest of the process,
+# so that whole sample lists can be matched with array operations
+# (see calculate_sample_idxs).
+#
+# Like site keys, the ids only live in memory (names are added the first
+# time they are seen), so they shouldn't be written to disk.
+#
+###############################################################################
+import numpy
+
+# map from id type ('samples' or 'subjects') -> {'names': list of names, 'id_map': map from name -> id}
+id_dictionaries = {}
+
+def get_id_dictionary(id_type):
+
+    if id_type not in id_dictionaries:
+        id_dictionaries[id_type] = {'names': [], 'id_map': {}}
+
+    return id_dictionaries[id_type]
+
+#############
+#
+# Returns array of ids for names
+#
+# (names that aren't in the dictionary are added if add_missing,
+#  and get id -1 otherwise)
+#
+#############
+def get_ids(id_type, names, add_missing=True):
+
+    id_dictionary = get_id_dictionary(id_type)
+    id_map = id_dictionary['id_map']
+
+    if len(names)==0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    # (only need one dict lookup per distinct name)
+    unique_names, name_idxs = numpy.unique(numpy.asarray(names), return_inverse=True)
+
+    unique_ids = []
+    for name in unique_names.tolist():
+        if name not in id_map and add_missing:
+            id_map[name] = len(id_dictionary['names'])
+            id_dictionary['names'].append(name)
+        unique_ids.append(id_map.get(name, -1))
+
+    return numpy.array(unique_ids, dtype=numpy.int64)[name_idxs]
+
+def get_names(id_type, ids):
+    names = get_id_dictionary(id_type)['names']
+    return [names[id] for id in numpy.asarray(ids).tolist()]
+
+def get_sample_ids(samples, add_missing=True):
+    return get_ids('samples', samples, add_missing)
+
+def get_subject_ids(subjects, add_missing=True):
+    return get_ids('subjects', subjects, add_missing)
+
+###############################################################################
+#
+# Vectorized joins between sample orders
+#
+###############################################################################
+
+#############
+#
+# Returns array of idxs of ids_from in ids_to (-1 if missing)
+#
+# (if an id appears more than once in ids_to, the first idx is used,
+#  like list.index)
+#
+#############
+def find_ids(ids_from, ids_to):
+
+    ids_from = numpy.asarray(ids_from, dtype=numpy.int64)
+    ids_to = numpy.asarray(ids_to, dtype=numpy.int64)
+
+    if len(ids_to)==0 or len(ids_from)==0:
+        return -1*numpy.ones(len(ids_from), dtype=numpy.int64)
+
+    # (stable sort keeps the first copy of each id first)
+    order = numpy.argsort(ids_to, kind='mergesort')
+    sorted_ids = ids_to[order]
+
+    positions = numpy.fmin(numpy.searchsorted(sorted_ids, ids_from), len(sorted_ids)-1)
+    found = (sorted_ids[positions]==ids_from)*(ids_from>=0)
+
+    return numpy.where(found, order[positions], -1)
+
+def calculate_sample_idxs(sample_list_from, sample_list_to):
+# returns array of idxs of the samples in sample_list_from in sample_list_to (-1 if missing)
+
+    return find_ids(get_sample_ids(sample_list_from), get_sample_ids(sample_list_to))
+
+#############
+#
+# Returns idxs1, idxs2 such that sample_list_1[idxs1] == sample_list_2[idxs2]
+# for all samples that are in both lists (in the order of sample_list_1)
+#
+#############
+def align_sample_lists(sample_list_1, sample_list_2):
+
+    idxs2 = calculate_sample_idxs(sample_list_1, sample_list_2)
+    idxs1 = numpy.nonzero(idxs2>=0)[0]
+
+    return idxs1, idxs2[idxs1]
+
+###############################################################################
+#
+# Pair enumeration
+#
+###############################################################################
+
+def calculate_lower_triangle_pairs(num_items):
+# returns (i,j) idxs for all pairs with j<i, in the order of
+#
+# for i in xrange(0,num_items):
+#     for j in xrange(0,i):
+#
+    lower_idxs, upper_idxs = numpy.tril_indices(num_items, -1)
+    return lower_idxs.astype(numpy.int32), upper_idxs.astype(numpy.int32)
+
+def calculate_upper_triangle_pairs(num_items):
+# returns (i,j) idxs for all pairs with j>i, in the order of
+#
+# for i in xrange(0,num_items):
+#     for j in xrange(i+1,num_items):
+#
+    lower_idxs, upper_idxs = numpy.triu_indices(num_items, 1)
+    return lower_idxs.astype(numpy.int32), upper_idxs.astype(numpy.int32)
@@ -1,4 +1,5 @@
 import numpy
+import sample_id_utils
 from config import *
 
 ###############################################################################
@@ -39,10 +40,13 @@ def calculate_sample_subject_map(subject_sample_map):
 ###############################################################################
 def calculate_sample_idx_map(sample_list_from, sample_list_to):
     
-    sample_list_to = list(sample_list_to)
-    sample_map = {}
-    for i in xrange(0,len(sample_list_from)):
-        sample_map[i] = sample_list_to.index(sample_list_from[i])
+    sample_idxs = sample_id_utils.calculate_sample_idxs(sample_list_from, sample_list_to)
+    
+    if (sample_idxs<0).any():
+        missing_sample = sample_list_from[numpy.nonzero(sample_idxs<0)[0][0]]
+        raise ValueError("%s is not in list" % missing_sample)
+    
+    sample_map = dict(zip(xrange(0,len(sample_idxs)), sample_idxs.tolist()))
     
     return sample_map
 
@@ -50,6 +54,33 @@ def apply_sample_index_map_to_indices(sample_idx_map, idxs):
     new_idxs = (numpy.array([sample_idx_map[i] for i in idxs[0]]), numpy.array([sample_idx_map[i] for i in idxs[1]]))
     return new_idxs
 
+###############################################################################
+#
+# For a subject_sample_time_map (subject -> visno -> [[sample, day], ...]),
+# returns map from subject -> visno -> idx in samples of the sample at 
+# that timepoint (-1 if it is not in samples)
+#
+###############################################################################
+def calculate_timepoint_sample_idx_map(subject_sample_time_map, samples):
+    
+    timepoints = []
+    timepoint_samples = []
+    for subject in subject_sample_time_map.keys():
+        for visno in subject_sample_time_map[subject].keys():
+            if len(subject_sample_time_map[subject][visno])>0:
+                timepoints.append((subject, visno))
+                timepoint_samples.append(subject_sample_time_map[subject][visno][0][0])
+    
+    sample_idxs = sample_id_utils.calculate_sample_idxs(timepoint_samples, samples).tolist()
+    
+    timepoint_sample_idx_map = {}
+    for (subject, visno), sample_idx in zip(timepoints, sample_idxs):
+        if subject not in timepoint_sample_idx_map:
+            timepoint_sample_idx_map[subject] = {}
+        timepoint_sample_idx_map[subject][visno] = sample_idx
+    
+    return timepoint_sample_idx_map
+
 def sample_name_lookup(sample_name, samples):
     
     for sample in samples:
@@ -159,38 +190,22 @@ def calculate_subject_pairs(subject_sample_map, sample_list=[]):
     if len(sample_list)==0:
         sample_list = list(sorted(flatten_samples(subject_sample_map).keys()))
     
-    new_sample_list = []
-    for sample in sample_list:
-        if sample.endswith('c'):
-            new_sample_list.append(sample[:-1])
-        else: 
-            new_sample_list.append(sample)
+    sample_list = parse_merged_sample_names(sample_list)
     
-    sample_list = new_sample_list
+    sample_subject_map = calculate_sample_subject_map(subject_sample_map)
+    subject_ids = sample_id_utils.get_subject_ids([sample_subject_map[sample] for sample in sample_list])
     
-    # invert subject sample map
-    sample_subject_map = {}
-    for subject in subject_sample_map.keys():
-        for sample in subject_sample_map[subject].keys():
-            sample_subject_map[sample] = subject
+    # all pairs (i,j) with j<i
+    lower_idxs, upper_idxs = sample_id_utils.calculate_lower_triangle_pairs(len(sample_list))
+    same_subjects = (subject_ids[lower_idxs]==subject_ids[upper_idxs])
+    diff_subjects = numpy.logical_not(same_subjects)
     
-    same_sample_idx_lower = []
-    same_sample_idx_upper = []
-    same_subject_idx_lower = []
-    same_subject_idx_upper = []
-    diff_subject_idx_lower = []
-    diff_subject_idx_upper = []
-        
-    for i in xrange(0,len(sample_list)):
-        same_sample_idx_lower.append(i)
-        same_sample_idx_upper.append(i)
-        for j in xrange(0,i):
-            if sample_subject_map[sample_list[i]]==sample_subject_map[sample_list[j]]:
-                same_subject_idx_lower.append(i)
-                same_subject_idx_upper.append(j)
-            else: 
-                diff_subject_idx_lower.append(i)
-                diff_subject_idx_upper.append(j)
+    same_sample_idx_lower = numpy.arange(0,len(sample_list))
+    same_sample_idx_upper = numpy.arange(0,len(sample_list))
+    same_subject_idx_lower = lower_idxs[same_subjects]
+    same_subject_idx_upper = upper_idxs[same_subjects]
+    diff_subject_idx_lower = lower_idxs[diff_subjects]
+    diff_subject_idx_upper = upper_idxs[diff_subjects]
     
     same_sample_idxs = (numpy.array(same_sample_idx_lower,dtype=numpy.int32), numpy.array(same_sample_idx_upper,dtype=numpy.int32))
     
@@ -321,18 +336,13 @@ def calculate_ordered_subject_pairs(sample_order_map, sample_list=[], within_hos
                         same_subject_idx_upper.append( subject_order_idx_map[subject][sorted_orders[order_idx_j]] )
                
     # now create index pairs in different subjects
+    # (first sample of each subject)
     sorted_subjects = sorted(subject_order_idx_map.keys())
+    first_sample_idxs = numpy.array([subject_order_idx_map[subject][min(subject_order_idx_map[subject].keys())] for subject in sorted_subjects], dtype=numpy.int32)
     
-    for subject_i_idx in xrange(0,len(sorted_subjects)):
-        subject_i = sorted_subjects[subject_i_idx]
-        i = subject_order_idx_map[subject_i][min(subject_order_idx_map[subject_i].keys())]
-        
-        for subject_j_idx in xrange(subject_i_idx+1,len(sorted_subjects)):
-            subject_j = sorted_subjects[subject_j_idx]
-            j = subject_order_idx_map[subject_j][min(subject_order_idx_map[subject_j].keys())]
-            
-            diff_subject_idx_lower.append(i)
-            diff_subject_idx_upper.append(j)
+    subject_i_idxs, subject_j_idxs = sample_id_utils.calculate_upper_triangle_pairs(len(sorted_subjects))
+    diff_subject_idx_lower = first_sample_idxs[subject_i_idxs]
+    diff_subject_idx_upper = first_sample_idxs[subject_j_idxs]
                  
     same_sample_idxs = (numpy.array(same_sample_idx_lower,dtype=numpy.int32), numpy.array(same_sample_idx_upper,dtype=numpy.int32))
     
@@ -147,3 +147,211 @@ def calculate_polymorphism_rates_from_sfs_map(sfs_map,lower_threshold=0.2,upper_
     return within_sites, between_sites, total_sites
     
     
+
+##############################################################################
+#
+# Array-backed within-sample SFSs
+#
+# Instead of a map from (D,A) -> [n, reverse_n] for each sample,
+# sfs_arrays stores the SFSs of all samples as parallel arrays with one
+# entry per (sample, D, A), sorted by sample, then D, then A:
+#
+# 'samples' = array of sample names
+# 'sample_idxs' = index of entry's sample in samples
+# 'depths', 'alts' = D and A
+# 'counts' = n (number of sites)
+# 'reverse_counts' = reverse_n (weight of polarization reversals)
+#
+# (see parse_midas_data.parse_within_sample_sfs_arrays). The functions
+# below calculate the same statistics as their _from_sfs_map versions,
+# for all samples at once.
+#
+##############################################################################
+
+def calculate_sfs_maps_from_sfs_arrays(sfs_arrays):
+    
+    sfs_maps = {sample: {} for sample in sfs_arrays['samples']}
+    
+    for sample_idx, D, A, n, reverse_n in zip(sfs_arrays['sample_idxs'].tolist(), sfs_arrays['depths'].tolist(), sfs_arrays['alts'].tolist(), sfs_arrays['counts'].tolist(), sfs_arrays['reverse_counts'].tolist()):
+        sfs_maps[sfs_arrays['samples'][sample_idx]][(D,A)] = [n, reverse_n]
+    
+    return sfs_maps
+
+def calculate_sfs_arrays_from_sfs_maps(samples, sfs_maps):
+    
+    sample_idxs = []
+    depths = []
+    alts = []
+    counts = []
+    reverse_counts = []
+    for sample_idx, sample in enumerate(samples):
+        for (D,A) in sorted(sfs_maps[sample].keys()):
+            sample_idxs.append(sample_idx)
+            depths.append(D)
+            alts.append(A)
+            counts.append(sfs_maps[sample][(D,A)][0])
+            reverse_counts.append(sfs_maps[sample][(D,A)][1])
+    
+    return {'samples': numpy.array(samples), 'sample_idxs': numpy.array(sample_idxs, dtype=numpy.int64), 'depths': numpy.array(depths, dtype=numpy.int64), 'alts': numpy.array(alts, dtype=numpy.int64), 'counts': numpy.array(counts, dtype=numpy.int64), 'reverse_counts': numpy.array(reverse_counts, dtype=numpy.float64)}
+
+# Returns sfs_arrays for a subset of samples (in the given order)
+def select_sfs_samples(sfs_arrays, samples):
+    
+    sample_idx_map = {sample: idx for idx, sample in enumerate(sfs_arrays['samples'])}
+    old_sample_idxs = numpy.array([sample_idx_map[sample] for sample in samples], dtype=numpy.int64)
+    
+    new_sample_idx_map = numpy.ones(len(sfs_arrays['samples']), dtype=numpy.int64)*-1
+    new_sample_idx_map[old_sample_idxs] = numpy.arange(0,len(old_sample_idxs))
+    
+    new_sample_idxs = new_sample_idx_map[sfs_arrays['sample_idxs']]
+    
+    # (keep entries sorted by sample)
+    entry_idxs = numpy.nonzero(new_sample_idxs>=0)[0]
+    entry_idxs = entry_idxs[numpy.argsort(new_sample_idxs[entry_idxs], kind='mergesort')]
+    
+    selected_sfs_arrays = {key: sfs_arrays[key][entry_idxs] for key in ['sample_idxs', 'depths', 'alts', 'counts', 'reverse_counts']}
+    selected_sfs_arrays['sample_idxs'] = new_sample_idxs[entry_idxs]
+    selected_sfs_arrays['samples'] = numpy.array(samples)
+    
+    return selected_sfs_arrays
+
+# Sums weights over the entries of each sample 
+def sum_by_sample(sfs_arrays, weights):
+    return numpy.bincount(sfs_arrays['sample_idxs'], weights=weights, minlength=len(sfs_arrays['samples']))
+
+###############
+#
+# Returns median depth of each sample (weighted by number of sites)
+#
+###############
+def calculate_median_depths(sfs_arrays):
+    
+    sample_idxs = sfs_arrays['sample_idxs']
+    depths = sfs_arrays['depths']
+    counts = sfs_arrays['counts']
+    
+    # (entries are already sorted by depth within each sample)
+    total_counts = numpy.bincount(sample_idxs, weights=counts, minlength=len(sfs_arrays['samples'])).astype(numpy.int64)
+    cumulative_counts = numpy.cumsum(counts)
+    sample_starts = numpy.cumsum(total_counts)-total_counts
+    cumulative_counts -= sample_starts[sample_idxs]
+    
+    # first entry in each sample with CDF > 0.5
+    above_median_idxs = numpy.nonzero(2*cumulative_counts > total_counts[sample_idxs])[0]
+    median_sample_idxs, first_idxs = numpy.unique(sample_idxs[above_median_idxs], return_index=True)
+    
+    median_depths = numpy.zeros(len(sfs_arrays['samples']), dtype=numpy.int64)
+    median_depths[median_sample_idxs] = depths[above_median_idxs[first_idxs]]
+    
+    return median_depths
+
+###############
+#
+# Returns fs, sample x bin matrix of pfs
+# (see calculate_binned_sfs_from_sfs_map, but bins must be provided)
+#
+###############
+def calculate_binned_sfs_from_sfs_arrays(sfs_arrays, bins, folding='minor'):
+    
+    sample_idxs = sfs_arrays['sample_idxs']
+    
+    weights = sfs_arrays['counts']*1.0/sum_by_sample(sfs_arrays, sfs_arrays['counts'])[sample_idxs]
+    
+    freqs = sfs_arrays['alts']*1.0/sfs_arrays['depths']
+    minor_freqs = numpy.fmin(freqs,1-freqs)
+    
+    bins = numpy.array(bins)
+    fs = bins[1:]
+    
+    # (bin_idx 0 wraps around to the last bin, like pfs[bin_idx-1])
+    bin_idxs = (numpy.digitize(minor_freqs, bins=bins)-1) % len(fs)
+    
+    pfs = numpy.bincount(sample_idxs*len(fs)+bin_idxs, weights=weights, minlength=len(sfs_arrays['samples'])*len(fs)).reshape((len(sfs_arrays['samples']), len(fs)))
+    
+    # should already be normalized, but just to make sure...
+    pfs /= pfs.sum(axis=1)[:,None]
+    
+    if folding=='major':
+        pfs = pfs[:,::-1]
+        fs = (1.0-fs)[::-1]
+    
+    return fs, pfs
+
+###############
+#
+# Returns sample x bin matrices of bins, Ds, pDs
+# (see calculate_binned_depth_distribution_from_sfs_map)
+#
+###############
+def calculate_binned_depth_distribution_from_sfs_arrays(sfs_arrays, bins=[], num_bins=30):
+    
+    num_samples = len(sfs_arrays['samples'])
+    sample_idxs = sfs_arrays['sample_idxs']
+    depths = sfs_arrays['depths']
+    
+    weights = sfs_arrays['counts']*1.0/sum_by_sample(sfs_arrays, sfs_arrays['counts'])[sample_idxs]
+    
+    if len(bins)==0:
+        # use median depth of each sample to set up bins
+        Dbars = calculate_median_depths(sfs_arrays)
+        bins = numpy.array([numpy.logspace(log10(Dbar/8),log10(Dbar*8),num_bins) for Dbar in Dbars]).reshape((num_samples,num_bins))
+    else:
+        bins = numpy.array([bins]*num_samples, dtype=numpy.float64).reshape((num_samples,len(bins)))
+    
+    # (Ds is a view, so Ds[:,0] is 0 too)
+    Ds = bins[:,0:-1]
+    
+    bins[:,0] = 0
+    bins[:,-1] = 1e09
+    
+    # same as numpy.digitize on each sample's bins
+    bin_idxs = (depths[:,None] >= bins[sample_idxs]).sum(axis=1)
+    
+    pDs = numpy.bincount(sample_idxs*Ds.shape[1]+bin_idxs-1, weights=weights, minlength=num_samples*Ds.shape[1]).reshape(Ds.shape)
+    
+    # should already be normalized, but just to make sure...
+    pDs /= pDs.sum(axis=1)[:,None]
+    
+    return bins, Ds, pDs
+
+###############
+#
+# Returns arrays of within_sites, between_sites, total_sites for each sample
+# (see calculate_polymorphism_rates_from_sfs_map)
+#
+###############
+def calculate_polymorphism_rates_from_sfs_arrays(sfs_arrays,lower_threshold=0.2,upper_threshold=0.8):
+    
+    fs = sfs_arrays['alts']*1.0/sfs_arrays['depths']
+    counts = sfs_arrays['counts']
+    reverse_counts = sfs_arrays['reverse_counts']
+    
+    intermediate_sites = (fs>lower_threshold)*(fs<upper_threshold)
+    
+    total_sites = sum_by_sample(sfs_arrays, counts).astype(numpy.int64)
+    within_sites = sum_by_sample(sfs_arrays, counts*intermediate_sites).astype(numpy.int64)
+    between_sites = sum_by_sample(sfs_arrays, numpy.where(intermediate_sites, 0, numpy.where(fs>0.5, counts-reverse_counts, reverse_counts)))
+    
+    return within_sites, between_sites, total_sites
+
+###############
+#
+# Returns arrays of total pi and number of opportunities for each sample
+# (see diversity_utils.calculate_pi_from_sfs_map)
+#
+###############
+def calculate_pi_from_sfs_arrays(sfs_arrays):
+    
+    alts = sfs_arrays['alts'].copy()
+    depths = sfs_arrays['depths']
+    counts = sfs_arrays['counts']
+    
+    alt_lower_threshold = numpy.ceil(depths*0.05)+0.5 #at least one read above 5%.
+    alts[alts<alt_lower_threshold] = 0
+    alt_upper_threshold = numpy.floor(depths*0.95)-0.5 #at least one read below 95%
+    alts[alts>alt_upper_threshold] = depths[alts>alt_upper_threshold]
+    
+    total_pis = sum_by_sample(sfs_arrays, (2*alts*(depths-alts)*1.0/(depths*(depths-1)+(depths<1.1)))*counts)
+    num_opportunities = sum_by_sample(sfs_arrays, counts)
+    
+    return total_pis, num_opportunities
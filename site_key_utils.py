@@ -0,0 +1,126 @@
+###############################################################################
+#
+# Integer site keys
+#
+# Sites used to be identified by (contig, location) tuples, which take up a
+# lot of memory and can only be compared one at a time with dict lookups.
+# A site key packs the same information into a single int64:
+#
+# key = (contig id << location_bits) + location
+#
+# where contig ids come from a per-species contig dictionary. The dictionary
+# only lives in memory (contigs are added the first time they are seen), so
+# keys can be compared with each other within a process, but shouldn't be
+# written to disk.
+#
+# Sets of sites are stored as sorted arrays of keys, so that many sites can
+# be looked up at once with searchsorted (see isin_site_key_set).
+#
+###############################################################################
+import numpy
+
+location_bits = 40
+
+# map from species_name -> {'contigs': list of contigs, 'contig_id_map': map from contig -> id}
+contig_dictionaries = {}
+
+def get_contig_dictionary(species_name):
+
+    if species_name not in contig_dictionaries:
+        contig_dictionaries[species_name] = {'contigs': [], 'contig_id_map': {}}
+
+    return contig_dictionaries[species_name]
+
+#############
+#
+# Returns array of contig ids for contigs
+#
+# (contigs that aren't in the dictionary are added if add_missing,
+#  and get id -1 otherwise)
+#
+#############
+def get_contig_ids(species_name, contigs, add_missing=True):
+
+    contig_dictionary = get_contig_dictionary(species_name)
+    contig_id_map = contig_dictionary['contig_id_map']
+
+    if len(contigs)==0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    # (only need one dict lookup per distinct contig)
+    unique_contigs, contig_idxs = numpy.unique(numpy.asarray(contigs), return_inverse=True)
+
+    unique_contig_ids = []
+    for contig in unique_contigs.tolist():
+        if contig not in contig_id_map and add_missing:
+            contig_id_map[contig] = len(contig_dictionary['contigs'])
+            contig_dictionary['contigs'].append(contig)
+        unique_contig_ids.append(contig_id_map.get(contig, -1))
+
+    return numpy.array(unique_contig_ids, dtype=numpy.int64)[contig_idxs]
+
+def pack_site_keys(contig_ids, locations):
+# (key is -1 for sites with contig id -1)
+
+    contig_ids = numpy.asarray(contig_ids, dtype=numpy.int64)
+    keys = (contig_ids << location_bits) + numpy.asarray(locations, dtype=numpy.int64)
+    return numpy.where(contig_ids>=0, keys, -1)
+
+def calculate_site_keys(species_name, contigs, locations, add_missing=True):
+# returns int64 array of site keys for sites at (contigs[i], locations[i])
+
+    return pack_site_keys(get_contig_ids(species_name, contigs, add_missing), locations)
+
+def calculate_site_key(species_name, contig, location, add_missing=True):
+# returns site key for a single site (-1 if contig is missing and not add_missing)
+
+    contig_dictionary = get_contig_dictionary(species_name)
+
+    if contig not in contig_dictionary['contig_id_map']:
+        if not add_missing:
+            return -1
+        contig_dictionary['contig_id_map'][contig] = len(contig_dictionary['contigs'])
+        contig_dictionary['contigs'].append(contig)
+
+    return (long(contig_dictionary['contig_id_map'][contig]) << location_bits) + long(location)
+
+def decode_site_keys(species_name, keys):
+# returns list of contigs and array of locations of site keys
+
+    contigs = get_contig_dictionary(species_name)['contigs']
+
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    contig_ids = keys >> location_bits
+    locations = keys - (contig_ids << location_bits)
+
+    return [contigs[contig_id] for contig_id in contig_ids.tolist()], locations
+
+###############################################################################
+#
+# Sets of sites (sorted int64 arrays of site keys)
+#
+###############################################################################
+
+def create_site_key_set(keys):
+    return numpy.unique(numpy.asarray(keys, dtype=numpy.int64))
+
+#############
+#
+# Returns idxs of keys in sorted_keys, and boolean array of whether they were found
+# (idx is meaningless if not found)
+#
+#############
+def find_site_keys(sorted_keys, keys):
+
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+
+    if len(sorted_keys)==0:
+        return numpy.zeros(len(keys), dtype=numpy.int64), numpy.zeros(len(keys), dtype=numpy.bool_)
+
+    idxs = numpy.fmin(numpy.searchsorted(sorted_keys, keys), len(sorted_keys)-1)
+    found = (sorted_keys[idxs]==keys)*(keys>=0)
+
+    return idxs, found
+
+def isin_site_key_set(site_key_set, keys):
+    return find_site_keys(site_key_set, keys)[1]
@@ -0,0 +1,285 @@
+###############################################################################
+#
+# Contiguous in-memory container for the SNPs returned by parse_snps
+#
+# allele_counts_map and passed_sites_map spread a species' SNPs over
+# thousands of small arrays (one per gene and variant type) and lists of
+# location tuples. A SNP container holds the same data in a few flat arrays:
+#
+# 'gene_names' = list of genes
+# 'variant_types' = sorted list of variant types
+# 'alleles' = (sites x samples x 2) matrix of allele counts for all SNPs,
+#             sorted by gene and then by variant type
+# 'block_offsets' = offsets of the sites of each (gene, variant type)
+#                   block: the sites of gene g and variant type v are
+#                   block_offsets[g*V+v]:block_offsets[g*V+v+1]
+#                   (V = number of variant types)
+# 'gene_offsets' = offsets of the sites of each gene (= block_offsets[::V])
+# 'site_gene_idxs', 'site_variant_type_idxs' = gene and variant type of each site
+# 'contigs', 'site_contig_idxs', 'site_locations' = location of each site
+# 'site_keys' = site key of each site (see site_key_utils)
+# 'block_present' = (genes x variant types) matrix of whether the gene has
+#                   an entry for the variant type in passed_sites_map
+# 'depth_patterns', 'pattern_counts' = passed sites of all blocks
+#                   (see parse_midas_data.calculate_passed_sites_matrix),
+#                   concatenated, with offsets 'pattern_block_offsets'
+# 'gene_contig_idxs', 'gene_locations' = passed_sites_map[gene][v]['location']
+#
+# Genome-wide quantities can be calculated in a single pass over 'alleles'
+# (see select_sites), and per-gene ones with sum_by_gene.
+# get_gene_snps and unpack_snp_container return the old map entries,
+# with allele counts that are views of 'alleles'.
+#
+###############################################################################
+import numpy
+
+import parse_midas_data
+
+###############################################################################
+#
+# Creates a SNP container
+#
+# snp_genes = iterable of (gene_name, gene_allele_counts, gene_passed_sites),
+#             e.g. from parse_midas_data.parse_snp_genes
+# num_samples = number of samples
+#
+###############################################################################
+def create_snp_container(snp_genes, num_samples):
+
+    gene_names = []
+    gene_idx_map = {}
+    gene_allele_counts_list = []
+    gene_passed_sites_list = []
+
+    for gene_name, gene_allele_counts, gene_passed_sites in snp_genes:
+        if gene_name in gene_idx_map:
+            # (gene whose sites aren't contiguous in the file)
+            gene_idx = gene_idx_map[gene_name]
+            parse_midas_data.merge_snp_gene_runs(gene_allele_counts_list[gene_idx], gene_passed_sites_list[gene_idx], gene_allele_counts, gene_passed_sites)
+        else:
+            gene_idx_map[gene_name] = len(gene_names)
+            gene_names.append(gene_name)
+            gene_allele_counts_list.append(gene_allele_counts)
+            gene_passed_sites_list.append(gene_passed_sites)
+
+    variant_types = list(sorted(set([variant_type for gene_passed_sites in gene_passed_sites_list for variant_type in gene_passed_sites.keys()])))
+
+    contigs = []
+    contig_idx_map = {}
+    def get_contig_idx(contig):
+        if contig not in contig_idx_map:
+            contig_idx_map[contig] = len(contigs)
+            contigs.append(contig)
+        return contig_idx_map[contig]
+
+    alleles = []
+    site_contig_idxs = []
+    site_locations = []
+    site_keys = []
+    block_sizes = numpy.zeros((len(gene_names), len(variant_types)), dtype=numpy.int64)
+    block_present = numpy.zeros((len(gene_names), len(variant_types)), dtype=numpy.bool_)
+
+    depth_patterns = []
+    pattern_counts = []
+    pattern_block_sizes = numpy.zeros_like(block_sizes)
+
+    gene_contig_idxs = numpy.zeros(len(gene_names), dtype=numpy.int64)
+    gene_locations = numpy.zeros(len(gene_names), dtype=numpy.int64)
+
+    for gene_idx in xrange(0,len(gene_names)):
+
+        gene_allele_counts = gene_allele_counts_list[gene_idx]
+        gene_passed_sites = gene_passed_sites_list[gene_idx]
+
+        for variant_type_idx in xrange(0,len(variant_types)):
+
+            variant_type = variant_types[variant_type_idx]
+            if variant_type not in gene_passed_sites:
+                continue
+
+            block_present[gene_idx, variant_type_idx] = True
+
+            contig, location = gene_passed_sites[variant_type]['location']
+            gene_contig_idxs[gene_idx] = get_contig_idx(contig)
+            gene_locations[gene_idx] = location
+
+            depth_patterns.append(gene_passed_sites[variant_type]['depth_patterns'])
+            pattern_counts.append(gene_passed_sites[variant_type]['pattern_counts'])
+            pattern_block_sizes[gene_idx, variant_type_idx] = len(gene_passed_sites[variant_type]['pattern_counts'])
+
+            block_alleles = gene_allele_counts[variant_type]['alleles']
+            if len(block_alleles)==0:
+                continue
+
+            alleles.append(block_alleles)
+            site_contig_idxs.extend([get_contig_idx(contig) for contig, location in gene_allele_counts[variant_type]['locations']])
+            site_locations.extend([location for contig, location in gene_allele_counts[variant_type]['locations']])
+            site_keys.append(gene_allele_counts[variant_type]['site_keys'])
+            block_sizes[gene_idx, variant_type_idx] = len(block_alleles)
+
+    if len(alleles)>0:
+        alleles = parse_midas_data.compact_allele_counts(numpy.concatenate([block_alleles.astype(numpy.uint32) for block_alleles in alleles]))
+    else:
+        alleles = numpy.zeros((0,num_samples,2), dtype=numpy.uint16)
+
+    if len(depth_patterns)>0:
+        depth_patterns = numpy.concatenate(depth_patterns)
+        pattern_counts = numpy.concatenate(pattern_counts).astype(parse_midas_data.passed_sites_dtype)
+    else:
+        depth_patterns = numpy.zeros((0,num_samples), dtype=numpy.bool_)
+        pattern_counts = numpy.zeros(0, dtype=parse_midas_data.passed_sites_dtype)
+
+    block_offsets = numpy.hstack([[0], numpy.cumsum(block_sizes.flatten())]).astype(numpy.int64)
+
+    snp_container = {}
+    snp_container['gene_names'] = gene_names
+    snp_container['gene_idx_map'] = gene_idx_map
+    snp_container['variant_types'] = variant_types
+    snp_container['alleles'] = alleles
+    snp_container['block_offsets'] = block_offsets
+    snp_container['gene_offsets'] = block_offsets[::max([len(variant_types),1])]
+    snp_container['site_gene_idxs'] = numpy.repeat(numpy.arange(0,len(gene_names)), block_sizes.sum(axis=1))
+    snp_container['site_variant_type_idxs'] = numpy.repeat(numpy.tile(numpy.arange(0,len(variant_types)), len(gene_names)), block_sizes.flatten())
+    snp_container['contigs'] = contigs
+    snp_container['site_contig_idxs'] = numpy.array(site_contig_idxs, dtype=numpy.int64)
+    snp_container['site_locations'] = numpy.array(site_locations, dtype=numpy.int64)
+    snp_container['site_keys'] = numpy.hstack([numpy.zeros(0, dtype=numpy.int64)]+site_keys)
+    snp_container['block_present'] = block_present
+    snp_container['depth_patterns'] = depth_patterns
+    snp_container['pattern_counts'] = pattern_counts
+    snp_container['pattern_block_offsets'] = numpy.hstack([[0], numpy.cumsum(pattern_block_sizes.flatten())]).astype(numpy.int64)
+    snp_container['gene_contig_idxs'] = gene_contig_idxs
+    snp_container['gene_locations'] = gene_locations
+
+    return snp_container
+
+def create_snp_container_from_maps(allele_counts_map, passed_sites_map, num_samples):
+# same as above, from the output of parse_snps (genes are in sorted order)
+
+    return create_snp_container(((gene_name, allele_counts_map[gene_name], passed_sites_map[gene_name]) for gene_name in sorted(passed_sites_map.keys())), num_samples)
+
+###############################################################################
+#
+# Gene-level views (same as allele_counts_map[gene_name] and
+# passed_sites_map[gene_name] from parse_snps)
+#
+###############################################################################
+def get_gene_snps(snp_container, gene_name):
+
+    gene_idx = snp_container['gene_idx_map'][gene_name]
+    num_variant_types = len(snp_container['variant_types'])
+
+    contigs = snp_container['contigs']
+    gene_location = (contigs[snp_container['gene_contig_idxs'][gene_idx]], long(snp_container['gene_locations'][gene_idx]))
+
+    gene_allele_counts = {}
+    gene_passed_sites = {}
+
+    for variant_type_idx in xrange(0,num_variant_types):
+
+        if not snp_container['block_present'][gene_idx, variant_type_idx]:
+            continue
+
+        variant_type = snp_container['variant_types'][variant_type_idx]
+        block_idx = gene_idx*num_variant_types+variant_type_idx
+
+        start_idx = snp_container['block_offsets'][block_idx]
+        end_idx = snp_container['block_offsets'][block_idx+1]
+
+        if end_idx > start_idx:
+            alleles = snp_container['alleles'][start_idx:end_idx]
+        else:
+            # (same as parse_snps)
+            alleles = parse_midas_data.compact_allele_counts(numpy.array([], dtype=numpy.uint32))
+
+        site_keys = snp_container['site_keys'][start_idx:end_idx]
+
+        locations = [(contigs[contig_idx], long(location)) for contig_idx, location in zip(snp_container['site_contig_idxs'][start_idx:end_idx], snp_container['site_locations'][start_idx:end_idx])]
+
+        gene_allele_counts[variant_type] = {'locations': locations, 'site_keys': site_keys, 'alleles': alleles}
+
+        pattern_start_idx = snp_container['pattern_block_offsets'][block_idx]
+        pattern_end_idx = snp_container['pattern_block_offsets'][block_idx+1]
+
+        gene_passed_sites[variant_type] = {'location': gene_location, 'depth_patterns': snp_container['depth_patterns'][pattern_start_idx:pattern_end_idx], 'pattern_counts': snp_container['pattern_counts'][pattern_start_idx:pattern_end_idx]}
+
+    return gene_allele_counts, gene_passed_sites
+
+def iterate_snp_genes(snp_container):
+# yields (gene_name, gene_allele_counts, gene_passed_sites) for every gene
+# (e.g. for diversity_utils.calculate_matrices_from_snp_genes)
+
+    for gene_name in snp_container['gene_names']:
+        gene_allele_counts, gene_passed_sites = get_gene_snps(snp_container, gene_name)
+        yield gene_name, gene_allele_counts, gene_passed_sites
+
+def unpack_snp_container(snp_container):
+# returns allele_counts_map, passed_sites_map (see parse_snps)
+
+    allele_counts_map = {}
+    passed_sites_map = {}
+    for gene_name, gene_allele_counts, gene_passed_sites in iterate_snp_genes(snp_container):
+        allele_counts_map[gene_name] = gene_allele_counts
+        passed_sites_map[gene_name] = gene_passed_sites
+
+    return allele_counts_map, passed_sites_map
+
+###############################################################################
+#
+# Genome-wide calculations
+#
+###############################################################################
+
+def select_sites(snp_container, allowed_variant_types=set([]), allowed_genes=set([])):
+# returns boolean array of sites in allowed_genes with allowed_variant_types
+# (all genes or variant types if empty)
+
+    if len(allowed_variant_types)==0:
+        allowed_variant_type_idxs = numpy.ones(len(snp_container['variant_types']), dtype=numpy.bool_)
+    else:
+        allowed_variant_type_idxs = numpy.array([variant_type in allowed_variant_types for variant_type in snp_container['variant_types']], dtype=numpy.bool_)
+
+    if len(allowed_genes)==0:
+        allowed_gene_idxs = numpy.ones(len(snp_container['gene_names']), dtype=numpy.bool_)
+    else:
+        allowed_gene_idxs = numpy.array([gene_name in allowed_genes for gene_name in snp_container['gene_names']], dtype=numpy.bool_)
+
+    return allowed_variant_type_idxs[snp_container['site_variant_type_idxs']]*allowed_gene_idxs[snp_container['site_gene_idxs']]
+
+def sum_by_gene(snp_container, site_values):
+# returns sum of site_values (sites x ...) over the sites of each gene
+
+    gene_offsets = snp_container['gene_offsets']
+
+    gene_sums = numpy.zeros((len(gene_offsets)-1,)+site_values.shape[1:], dtype=site_values.dtype)
+
+    # (reduceat doesn't work for genes with no sites)
+    nonempty_genes = (gene_offsets[1:]>gene_offsets[:-1])
+    if nonempty_genes.any():
+        gene_sums[nonempty_genes] = numpy.add.reduceat(site_values, gene_offsets[:-1][nonempty_genes], axis=0)
+
+    return gene_sums
+
+def calculate_passed_sites_matrix(snp_container, allowed_variant_types=set([]), allowed_genes=set([]), sample_idxs=None):
+# returns samples x samples matrix of the number of sites where both
+# samples have coverage (summed over allowed genes and variant types)
+
+    num_variant_types = len(snp_container['variant_types'])
+
+    if len(allowed_variant_types)==0:
+        allowed_variant_type_idxs = numpy.ones(num_variant_types, dtype=numpy.bool_)
+    else:
+        allowed_variant_type_idxs = numpy.array([variant_type in allowed_variant_types for variant_type in snp_container['variant_types']], dtype=numpy.bool_)
+
+    if len(allowed_genes)==0:
+        allowed_gene_idxs = numpy.ones(len(snp_container['gene_names']), dtype=numpy.bool_)
+    else:
+        allowed_gene_idxs = numpy.array([gene_name in allowed_genes for gene_name in snp_container['gene_names']], dtype=numpy.bool_)
+
+    allowed_blocks = (allowed_gene_idxs[:,None]*allowed_variant_type_idxs[None,:]).flatten()
+    pattern_block_sizes = snp_container['pattern_block_offsets'][1:]-snp_container['pattern_block_offsets'][:-1]
+    allowed_patterns = numpy.repeat(allowed_blocks, pattern_block_sizes)
+
+    passed_sites = {'depth_patterns': snp_container['depth_patterns'][allowed_patterns], 'pattern_counts': snp_container['pattern_counts'][allowed_patterns]}
+
+    return parse_midas_data.calculate_passed_sites_matrix(passed_sites, sample_idxs)
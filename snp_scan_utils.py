@@ -0,0 +1,128 @@
+###############################################################################
+#
+# Single streaming pass over annotated_snps.txt.bz2
+#
+# Several postprocessing steps (the columnar SNP store, SNP prevalences,
+# within-sample SFSs) each need to look at every site in annotated_snps.
+# Rather than decompressing and parsing the file once per step, each step
+# is written as a "consumer", and scan_annotated_snps feeds every parsed
+# site to all of them.
+#
+# A consumer is a map with three functions:
+#
+#   'start': called with the (raw) list of samples from the header
+#   'process_site': called for every site with
+#       (line_number, byte_offset, contig, location, gene_name, variant_type,
+#        polarization, pvalue, alts, depths)
+#       where alts and depths are int64 vectors over all samples and
+#       byte_offset is the position of the line in the decompressed file
+#   'finish': called after the last site (writes output)
+#
+###############################################################################
+import numpy
+import sys
+
+import config
+import bz2_utils
+
+annotated_snps_filename_template = "%ssnps/%s/annotated_snps.txt.bz2"
+
+def scan_annotated_snps(species_name, consumers, debug=False):
+
+    snp_file = bz2_utils.open_bz2_file(annotated_snps_filename_template % (config.data_directory, species_name))
+
+    line = snp_file.readline() # header
+    samples = [item.strip() for item in line.split()[1:]]
+    byte_offset = len(line)
+
+    for consumer in consumers:
+        consumer['start'](samples)
+
+    num_sites_processed = 0
+    for line in snp_file:
+
+        site_id, count_str = line.split("\t",1)
+
+        info_items = site_id.split("|")
+        contig = info_items[0]
+        location = long(info_items[1])
+        gene_name = info_items[2]
+        variant_type = info_items[3]
+
+        if len(info_items) > 5: # for backwards compatability
+            polarization = info_items[4]
+            pvalue = float(info_items[5])
+        else:
+            polarization="R" # not correct, but avoids a crash
+            pvalue = float(info_items[4])
+
+        # alt,depth pairs for every sample
+        counts = numpy.fromstring(count_str.replace("\t",","), dtype=numpy.int64, sep=",")
+        alts = counts[0::2]
+        depths = counts[1::2]
+
+        for consumer in consumers:
+            consumer['process_site'](num_sites_processed, byte_offset, contig, location, gene_name, variant_type, polarization, pvalue, alts, depths)
+
+        num_sites_processed += 1
+        byte_offset += len(line)
+
+        if num_sites_processed%50000==0:
+            sys.stderr.write("%dk sites processed...\n" % (num_sites_processed/1000))
+            if debug:
+                break
+
+    snp_file.close()
+
+    for consumer in consumers:
+        consumer['finish']()
+
+    return num_sites_processed
+
+
+if __name__=='__main__':
+
+    ################################################################################
+    #
+    # Standard header to read in argument information
+    #
+    ################################################################################
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("species_name", help="name of species to process")
+    parser.add_argument("--debug", help="Loads only a subset of SNPs for speed", action="store_true")
+    parser.add_argument("--snp-prevalences", help="Also writes the snp_prevalences file (overwriting any existing one)", action="store_true")
+    parser.add_argument("--within-sample-sfs", help="Also writes within_sample_sfs.txt.bz2 (overwriting any existing one)", action="store_true")
+    args = parser.parse_args()
+
+    species_name = args.species_name
+    debug = args.debug
+    snp_prevalences = args.snp_prevalences
+    within_sample_sfs = args.within_sample_sfs
+    ################################################################################
+
+    import snp_store_utils
+    import calculate_snp_prevalences
+    import calculate_within_person_sfs
+    import parse_midas_data
+
+    # (the other outputs can be supplied externally, 
+    #  so they are only written when asked for)
+    consumers = []
+    consumers.append(snp_store_utils.create_snp_store_consumer(species_name, debug=debug))
+
+    if snp_prevalences:
+        consumers.append(calculate_snp_prevalences.create_snp_prevalence_consumer(species_name))
+
+    if within_sample_sfs:
+        sys.stderr.write("Loading core genes...\n")
+        core_genes = parse_midas_data.load_core_genes(species_name)
+        sys.stderr.write("Done! %d core genes\n" % len(core_genes))
+
+        # population freqs come from the same pass, rather than from the
+        # snp_prevalences file written at the end of it
+        consumers.append(calculate_within_person_sfs.create_within_sample_sfs_consumer(species_name, core_genes, calculate_snp_prevalences.calculate_population_freq))
+
+    sys.stderr.write("Scanning annotated SNPs for %s...\n" % species_name)
+    num_sites = scan_annotated_snps(species_name, consumers, debug=debug)
+    sys.stderr.write("Done! Scanned %d sites\n" % num_sites)
@@ -0,0 +1,535 @@
+###############################################################################
+#
+# Columnar binary store for annotated_snps.txt.bz2
+#
+# The text file is converted once into a directory of typed .npy arrays
+# (snps/<species>/annotated_snps_store/). Site metadata is stored as one
+# array per column, and alt/depth counts are stored as chunks of
+# sites x samples matrices in column-major order, so that they can be
+# memory-mapped and only the desired sample columns are read from disk.
+#
+# parse_midas_data.parse_snps uses the store automatically when it exists
+# and is up to date with annotated_snps.txt.bz2
+#
+# Also maintains a gene-range index for annotated_snps.txt.bz2
+# (snps/<species>/annotated_snps_gene_index.txt), which records where each
+# contiguous run of sites from the same gene starts, so that parse_snps can
+# seek to the start of a chunk and skip disallowed genes in the text file.
+#
+###############################################################################
+import numpy
+import sys
+import os
+import os.path
+import bz2
+from array import array
+
+import config
+
+snp_store_directory_template = "%ssnps/%s/annotated_snps_store/"
+annotated_snps_filename_template = "%ssnps/%s/annotated_snps.txt.bz2"
+gene_index_filename_template = "%ssnps/%s/annotated_snps_gene_index.txt"
+
+# number of sites per alt/depth chunk
+default_chunk_size = 20000
+
+# dtype used for alt and depth counts
+count_dtype = numpy.uint32
+
+def get_snp_store_directory(species_name):
+    return snp_store_directory_template % (config.data_directory, species_name)
+
+#############
+#
+# Returns a string that changes whenever annotated_snps.txt.bz2 is rewritten
+# (used to invalidate the store)
+#
+#############
+def calculate_source_stamp(filename):
+
+    if not os.path.isfile(filename):
+        return ""
+
+    file_stat = os.stat(filename)
+    return "%d %d" % (file_stat.st_size, long(file_stat.st_mtime))
+
+###############################################################################
+#
+# Binary caches are directories of files (.npy arrays, string lists, ...)
+# with a source_stamp.txt recording the source files they were built from.
+#
+# They are written to a temporary directory first, so that a failed
+# conversion never leaves behind a half-written cache. The stamp goes in
+# last (a cache without it is never used), and then the temporary directory
+# is swapped into place. The source stamp should be calculated before the
+# source files are read, so that a file that changes while it is being read
+# invalidates the cache.
+#
+###############################################################################
+
+def read_cache_stamp(cache_directory):
+# returns source stamp of cache, or None if there isn't a (complete) cache
+
+    stamp_filename = cache_directory+"source_stamp.txt"
+
+    if not os.path.isfile(stamp_filename):
+        return None
+
+    file = open(stamp_filename,"r")
+    cache_stamp = file.readline().strip()
+    file.close()
+
+    return cache_stamp
+
+def get_tmp_cache_directory(cache_directory):
+    return cache_directory.rstrip("/")+".tmp/"
+
+def start_cache_directory(cache_directory):
+# creates an empty temporary directory for cache_directory and returns its name
+
+    tmp_directory = get_tmp_cache_directory(cache_directory)
+    os.system('rm -rf %s' % tmp_directory)
+    os.system('mkdir -p %s' % tmp_directory)
+    return tmp_directory
+
+def finish_cache_directory(tmp_directory, cache_directory, source_stamp):
+# writes stamp and moves temporary directory into place
+
+    file = open(tmp_directory+"source_stamp.txt","w")
+    file.write(source_stamp+"\n")
+    file.close()
+
+    os.system('rm -rf %s' % cache_directory)
+    os.rename(tmp_directory, cache_directory)
+
+#############
+#
+# Writes cache_directory in one go, by calling write_function(tmp_directory)
+#
+# returns True if successful. If the cache can't be written (e.g. read-only
+# data directory), prints a warning and returns False, since callers can
+# still use the data they have already parsed.
+#
+#############
+def write_cache_directory(cache_directory, source_stamp, write_function):
+
+    try:
+        tmp_directory = start_cache_directory(cache_directory)
+        write_function(tmp_directory)
+        finish_cache_directory(tmp_directory, cache_directory, source_stamp)
+        return True
+
+    except (IOError, OSError):
+        sys.stderr.write("Warning: could not write cache to %s\n" % cache_directory)
+        return False
+
+def snp_store_exists(species_name):
+
+    store_stamp = read_cache_stamp(get_snp_store_directory(species_name))
+
+    if store_stamp is None:
+        return False
+
+    snp_filename = annotated_snps_filename_template % (config.data_directory, species_name)
+    source_stamp = calculate_source_stamp(snp_filename)
+
+    if source_stamp=="":
+        # no text file to compare against, trust the store
+        return True
+
+    return store_stamp==source_stamp
+
+def write_string_list(filename, strings):
+    file = open(filename,"w")
+    for string in strings:
+        file.write(string)
+        file.write("\n")
+    file.close()
+
+def read_string_list(filename):
+    file = open(filename,"r")
+    strings = [line.strip() for line in file]
+    file.close()
+    return strings
+
+###############################################################################
+#
+# Gene-range index
+#
+# A list of maps, one per contiguous run of sites from the same gene, with
+# keys 'gene_name', 'line_number' (of first site, not counting the header),
+# 'byte_offset' (of first site in the decompressed file), 'num_sites',
+# and 'variant_type_counts' (map from variant type -> number of sites)
+#
+###############################################################################
+def add_site_to_gene_ranges(gene_ranges, line_number, byte_offset, gene_name, variant_type):
+
+    if len(gene_ranges)==0 or gene_ranges[-1]['gene_name']!=gene_name:
+        gene_ranges.append({'gene_name': gene_name, 'line_number': line_number, 'byte_offset': byte_offset, 'num_sites': 0, 'variant_type_counts': {}})
+
+    gene_range = gene_ranges[-1]
+    gene_range['num_sites'] += 1
+    if variant_type not in gene_range['variant_type_counts']:
+        gene_range['variant_type_counts'][variant_type] = 0
+    gene_range['variant_type_counts'][variant_type] += 1
+
+def write_gene_index(species_name, gene_ranges, source_stamp):
+
+    gene_index_filename = gene_index_filename_template % (config.data_directory, species_name)
+
+    # same trick as the store: write elsewhere, then move into place
+    file = open(gene_index_filename+".tmp","w")
+    file.write("#%s\n" % source_stamp)
+    file.write("\t".join(["gene_name", "line_number", "byte_offset", "num_sites", "variant_type_counts"]))
+    for gene_range in gene_ranges:
+        variant_type_count_str = ",".join(["%s:%d" % (variant_type, gene_range['variant_type_counts'][variant_type]) for variant_type in sorted(gene_range['variant_type_counts'])])
+        file.write("\n%s\t%d\t%d\t%d\t%s" % (gene_range['gene_name'], gene_range['line_number'], gene_range['byte_offset'], gene_range['num_sites'], variant_type_count_str))
+    file.write("\n")
+    file.close()
+
+    os.rename(gene_index_filename+".tmp", gene_index_filename)
+
+#############
+#
+# Loads gene-range index for annotated_snps.txt.bz2
+#
+# returns list of gene ranges (see above),
+# or None if the index does not exist or is out of date
+#
+#############
+def load_gene_index(species_name):
+
+    gene_index_filename = gene_index_filename_template % (config.data_directory, species_name)
+
+    if not os.path.isfile(gene_index_filename):
+        return None
+
+    snp_filename = annotated_snps_filename_template % (config.data_directory, species_name)
+    source_stamp = calculate_source_stamp(snp_filename)
+
+    file = open(gene_index_filename,"r")
+    index_stamp = file.readline().strip()[1:]
+    if index_stamp!=source_stamp:
+        file.close()
+        return None
+
+    file.readline() # header
+    gene_ranges = []
+    for line in file:
+        # gene names can in principle be empty, so don't use split()
+        items = line.rstrip("\n").split("\t")
+        variant_type_counts = {}
+        if len(items[4])>0:
+            for subitem in items[4].split(","):
+                variant_type, count = subitem.split(":")
+                variant_type_counts[variant_type] = long(count)
+        gene_ranges.append({'gene_name': items[0], 'line_number': long(items[1]), 'byte_offset': long(items[2]), 'num_sites': long(items[3]), 'variant_type_counts': variant_type_counts})
+    file.close()
+
+    return gene_ranges
+
+###############################################################################
+#
+# Creates gene-range index directly from annotated_snps.txt.bz2
+# (create_snp_store also writes it as a side effect)
+#
+###############################################################################
+def create_gene_index(species_name):
+
+    snp_filename = annotated_snps_filename_template % (config.data_directory, species_name)
+    source_stamp = calculate_source_stamp(snp_filename)
+
+    snp_file = bz2.BZ2File(snp_filename,"r")
+    line = snp_file.readline() # header
+    byte_offset = len(line)
+
+    gene_ranges = []
+    line_number = 0
+    for line in snp_file:
+        info_items = line.split(None,1)[0].split("|")
+        add_site_to_gene_ranges(gene_ranges, line_number, byte_offset, info_items[2], info_items[3])
+        line_number += 1
+        byte_offset += len(line)
+
+    snp_file.close()
+
+    write_gene_index(species_name, gene_ranges, source_stamp)
+
+    return gene_ranges
+
+###############################################################################
+#
+# Converts annotated_snps.txt.bz2 to the columnar store
+#
+###############################################################################
+def create_snp_store(species_name, chunk_size=default_chunk_size, debug=False):
+
+    import snp_scan_utils
+
+    # (snp_scan_utils.py runs this together with the other
+    #  consumers of annotated_snps in a single pass)
+    return snp_scan_utils.scan_annotated_snps(species_name, [create_snp_store_consumer(species_name, chunk_size, debug)], debug=debug)
+
+###############################################################################
+#
+# Consumer for snp_scan_utils.scan_annotated_snps that writes the store
+#
+###############################################################################
+def create_snp_store_consumer(species_name, chunk_size=default_chunk_size, debug=False):
+
+    snp_filename = annotated_snps_filename_template % (config.data_directory, species_name)
+    store_directory = get_snp_store_directory(species_name)
+
+    # (see start_cache_directory)
+    tmp_directory = get_tmp_cache_directory(store_directory)
+
+    source_stamp = calculate_source_stamp(snp_filename)
+
+    samples = []
+
+    contig_idx_map = {}
+    gene_idx_map = {}
+    variant_type_idx_map = {}
+
+    contig_idxs = array('i')
+    locations = array('l')
+    gene_idxs = array('i')
+    variant_type_idxs = array('b')
+    polarizations = []
+    pvalues = array('d')
+
+    chunk_alts = []
+    chunk_depths = []
+    # (in a list so that the nested functions can update it)
+    num_chunks = [0]
+
+    gene_ranges = []
+
+    def start(raw_samples):
+        samples.extend(raw_samples)
+        start_cache_directory(store_directory)
+        sys.stderr.write("Converting annotated SNPs for %s to columnar store...\n" % species_name)
+
+    def process_site(line_number, byte_offset, contig, location, gene_name, variant_type, polarization, pvalue, alts, depths):
+
+        if contig not in contig_idx_map:
+            contig_idx_map[contig] = len(contig_idx_map)
+        if gene_name not in gene_idx_map:
+            gene_idx_map[gene_name] = len(gene_idx_map)
+        if variant_type not in variant_type_idx_map:
+            variant_type_idx_map[variant_type] = len(variant_type_idx_map)
+
+        contig_idxs.append(contig_idx_map[contig])
+        locations.append(location)
+        gene_idxs.append(gene_idx_map[gene_name])
+        variant_type_idxs.append(variant_type_idx_map[variant_type])
+        polarizations.append(polarization)
+        pvalues.append(pvalue)
+
+        add_site_to_gene_ranges(gene_ranges, line_number, byte_offset, gene_name, variant_type)
+
+        chunk_alts.append(alts)
+        chunk_depths.append(depths)
+
+        if len(chunk_alts)==chunk_size:
+            save_snp_store_chunk(tmp_directory, num_chunks[0], chunk_alts, chunk_depths)
+            num_chunks[0] += 1
+            del chunk_alts[:]
+            del chunk_depths[:]
+
+    def finish():
+
+        if len(chunk_alts)>0:
+            save_snp_store_chunk(tmp_directory, num_chunks[0], chunk_alts, chunk_depths)
+            num_chunks[0] += 1
+
+        num_sites = len(pvalues)
+
+        write_string_list(tmp_directory+"samples.txt", samples)
+        write_string_list(tmp_directory+"contigs.txt", sorted(contig_idx_map.keys(), key=lambda contig: contig_idx_map[contig]))
+        write_string_list(tmp_directory+"genes.txt", sorted(gene_idx_map.keys(), key=lambda gene_name: gene_idx_map[gene_name]))
+        write_string_list(tmp_directory+"variant_types.txt", sorted(variant_type_idx_map.keys(), key=lambda variant_type: variant_type_idx_map[variant_type]))
+
+        numpy.save(tmp_directory+"contig_idxs.npy", numpy.frombuffer(contig_idxs, dtype=numpy.intc).astype(numpy.int32))
+        numpy.save(tmp_directory+"locations.npy", numpy.frombuffer(locations, dtype=numpy.int_).astype(numpy.int64))
+        numpy.save(tmp_directory+"gene_idxs.npy", numpy.frombuffer(gene_idxs, dtype=numpy.intc).astype(numpy.int32))
+        numpy.save(tmp_directory+"variant_type_idxs.npy", numpy.frombuffer(variant_type_idxs, dtype=numpy.int8))
+        numpy.save(tmp_directory+"polarizations.npy", numpy.array(polarizations, dtype='S1'))
+        numpy.save(tmp_directory+"pvalues.npy", numpy.frombuffer(pvalues, dtype=numpy.float64))
+
+        file = open(tmp_directory+"store_info.txt","w")
+        file.write("num_sites %d\n" % num_sites)
+        file.write("num_samples %d\n" % len(samples))
+        file.write("chunk_size %d\n" % chunk_size)
+        file.write("num_chunks %d\n" % num_chunks[0])
+        file.close()
+
+        if debug:
+            # a debug store only covers part of the file, so it must never
+            # be installed under the stamp of the whole file (parse_snps would
+            # treat it as complete). Same for the gene index.
+            os.system('rm -rf %s' % tmp_directory)
+            sys.stderr.write("Done! Converted %d sites (debug run, store not kept)\n" % num_sites)
+            return
+
+        finish_cache_directory(tmp_directory, store_directory, source_stamp)
+        write_gene_index(species_name, gene_ranges, source_stamp)
+
+        sys.stderr.write("Done! Stored %d sites\n" % num_sites)
+
+    return {'start': start, 'process_site': process_site, 'finish': finish}
+
+def save_snp_store_chunk(store_directory, chunk_idx, chunk_alts, chunk_depths):
+
+    # column-major, so that a subset of sample columns is contiguous on disk
+    numpy.save(store_directory+"alts_%d.npy" % chunk_idx, numpy.asfortranarray(numpy.array(chunk_alts).astype(count_dtype)))
+    numpy.save(store_directory+"depths_%d.npy" % chunk_idx, numpy.asfortranarray(numpy.array(chunk_depths).astype(count_dtype)))
+
+###############################################################################
+#
+# Loads the (memory-mapped) store
+#
+# returns map with site metadata columns and store dimensions
+#
+###############################################################################
+def load_snp_store(species_name):
+
+    store_directory = get_snp_store_directory(species_name)
+
+    snp_store = {}
+    snp_store['directory'] = store_directory
+
+    file = open(store_directory+"store_info.txt","r")
+    for line in file:
+        items = line.split()
+        snp_store[items[0]] = long(items[1])
+    file.close()
+
+    snp_store['samples'] = read_string_list(store_directory+"samples.txt")
+    snp_store['contigs'] = read_string_list(store_directory+"contigs.txt")
+    snp_store['genes'] = read_string_list(store_directory+"genes.txt")
+    snp_store['variant_types'] = read_string_list(store_directory+"variant_types.txt")
+
+    for column in ['contig_idxs', 'locations', 'gene_idxs', 'variant_type_idxs', 'polarizations', 'pvalues']:
+        snp_store[column] = numpy.load(store_directory+column+".npy", mmap_mode='r')
+
+    return snp_store
+
+###############################################################################
+#
+# Loads alt and depth counts for sites [start_idx, end_idx)
+# in the desired sample columns. The range must lie within one chunk.
+#
+# returns sites x samples matrices of alts and depths
+#
+###############################################################################
+def load_snp_store_counts(snp_store, start_idx, end_idx, sample_idxs):
+
+    chunk_size = snp_store['chunk_size']
+    chunk_idx = start_idx/chunk_size
+    chunk_start_idx = chunk_idx*chunk_size
+
+    alts = numpy.load(snp_store['directory']+"alts_%d.npy" % chunk_idx, mmap_mode='r')
+    depths = numpy.load(snp_store['directory']+"depths_%d.npy" % chunk_idx, mmap_mode='r')
+
+    # selecting columns first only touches the pages for those samples
+    alts = alts[:,sample_idxs][(start_idx-chunk_start_idx):(end_idx-chunk_start_idx)]
+    depths = depths[:,sample_idxs][(start_idx-chunk_start_idx):(end_idx-chunk_start_idx)]
+
+    return alts, depths
+
+###############################################################################
+#
+# Iterates over sites in the store in file order, starting at
+# initial_line_number. Yields the same records as
+# parse_midas_data.iterate_annotated_snps_sites:
+#
+# (line_number, contig, location, gene_name, variant_type, polarization, pvalue, alts, depths)
+#
+# where alts and depths are None for sites outside allowed_genes or
+# allowed_variant_types. Of those, only the first site in each run of the
+# same gene is yielded (enough for parse_snps to find chunk boundaries).
+#
+###############################################################################
+def iterate_snp_store_sites(snp_store, desired_sample_idxs, initial_line_number=0, allowed_genes=set([]), allowed_variant_types=set(['1D','2D','3D','4D'])):
+
+    num_sites = snp_store['num_sites']
+    chunk_size = snp_store['chunk_size']
+
+    contigs = snp_store['contigs']
+    genes = snp_store['genes']
+    variant_types = snp_store['variant_types']
+
+    allowed_variant_type_idxs = numpy.array([variant_type in allowed_variant_types for variant_type in variant_types])
+    if len(allowed_genes)==0:
+        allowed_gene_idxs = numpy.ones(len(genes),dtype=numpy.bool_)
+    else:
+        allowed_gene_idxs = numpy.array([gene_name in allowed_genes for gene_name in genes])
+
+    initial_line_number = max([initial_line_number, 0])
+
+    # the first site is always yielded
+    previous_gene_idx = -1
+
+    for chunk_start_idx in xrange((initial_line_number/chunk_size)*chunk_size, num_sites, chunk_size):
+
+        start_idx = max([chunk_start_idx, initial_line_number])
+        end_idx = min([chunk_start_idx+chunk_size, num_sites])
+
+        contig_idxs = snp_store['contig_idxs'][start_idx:end_idx]
+        locations = snp_store['locations'][start_idx:end_idx]
+        gene_idxs = snp_store['gene_idxs'][start_idx:end_idx]
+        variant_type_idxs = snp_store['variant_type_idxs'][start_idx:end_idx]
+        polarizations = snp_store['polarizations'][start_idx:end_idx]
+        pvalues = snp_store['pvalues'][start_idx:end_idx]
+
+        allowed_sites = allowed_variant_type_idxs[variant_type_idxs]*allowed_gene_idxs[gene_idxs]
+
+        gene_starts = numpy.ones_like(allowed_sites)
+        gene_starts[0] = (gene_idxs[0]!=previous_gene_idx)
+        gene_starts[1:] = (gene_idxs[1:]!=gene_idxs[:-1])
+        previous_gene_idx = gene_idxs[-1]
+
+        if allowed_sites.any():
+            alts, depths = load_snp_store_counts(snp_store, start_idx, end_idx, desired_sample_idxs)
+
+        for site_idx in numpy.nonzero(allowed_sites+gene_starts)[0]:
+
+            if allowed_sites[site_idx]:
+                site_alts = alts[site_idx]
+                site_depths = depths[site_idx]
+            else:
+                site_alts = None
+                site_depths = None
+
+            yield (start_idx+long(site_idx), contigs[contig_idxs[site_idx]], long(locations[site_idx]), genes[gene_idxs[site_idx]], variant_types[variant_type_idxs[site_idx]], str(polarizations[site_idx]), float(pvalues[site_idx]), site_alts, site_depths)
+
+
+if __name__=='__main__':
+
+    ################################################################################
+    #
+    # Standard header to read in argument information
+    #
+    ################################################################################
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("species_name", help="name of species to process")
+    parser.add_argument("--debug", help="Converts only a subset of SNPs for speed (and doesn't keep the store)", action="store_true")
+    parser.add_argument("--chunk-size", type=int, help="number of sites per count chunk", default=default_chunk_size)
+    parser.add_argument("--gene-index-only", help="Only creates gene-range index for annotated_snps.txt.bz2", action="store_true")
+    args = parser.parse_args()
+
+    species_name = args.species_name
+    debug = args.debug
+    chunk_size = args.chunk_size
+    gene_index_only = args.gene_index_only
+    ################################################################################
+
+    if gene_index_only:
+        sys.stderr.write("Creating gene-range index for %s...\n" % species_name)
+        gene_ranges = create_gene_index(species_name)
+        sys.stderr.write("Done! Indexed %d gene ranges\n" % len(gene_ranges))
+        sys.exit(0)
+
+    create_snp_store(species_name, chunk_size=chunk_size, debug=debug)
@@ -1,47 +1,13 @@
 import parse_midas_data
+import midas_db_store_utils
 
 def get_genus_name(species_name):
     return species_name.split("_")[0]
     
 def get_taxonomy_map():
-
-    species_genome_map = {}
-    genome_species_map = {}
-    
-    file = open("%sspecies_info.txt" % parse_midas_data.midas_directory,"r")
-    file.readline() # header
-    for line in file:
-        items = line.split()
-        species_name = items[0].strip()
-        genome = items[1].strip()
-        species_genome_map[species_name] = genome
-        genome_species_map[genome] = species_name
-    file.close()
-    
-    species_taxonomy_map = {}
-    
-    file = open("%sgenome_taxonomy.txt" % parse_midas_data.midas_directory,"r")
-    file.readline() # header
-    for line in file:
-        items =  line.split("\t")
-        
-        genome_id = items[0].strip()
-        
-        kingdom = items[3].strip()
-        phylum = items[4].strip()
-        class_name = items[5].strip()
-        order = items[6].strip()
-        family = items[7].strip()
-        genus = items[8].strip()
-        
-        if genome_id in genome_species_map:
-        
-            species_name = genome_species_map[genome_id]
-            species_taxonomy_map[species_name] = (kingdom,phylum,class_name,order,family,genus)
-        
-    return species_taxonomy_map
+    return midas_db_store_utils.get_taxonomy_map()
     
-   
+
 def sort_phylogenetically(species_list, first_entry="", second_sorting_attribute=[]):
 
     species_taxonomy_map = get_taxonomy_map()